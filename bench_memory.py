@@ -0,0 +1,109 @@
+# bench_memory.py
+# Đo đỉnh bộ nhớ cấp phát (tracemalloc) của đường lọc -> gộp nhóm trên dữ liệu mẫu (data/data.parquet):
+# - baseline: chuỗi copy của các page cũ (df.loc[mask].copy(), df_f_time = df_f.copy(), tmp = df_in.copy(),
+#   df_product / df_cohort / df_pareto_base = df_f.copy()), mỗi bản đủ mọi cột
+# - new: 1 bảng lọc duy nhất qua load_view (chỉ các cột cần), cột thời gian thêm trên bản nông (copy-on-write)
+# Chạy: python bench_memory.py > bench_output.txt
+import gc
+import logging
+import tracemalloc
+import warnings
+
+import pandas as pd
+
+logging.disable(logging.WARNING)  # streamlit chạy ngoài server (bare mode) cảnh báo thiếu ScriptRunContext
+warnings.filterwarnings("ignore")
+
+from load_data import PARQUET_FILE, _normalize, load_view  # noqa: E402
+
+GRAINS = ["Ngày", "Tuần", "Tháng", "Quý", "Năm"]
+COLUMNS = ["Ngày", "Region", "Điểm_mua_hàng", "Mã_NB", "Tổng_Gross", "Tổng_Net", "Số_CT", "Số_điện_thoại"]
+AGG = {
+    "Gross": ("Tổng_Gross", "sum"),
+    "Net": ("Tổng_Net", "sum"),
+    "Orders": ("Số_CT", "nunique"),
+    "Customers": ("Số_điện_thoại", "nunique"),
+}
+
+
+def time_label(ngay: pd.Series, grain: str) -> pd.Series:
+    if grain == "Ngày":
+        return ngay.dt.strftime("%Y-%m-%d")
+    if grain == "Tuần":
+        return (ngay - pd.to_timedelta(ngay.dt.weekday, unit="D")).dt.strftime("%Y-%m-%d")
+    return ngay.dt.to_period({"Tháng": "M", "Quý": "Q", "Năm": "Y"}[grain]).astype(str)
+
+
+def group_all(df_f: pd.DataFrame, df_time: pd.DataFrame, df_product: pd.DataFrame, df_cohort: pd.DataFrame) -> list:
+    # các bảng của page tổng quan + nền Pareto / Cohort của CRM, cùng 1 cách tính cho 2 đường
+    return [
+        df_time.groupby("Time", observed=True).agg(**AGG),
+        df_time.groupby(["Time", "Region"], observed=True).agg(**AGG),
+        df_f.groupby("Điểm_mua_hàng", observed=True).agg(**AGG),
+        df_product.groupby("Mã_NB", observed=True).agg(**AGG),
+        df_cohort.groupby("Số_điện_thoại", observed=True)["Ngày"].min(),
+        df_f.groupby(["Điểm_mua_hàng", "Số_điện_thoại"], observed=True)["Tổng_Net"].sum(),
+    ]
+
+
+# =====================================================
+# BASELINE (chuỗi copy của page cũ)
+# =====================================================
+def baseline(df: pd.DataFrame, start_date, end_date, filters: dict, grain: str) -> list:
+    mask = (df["Ngày"] >= pd.to_datetime(start_date)) & (df["Ngày"] <= pd.to_datetime(end_date))
+    for col, values in filters.items():
+        mask &= df[col].isin(values)
+    df_f = df.loc[mask].copy()
+
+    df_f_time = df_f.copy()
+    df_f_time["Time"] = time_label(df_f_time["Ngày"], grain)
+    tmp = df_f_time.copy()  # group_time / add_time_key: copy thêm 1 lần mỗi lần gọi
+    df_product = df_f.copy()
+    df_cohort = df_f.copy()
+    df_pareto_base = df_f.copy()
+    return group_all(df_pareto_base, tmp, df_product, df_cohort)
+
+
+# =====================================================
+# NEW (1 bảng lọc, chỉ các cột cần)
+# =====================================================
+def new(start_date, end_date, filters: dict, grain: str) -> list:
+    df_f = load_view(columns=COLUMNS, start_date=start_date, end_date=end_date, filters=filters)
+
+    df_time = df_f.copy(deep=False)  # copy-on-write: chỉ thêm cột Time, không copy dữ liệu
+    df_time["Time"] = time_label(df_time["Ngày"], grain)
+    return group_all(df_f, df_time, df_f, df_f)
+
+
+def peak_mb(func, *args) -> float:
+    func(*args)  # lần đầu: dựng snapshot / index / cache ngoài phép đo (như dataset đã nạp của baseline)
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return peak / 2**20
+
+
+def main():
+    df = _normalize(pd.read_parquet(PARQUET_FILE))
+    brands = sorted(df["Brand"].dropna().unique())
+    lo, hi = df["Ngày"].min(), df["Ngày"].max()
+    scenarios = {
+        "toàn bộ": (lo, hi, {}),
+        "8 tháng cuối, 2 brand": (hi - pd.DateOffset(months=8), hi, {"Brand": brands[:2]}),
+    }
+
+    print(f"Dữ liệu: {PARQUET_FILE} — {len(df):,} dòng, {df.memory_usage(deep=True).sum() / 2**20:,.1f} MB trong RAM")
+    print(f"{'bộ lọc':<24}{'grain':<8}{'baseline MB':>13}{'new MB':>10}{'giảm':>8}")
+    for name, (start_date, end_date, filters) in scenarios.items():
+        for grain in GRAINS:
+            old = peak_mb(baseline, df, start_date, end_date, filters, grain)
+            cur = peak_mb(new, start_date, end_date, filters, grain)
+            print(f"{name:<24}{grain:<8}{old:>13.1f}{cur:>10.1f}{1 - cur / old:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,11 @@ import numpy as np
 import streamlit as st
 from io import BytesIO
 
-from load_data import get_active_data, set_active_data
+from load_data import (
+    get_active_data, set_active_data, ingest_delta, UI_INGEST, load_view, cube_view, orders_view, cube_agg,
+    cube_distinct, isin_codes, get_catalog, cascade_options, calendar_keys, memoize, memo_stats,
+    render_sections, rerun_memory_start, rerun_memory_peak, HLL_ERROR,
+)
 
 # =====================================================
 # FORMAT HELPERS
@@ -29,34 +33,15 @@ def fmt_pct(x, decimals=2, with_sign=False):
     except Exception:
         return ""
 
-def ensure_datetime(df: pd.DataFrame) -> pd.DataFrame:
-    if "Ngày" in df.columns:
-        df["Ngày"] = pd.to_datetime(df["Ngày"], errors="coerce")
-        df = df.dropna(subset=["Ngày"])
-    return df
-
-def fix_numeric(df: pd.DataFrame) -> pd.DataFrame:
-    for c in ["Tổng_Gross", "Tổng_Net"]:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce")
-    return df
-
 # =====================================================
-# WEEK HELPERS (TUẦN BẮT ĐẦU THEO THỨ - RIÊNG GENERAL)
+# WEEK START (TUẦN BẮT ĐẦU THEO THỨ - RIÊNG GENERAL)
 # =====================================================
+# anchor / nhãn tuần lấy từ calendar chung (Week_anchor_{ws} / Week_label_{ws})
 WEEKDAY_MAP = {
     "Thứ 2": 0, "Thứ 3": 1, "Thứ 4": 2, "Thứ 5": 3,
     "Thứ 6": 4, "Thứ 7": 5, "Chủ nhật": 6
 }
 
-def week_anchor(dt: pd.Series, week_start: int) -> pd.Series:
-    d = pd.to_datetime(dt)
-    return (d - pd.to_timedelta((d.dt.weekday - week_start) % 7, unit="D")).dt.normalize()
-
-def week_label_from_anchor(anchor: pd.Series) -> pd.Series:
-    iso = pd.to_datetime(anchor).dt.isocalendar()
-    return "Tuần " + iso["week"].astype(str).str.zfill(2) + "/" + iso["year"].astype(str)
-
 # =====================================================
 # FILTER HELPERS (ALL + RESET)
 # =====================================================
@@ -92,6 +77,7 @@ def ms_all(key: str, label: str, options, all_label="All", default_all=True):
 # =====================================================
 st.set_page_config(page_title="Marketing Revenue Dashboard", layout="wide")
 st.title("📊 MARKETING REVENUE DASHBOARD – Tổng quan")
+rerun_memory_start()
 
 # =====================================================
 # CHỌN NGUỒN DỮ LIỆU CHO TOÀN APP
@@ -99,9 +85,13 @@ st.title("📊 MARKETING REVENUE DASHBOARD – Tổng quan")
 with st.sidebar:
     st.markdown("### 🗂 Chọn nguồn dữ liệu")
 
+    # nạp thêm ghi vào dữ liệu dùng chung của server => chỉ hiện khi instance bật UI_INGEST
+    src_options = ["Dùng dữ liệu hiện tại", "Upload file parquet từ máy", "Quay lại dữ liệu mặc định"]
+    if UI_INGEST:
+        src_options.insert(2, "Nạp thêm dữ liệu mới (append)")
     src_choice = st.radio(
         "Nguồn dữ liệu (áp dụng cho tất cả trang)",
-        ["Dùng dữ liệu hiện tại", "Upload file parquet từ máy", "Quay lại dữ liệu mặc định"],
+        src_options,
         index=0,
         key="data_source_main",
     )
@@ -115,6 +105,17 @@ with st.sidebar:
             key="parquet_uploader_main",
         )
 
+    delta_files = None
+    if src_choice == "Nạp thêm dữ liệu mới (append)":
+        if st.session_state.get("active_source", "default") != "default" and "active_df" in st.session_state:
+            st.warning("⚠ Phiên đang dùng dữ liệu upload: nạp thêm thành công sẽ bỏ dữ liệu upload và chuyển về dữ liệu mặc định.")
+        delta_files = st.file_uploader(
+            "📥 File .parquet tuần mới (nối vào dữ liệu mặc định trên server)",
+            type=["parquet"],
+            accept_multiple_files=True,
+            key="parquet_delta_main",
+        )
+
 if src_choice == "Upload file parquet từ máy" and uploaded_files:
     dfs = []
     for f in uploaded_files:
@@ -123,31 +124,62 @@ if src_choice == "Upload file parquet từ máy" and uploaded_files:
         except Exception as e:
             st.warning(f"⚠ Không đọc được file: {getattr(f, 'name', 'unknown')} ({e})")
 
+    # set_active_data normalize + kiểm schema 1 lần; page không ép kiểu lại
     df_up = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
-    df_up = ensure_datetime(df_up)
-    df_up = fix_numeric(df_up)
 
     if df_up.empty:
         st.warning("⚠ File parquet upload không có dữ liệu hợp lệ. Vẫn giữ dữ liệu cũ.")
     else:
-        set_active_data(df_up, source="upload")
-        st.success(f"✅ Đã cập nhật dữ liệu từ {len(uploaded_files)} file parquet upload")
+        try:
+            set_active_data(df_up, source="upload")
+            st.success(f"✅ Đã cập nhật dữ liệu từ {len(uploaded_files)} file parquet upload")
+        except ValueError as e:
+            st.warning(f"⚠ File parquet upload không hợp lệ ({e}). Vẫn giữ dữ liệu cũ.")
 
     del dfs, df_up
 
+elif src_choice == "Nạp thêm dữ liệu mới (append)" and delta_files:
+    # file đã nạp trong phiên (theo file_id) => rerun không nạp lại; trùng với dữ liệu cũ do ingest_delta bỏ
+    ingested = st.session_state.setdefault("ingested_files", {})
+    added = 0
+    for f in delta_files:
+        if f.file_id not in ingested:
+            try:
+                ingested[f.file_id] = ingest_delta(pd.read_parquet(f))
+            except Exception as e:
+                st.warning(f"⚠ Không nạp được file: {getattr(f, 'name', 'unknown')} ({e})")
+                continue
+            added += ingested[f.file_id]["added"]
+        stats = ingested[f.file_id]
+        watermark = f"{stats['watermark']:%Y-%m-%d}" if stats["watermark"] is not None else "—"
+        st.success(
+            f"✅ {f.name}: +{stats['added']:,} dòng mới "
+            f"(bỏ {stats['duplicates']:,} dòng trùng, {stats['late']:,} dòng trễ trước {watermark}, "
+            f"{stats['invalid']:,} dòng lỗi Ngày)"
+        )
+
+    if added:
+        st.session_state.pop(GEN_PREFIX + "end_date", None)  # "Đến ngày" theo ngày lớn nhất mới
+        # nạp vào dữ liệu mặc định => phiên đang xem upload chuyển về mặc định (đã cảnh báo ở sidebar)
+        if st.session_state.get("active_source", "default") != "default" and "active_df" in st.session_state:
+            st.session_state.pop("active_df", None)
+            st.session_state["active_source"] = "default"
+            st.info("ℹ Đã bỏ dữ liệu upload của phiên, chuyển về dữ liệu mặc định (gồm phần vừa nạp).")
+
 elif src_choice == "Quay lại dữ liệu mặc định":
     if "active_df" in st.session_state:
         del st.session_state["active_df"]
     _ = get_active_data()
     st.success("↩ Đã quay lại dùng dữ liệu mặc định trên server")
 
-df = get_active_data()
-st.sidebar.caption("🔎 Đang dùng nguồn: **{}**".format(st.session_state.get("active_source", "default")))
+# Bảng dòng hàng chỉ còn cho phần Nhóm SP / Mã NB (chỉ các cột cần); các bảng khác chạy trên cube + header chứng từ
+PRODUCT_COLUMNS = ["Nhóm_hàng", "Mã_NB", "Tổng_Gross", "Tổng_Net", "Số_CT", "Số_điện_thoại", "Số_lượng"]
 
-df = ensure_datetime(df)
-df = fix_numeric(df)
+# option / cascade / min-max ngày đọc từ catalog (dựng 1 lần / dataset), không quét bảng fact
+catalog = get_catalog()
+st.sidebar.caption("🔎 Đang dùng nguồn: **{}**".format(st.session_state.get("active_source", "default")))
 
-if df.empty:
+if catalog["date_min"] is None:
     st.warning("⚠ Không có dữ liệu để phân tích. Kiểm tra lại nguồn dữ liệu.")
     st.stop()
 
@@ -179,130 +211,141 @@ with st.sidebar:
 
     start_date = st.date_input(
         "Từ ngày",
-        df["Ngày"].min().date(),
+        catalog["date_min"].date(),
         key=GEN_PREFIX + "start_date",
     )
     end_date = st.date_input(
         "Đến ngày",
-        df["Ngày"].max().date(),
+        catalog["date_max"].date(),
         key=GEN_PREFIX + "end_date",
     )
 
     loaiCT_filter = ms_all(
         key=GEN_PREFIX + "loaiCT",
         label="Loại CT",
-        options=df["LoaiCT"] if "LoaiCT" in df.columns else [],
+        options=catalog["options"].get("LoaiCT", []),
     )
 
     brand_filter = ms_all(
         key=GEN_PREFIX + "brand",
         label="Brand",
-        options=df["Brand"] if "Brand" in df.columns else [],
+        options=catalog["options"].get("Brand", []),
     )
 
-    df_brand = df[df["Brand"].isin(brand_filter)] if (brand_filter and "Brand" in df.columns) else df.iloc[0:0]
     region_filter = ms_all(
         key=GEN_PREFIX + "region",
         label="Region",
-        options=df_brand["Region"] if "Region" in df_brand.columns else [],
+        options=cascade_options(catalog, "Region", {"Brand": brand_filter}),
     )
 
-    df_brand_region = df_brand[df_brand["Region"].isin(region_filter)] if (region_filter and "Region" in df_brand.columns) else df_brand.iloc[0:0]
     store_filter = ms_all(
         key=GEN_PREFIX + "store",
         label="Cửa hàng",
-        options=df_brand_region["Điểm_mua_hàng"] if "Điểm_mua_hàng" in df_brand_region.columns else [],
+        options=cascade_options(catalog, "Điểm_mua_hàng", {"Brand": brand_filter, "Region": region_filter}),
+    )
+
+    approx = st.checkbox(
+        "⚡ Đếm đơn/khách xấp xỉ (nhanh hơn)",
+        value=False,
+        key=GEN_PREFIX + "approx",
+        help=f"Đếm distinct bằng HyperLogLog trên cube ngày, sai số chuẩn ~{HLL_ERROR:.1%}, 99.7% trường hợp trong ±{3 * HLL_ERROR:.1%}",
     )
 
 # =====================================================
 # APPLY FILTER
 # =====================================================
-mask = (df["Ngày"] >= pd.to_datetime(start_date)) & (df["Ngày"] <= pd.to_datetime(end_date))
-
-if "LoaiCT" in df.columns:
-    mask &= df["LoaiCT"].isin(loaiCT_filter if loaiCT_filter else [])
-if "Brand" in df.columns:
-    mask &= df["Brand"].isin(brand_filter if brand_filter else [])
-if "Region" in df.columns:
-    mask &= df["Region"].isin(region_filter if region_filter else [])
-if "Điểm_mua_hàng" in df.columns:
-    mask &= df["Điểm_mua_hàng"].isin(store_filter if store_filter else [])
-
-df_f = df.loc[mask].copy()
+gen_filters = {
+    "LoaiCT": loaiCT_filter if loaiCT_filter else [],
+    "Brand": brand_filter if brand_filter else [],
+    "Region": region_filter if region_filter else [],
+    "Điểm_mua_hàng": store_filter if store_filter else [],
+}
 
-if df_f.empty:
+# kiểm tra rỗng trên cube ngày (cùng bộ lọc, nhỏ hơn bảng dòng hàng nhiều lần) => không materialize bảng fact
+if cube_view(start_date=start_date, end_date=end_date, filters=gen_filters).empty:
     st.warning("⚠ Không có dữ liệu sau khi áp bộ lọc.")
     st.stop()
 
+# Gross/Net lấy từ cube ngày (cùng bộ lọc); đếm đơn / khách trên header chứng từ (1 dòng / Số_CT)
+# các bảng dưới memo theo (version dataset, bộ lọc, grain) => quay lại bộ lọc cũ trả kết quả ngay
+def gen_views(start_date, end_date, filters):
+    df_cube = cube_view(start_date=start_date, end_date=end_date, filters=filters)
+    df_orders = orders_view(start_date=start_date, end_date=end_date, filters=filters)
+    return df_cube, df_orders
+
+SUM_AGG = {"Gross": "Tổng_Gross", "Net": "Tổng_Net"}
+DISTINCT_AGG = {"Orders": "CT_key", "Customers": "KH_key"}
+
 # =====================================================
 # TIME COLUMN
 # =====================================================
-df_f_time = df_f.copy()
-
-if time_type == "Ngày":
-    df_f_time["Time"] = df_f_time["Ngày"].dt.date.astype(str)
+TIME_LABEL_COL = {"Ngày": "Day_label", "Tháng": "Month_label", "Quý": "Quarter_period", "Năm": "Year_label"}
 
-elif time_type == "Tuần":
-    df_f_time["_WeekAnchor"] = week_anchor(df_f_time["Ngày"], GEN_WEEK_START)
-    df_f_time["Time"] = week_label_from_anchor(df_f_time["_WeekAnchor"])
+def add_time_col(df_in: pd.DataFrame, tt: str, week_start: int) -> pd.DataFrame:
+    df_out = df_in.copy(deep=False)  # copy-on-write: chỉ thêm cột, không copy dữ liệu
 
-elif time_type == "Tháng":
-    df_f_time["Time"] = df_f_time["Ngày"].dt.to_period("M").astype(str)
-
-elif time_type == "Quý":
-    df_f_time["Time"] = df_f_time["Ngày"].dt.to_period("Q").astype(str)
+    if tt == "Tuần":
+        keys = calendar_keys(df_out["Ngày"], [f"Week_anchor_{week_start}", f"Week_label_{week_start}"])
+        df_out["_WeekAnchor"] = keys[f"Week_anchor_{week_start}"]
+        df_out["Time"] = keys[f"Week_label_{week_start}"]
+    else:
+        df_out["Time"] = calendar_keys(df_out["Ngày"], TIME_LABEL_COL[tt])
 
-elif time_type == "Năm":
-    df_f_time["Time"] = df_f_time["Ngày"].dt.year.astype(str)
+    return df_out
 
 # =====================================================
 # KPI
 # =====================================================
-gross = float(df_f["Tổng_Gross"].sum()) if "Tổng_Gross" in df_f.columns else 0
-net = float(df_f["Tổng_Net"].sum()) if "Tổng_Net" in df_f.columns else 0
-orders = df_f["Số_CT"].nunique() if "Số_CT" in df_f.columns else 0
-customers = df_f["Số_điện_thoại"].nunique() if "Số_điện_thoại" in df_f.columns else 0
-ck_rate = (1 - net / gross) * 100 if gross > 0 else 0
-
-c1, c2, c3, c4, c5 = st.columns(5)
-c1.metric("Gross", value=f"{gross:,.0f}")
-c2.metric("Net", value=f"{net:,.0f}")
-c3.metric("CK %", value=f"{ck_rate:.2f}%")
-c4.metric("Đơn hàng", value=f"{orders:,}")
-c5.metric("Khách hàng", value=f"{customers:,}")
+@memoize
+def kpi(start_date, end_date, filters, approx: bool) -> dict:
+    df_cube, df_orders = gen_views(start_date, end_date, filters)
+
+    gross = float(df_cube["Tổng_Gross"].sum()) if "Tổng_Gross" in df_cube.columns else 0
+    net = float(df_cube["Tổng_Net"].sum()) if "Tổng_Net" in df_cube.columns else 0
+    if approx:
+        orders = cube_distinct(df_cube, "CT_key")
+        customers = cube_distinct(df_cube, "KH_key")
+    else:
+        orders = df_orders["CT_key"].nunique() if "CT_key" in df_orders.columns else 0
+        customers = df_orders["KH_key"].nunique() if "KH_key" in df_orders.columns else 0
+    return {"gross": gross, "net": net, "orders": orders, "customers": customers}
+
+kpi_box = st.container()
+
+def show_kpi(k: dict):
+    gross, net, orders, customers = k["gross"], k["net"], k["orders"], k["customers"]
+    ck_rate = (1 - net / gross) * 100 if gross > 0 else 0
+
+    c1, c2, c3, c4, c5 = st.columns(5)
+    c1.metric("Gross", value=f"{gross:,.0f}")
+    c2.metric("Net", value=f"{net:,.0f}")
+    c3.metric("CK %", value=f"{ck_rate:.2f}%")
+    c4.metric("Đơn hàng", value=f"{orders:,}")
+    c5.metric("Khách hàng", value=f"{customers:,}")
+    if approx:
+        st.caption(f"⚡ Đơn hàng / Khách hàng là số ước lượng (HyperLogLog, sai số chuẩn ~{HLL_ERROR:.1%}, 99.7% trường hợp trong ±{3 * HLL_ERROR:.1%}).")
 
 # =====================================================
 # TIME GROUP (TUẦN: group theo anchor)
 # =====================================================
-def group_time(df_in: pd.DataFrame, tt: str, week_start: int) -> pd.DataFrame:
+@memoize
+def group_time(start_date, end_date, filters, tt: str, week_start: int, approx: bool) -> pd.DataFrame:
+    df_sum, df_in = gen_views(start_date, end_date, filters)
+
     if tt == "Tuần":
-        tmp = df_in.copy()
-        tmp["_WeekAnchor"] = week_anchor(tmp["Ngày"], week_start)
+        tmp = df_in.assign(_WeekAnchor=calendar_keys(df_in["Ngày"], f"Week_anchor_{week_start}"))
+        tmp_sum = df_sum.assign(_WeekAnchor=calendar_keys(df_sum["Ngày"], f"Week_anchor_{week_start}"))
 
         d = (
-            tmp.groupby("_WeekAnchor", dropna=False)
-            .agg(
-                Gross=("Tổng_Gross", "sum"),
-                Net=("Tổng_Net", "sum"),
-                Orders=("Số_CT", "nunique"),
-                Customers=("Số_điện_thoại", "nunique"),
-            )
-            .reset_index()
+            cube_agg(tmp, tmp_sum, "_WeekAnchor", SUM_AGG, DISTINCT_AGG, dropna=False, approx=approx)
             .rename(columns={"_WeekAnchor": "Ngày"})
             .sort_values("Ngày")
         )
     else:
-        freq_map = {"Ngày": "D", "Tháng": "ME", "Quý": "Q", "Năm": "Y"}
+        # Grouper theo tần suất = resample (giữ cả kỳ trống)
+        freq_map = {"Ngày": "D", "Tháng": "ME", "Quý": "QE", "Năm": "YE"}
         d = (
-            df_in.set_index("Ngày")
-            .resample(freq_map[tt])
-            .agg(
-                Gross=("Tổng_Gross", "sum"),
-                Net=("Tổng_Net", "sum"),
-                Orders=("Số_CT", "nunique"),
-                Customers=("Số_điện_thoại", "nunique"),
-            )
-            .reset_index()
+            cube_agg(df_in, df_sum, pd.Grouper(key="Ngày", freq=freq_map[tt]), SUM_AGG, DISTINCT_AGG, approx=approx)
             .sort_values("Ngày")
         )
 
@@ -311,121 +354,167 @@ def group_time(df_in: pd.DataFrame, tt: str, week_start: int) -> pd.DataFrame:
     d["Growth_%"] = np.where(d["Net_prev"] > 0, (d["Net"] - d["Net_prev"]) / d["Net_prev"] * 100, 0)
     return d
 
-df_time = group_time(df_f, time_type, GEN_WEEK_START)
+time_box = st.container()
+time_box.subheader(f"⏱ Theo thời gian ({time_type})")
 
-st.subheader(f"⏱ Theo thời gian ({time_type})")
-df_time_show = df_time.copy()
+def show_time(df_time: pd.DataFrame):
+    df_time_show = df_time.copy(deep=False)
 
-if time_type == "Tuần":
-    df_time_show["Ngày"] = week_label_from_anchor(df_time_show["Ngày"])
-else:
-    df_time_show["Ngày"] = pd.to_datetime(df_time_show["Ngày"], errors="coerce").dt.strftime("%Y-%m-%d")
+    if time_type == "Tuần":
+        df_time_show["Ngày"] = calendar_keys(df_time_show["Ngày"], f"Week_label_{GEN_WEEK_START}")
+    else:
+        df_time_show["Ngày"] = pd.to_datetime(df_time_show["Ngày"], errors="coerce").dt.strftime("%Y-%m-%d")
 
-for c in ["Gross", "Net", "Orders", "Customers", "Net_prev"]:
-    if c in df_time_show.columns:
-        df_time_show[c] = df_time_show[c].apply(fmt_int)
+    for c in ["Gross", "Net", "Orders", "Customers", "Net_prev"]:
+        if c in df_time_show.columns:
+            df_time_show[c] = df_time_show[c].apply(fmt_int)
 
-for c in ["CK_%", "Growth_%"]:
-    if c in df_time_show.columns:
-        df_time_show[c] = df_time_show[c].apply(lambda v: fmt_pct(v, 2, with_sign=(c == "Growth_%")))
+    for c in ["CK_%", "Growth_%"]:
+        if c in df_time_show.columns:
+            df_time_show[c] = df_time_show[c].apply(lambda v: fmt_pct(v, 2, with_sign=(c == "Growth_%")))
 
-st.dataframe(df_time_show, use_container_width=True, hide_index=True)
+    st.dataframe(df_time_show, use_container_width=True, hide_index=True)
 
 # =====================================================
 # REGION + TIME
 # =====================================================
-def group_region_time(df_in: pd.DataFrame) -> pd.DataFrame:
-    d = (
-        df_in.groupby(["Time", "Region"], dropna=False)
-        .agg(
-            Gross=("Tổng_Gross", "sum"),
-            Net=("Tổng_Net", "sum"),
-            Orders=("Số_CT", "nunique"),
-            Customers=("Số_điện_thoại", "nunique"),
-        )
-        .reset_index()
-    )
+@memoize
+def group_region_time(start_date, end_date, filters, tt: str, week_start: int, approx: bool) -> pd.DataFrame:
+    df_cube, df_orders = gen_views(start_date, end_date, filters)
+    df_in = add_time_col(df_orders, tt, week_start)
+    df_sum = add_time_col(df_cube, tt, week_start)
+
+    d = cube_agg(df_in, df_sum, ["Time", "Region"], SUM_AGG, DISTINCT_AGG, dropna=False, approx=approx)
     d["CK_%"] = np.where(d["Gross"] > 0, (d["Gross"] - d["Net"]) / d["Gross"] * 100, 0)
     return d.sort_values(["Time", "Net"], ascending=[True, False])
 
-df_region_time = group_region_time(df_f_time)
+region_time_box = st.container()
+region_time_box.subheader(f"🌍 Theo Region + {time_type}")
 
-st.subheader(f"🌍 Theo Region + {time_type}")
-df_region_time_show = df_region_time.copy()
+def show_region_time(df_region_time: pd.DataFrame):
+    df_region_time_show = df_region_time.copy(deep=False)
 
-for c in ["Gross", "Net", "Orders", "Customers"]:
-    if c in df_region_time_show.columns:
-        df_region_time_show[c] = df_region_time_show[c].apply(fmt_int)
-if "CK_%" in df_region_time_show.columns:
-    df_region_time_show["CK_%"] = df_region_time_show["CK_%"].apply(lambda v: fmt_pct(v, 2))
+    for c in ["Gross", "Net", "Orders", "Customers"]:
+        if c in df_region_time_show.columns:
+            df_region_time_show[c] = df_region_time_show[c].apply(fmt_int)
+    if "CK_%" in df_region_time_show.columns:
+        df_region_time_show["CK_%"] = df_region_time_show["CK_%"].apply(lambda v: fmt_pct(v, 2))
 
-st.dataframe(df_region_time_show, use_container_width=True, hide_index=True)
+    st.dataframe(df_region_time_show, use_container_width=True, hide_index=True)
 
 # =====================================================
 # STORE SUMMARY
 # =====================================================
-st.subheader("🏪 Tổng quan theo Cửa hàng")
-
-df_store = (
-    df_f.groupby("Điểm_mua_hàng", dropna=False)
-    .agg(
-        Gross=("Tổng_Gross", "sum"),
-        Net=("Tổng_Net", "sum"),
-        Orders=("Số_CT", "nunique"),
-        Customers=("Số_điện_thoại", "nunique"),
-    )
-    .reset_index()
-)
+store_box = st.container()
+store_box.subheader("🏪 Tổng quan theo Cửa hàng")
+
+@memoize
+def group_store(start_date, end_date, filters, approx: bool) -> pd.DataFrame:
+    df_cube, df_orders = gen_views(start_date, end_date, filters)
 
-df_store["CK_%"] = np.where(df_store["Gross"] > 0, (df_store["Gross"] - df_store["Net"]) / df_store["Gross"] * 100, 0)
+    d = cube_agg(df_orders, df_cube, "Điểm_mua_hàng", SUM_AGG, DISTINCT_AGG, dropna=False, approx=approx)
+    d["CK_%"] = np.where(d["Gross"] > 0, (d["Gross"] - d["Net"]) / d["Gross"] * 100, 0)
+    return d
 
-df_store_show = df_store.sort_values("Net", ascending=False).copy()
-for c in ["Gross", "Net", "Orders", "Customers"]:
-    df_store_show[c] = df_store_show[c].apply(fmt_int)
-df_store_show["CK_%"] = df_store_show["CK_%"].apply(lambda v: fmt_pct(v, 2))
+def show_store(df_store: pd.DataFrame):
+    df_store_show = df_store.sort_values("Net", ascending=False)
+    for c in ["Gross", "Net", "Orders", "Customers"]:
+        df_store_show[c] = df_store_show[c].apply(fmt_int)
+    df_store_show["CK_%"] = df_store_show["CK_%"].apply(lambda v: fmt_pct(v, 2))
 
-st.dataframe(df_store_show, use_container_width=True, hide_index=True)
+    st.dataframe(df_store_show, use_container_width=True, hide_index=True)
 
 # =====================================================
-# PRODUCT SUMMARY (THEO MÃ_NB)
+# PRODUCT SUMMARY (THEO MÃ_NB) – FRAGMENT: đổi Nhóm SP / Mã NB chỉ chạy lại section này
 # =====================================================
-st.subheader("📦 Theo Nhóm SP / Mã NB")
+product_box = st.container()
 
-df_product = df_f.copy()
-
-col1, col2 = st.columns(2)
-with col1:
+@memoize
+def product_options(start_date, end_date, filters) -> tuple:
+    df_product = load_view(columns=["Nhóm_hàng", "Mã_NB"], start_date=start_date, end_date=end_date, filters=filters)
     nhom_vals = sorted(df_product["Nhóm_hàng"].dropna().unique()) if "Nhóm_hàng" in df_product.columns else []
-    nhom_sp_selected = st.multiselect("📦 Chọn Nhóm SP", nhom_vals, key=GEN_PREFIX + "nhom_sp")
-with col2:
     ma_vals = sorted(df_product["Mã_NB"].dropna().unique()) if "Mã_NB" in df_product.columns else []
-    ma_nb_selected = st.multiselect("🏷️ Chọn Mã NB", ma_vals, key=GEN_PREFIX + "ma_nb")
-
-if nhom_sp_selected and "Nhóm_hàng" in df_product.columns:
-    df_product = df_product[df_product["Nhóm_hàng"].isin(nhom_sp_selected)]
-if ma_nb_selected and "Mã_NB" in df_product.columns:
-    df_product = df_product[df_product["Mã_NB"].isin(ma_nb_selected)]
-
-if "Số_lượng" in df_product.columns:
-    orders_agg = ("Số_lượng", "sum")
-else:
-    orders_agg = ("Số_CT", "nunique")
-
-df_product_group = (
-    df_product.groupby("Mã_NB", dropna=False)
-    .agg(
-        Gross=("Tổng_Gross", "sum"),
-        Net=("Tổng_Net", "sum"),
-        Orders=orders_agg,
-        Customers=("Số_điện_thoại", "nunique"),
+    return nhom_vals, ma_vals
+
+@memoize
+def group_product(start_date, end_date, filters, nhom_sp_selected, ma_nb_selected) -> pd.DataFrame:
+    df_product = load_view(columns=PRODUCT_COLUMNS, start_date=start_date, end_date=end_date, filters=filters)
+
+    # gộp 2 điều kiện thành 1 mask => chọn dòng 1 lần
+    mask = np.ones(len(df_product), dtype=bool)
+    if nhom_sp_selected and "Nhóm_hàng" in df_product.columns:
+        mask &= isin_codes(df_product["Nhóm_hàng"], nhom_sp_selected)
+    if ma_nb_selected and "Mã_NB" in df_product.columns:
+        mask &= df_product["Mã_NB"].isin(ma_nb_selected).to_numpy()
+    if not mask.all():
+        df_product = df_product[mask]
+
+    if "Số_lượng" in df_product.columns:
+        orders_agg = ("Số_lượng", "sum")
+    else:
+        orders_agg = ("CT_key", "nunique")
+
+    return (
+        df_product.groupby("Mã_NB", dropna=False)
+        .agg(
+            Gross=("Tổng_Gross", "sum"),
+            Net=("Tổng_Net", "sum"),
+            Orders=orders_agg,
+            Customers=("KH_key", "nunique"),
+        )
+        .reset_index()
+        .sort_values("Net", ascending=False)
     )
-    .reset_index()
-    .sort_values("Net", ascending=False)
-)
 
-df_product_show = df_product_group.copy()
-for c in ["Gross", "Net", "Orders", "Customers"]:
-    if c in df_product_show.columns:
-        df_product_show[c] = df_product_show[c].apply(fmt_int)
+def show_product(df_product_group: pd.DataFrame):
+    df_product_show = df_product_group.copy(deep=False)
+    for c in ["Gross", "Net", "Orders", "Customers"]:
+        if c in df_product_show.columns:
+            df_product_show[c] = df_product_show[c].apply(fmt_int)
+
+    st.dataframe(df_product_show, use_container_width=True, hide_index=True)
+
+@st.fragment
+def product_section(start_date, end_date, filters):
+    st.subheader("📦 Theo Nhóm SP / Mã NB")
+    nhom_vals, ma_vals = product_options(start_date, end_date, filters)
+
+    col1, col2 = st.columns(2)
+    with col1:
+        nhom_sp_selected = st.multiselect("📦 Chọn Nhóm SP", nhom_vals, key=GEN_PREFIX + "nhom_sp")
+    with col2:
+        ma_nb_selected = st.multiselect("🏷️ Chọn Mã NB", ma_vals, key=GEN_PREFIX + "ma_nb")
 
-st.dataframe(df_product_show, use_container_width=True, hide_index=True)
+    show_product(group_product(start_date, end_date, filters, nhom_sp_selected, ma_nb_selected))
+
+# =====================================================
+# RUN SECTIONS (các bảng trên độc lập => tính song song, bảng nào xong vẽ trước vào chỗ của nó)
+# =====================================================
+render_sections(
+    {
+        "kpi": (kpi, start_date, end_date, gen_filters, approx),
+        "time": (group_time, start_date, end_date, gen_filters, time_type, GEN_WEEK_START, approx),
+        "region_time": (group_region_time, start_date, end_date, gen_filters, time_type, GEN_WEEK_START, approx),
+        "store": (group_store, start_date, end_date, gen_filters, approx),
+    },
+    {
+        "kpi": (kpi_box, show_kpi, ["kpi"]),
+        "time": (time_box, show_time, ["time"]),
+        "region_time": (region_time_box, show_region_time, ["region_time"]),
+        "store": (store_box, show_store, ["store"]),
+    },
+)
+with product_box:
+    product_section(start_date, end_date, gen_filters)
+
+# =====================================================
+# CACHE STATS (memo kết quả dùng chung mọi phiên)
+# =====================================================
+ms = memo_stats()
+st.sidebar.caption(
+    f"🧠 Cache kết quả: {ms['entries']} bảng · {ms['bytes'] / 2**20:,.1f}/{ms['max_bytes'] / 2**20:,.0f} MB · "
+    f"hit {ms['hit_rate']:.0%} ({ms['hits']:,} hit / {ms['misses']:,} miss / {ms['evictions']:,} evict / {ms['coalesced']:,} gộp)"
+)
+mem = rerun_memory_peak()
+if mem:
+    st.sidebar.caption(f"📈 Đỉnh bộ nhớ lần chạy này: {mem['peak'] / 2**20:,.1f} MB (dataset {mem['dataset'] / 2**20:,.1f} MB)")
@@ -0,0 +1,82 @@
+# hll.py
+import numpy as np
+import pandas as pd
+
+# HyperLogLog dạng "sparse/long": mỗi sketch là các dòng (cell, reg, rho)
+# - cell: id ô của cube (ngày × cửa hàng × ...)
+# - reg : chỉ số register (p bit đầu của hash)
+# - rho : vị trí bit 1 đầu tiên của phần hash còn lại (max theo cell/reg)
+# Hợp (union) nhiều cell = max rho theo (nhóm, reg) => gộp được cho mọi kỳ / bộ lọc.
+HLL_P = 12
+HLL_M = 1 << HLL_P
+HLL_ERROR = 1.04 / np.sqrt(HLL_M)  # sai số chuẩn tương đối (~1.6% với p=12)
+
+_ALPHA = 0.7213 / (1 + 1.079 / HLL_M)
+_MASK64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def _hash64(keys: np.ndarray) -> np.ndarray:
+    # splitmix64: key int64 -> hash uint64 phân bố đều
+    with np.errstate(over="ignore"):
+        z = keys.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return (z ^ (z >> np.uint64(31))) & _MASK64
+
+
+def build_entries(cells: np.ndarray, keys: pd.Series) -> pd.DataFrame:
+    """Sketch HLL cho từng cell từ cột key int (bỏ qua <NA>)."""
+    keys = pd.Series(keys)
+    ok = keys.notna().to_numpy()
+    cells = np.asarray(cells)[ok]
+    h = _hash64(keys[ok].to_numpy(dtype="int64"))
+
+    tail_bits = 64 - HLL_P
+    reg = (h >> np.uint64(tail_bits)).astype(np.int64)
+    w = h & np.uint64((1 << tail_bits) - 1)
+
+    # rho = số bit 0 đầu (trong tail_bits bit) + 1; w == 0 => tail_bits + 1
+    nz = w > 0
+    e = np.zeros(len(w), dtype=np.int64)
+    e[nz] = np.floor(np.log2(w[nz].astype(np.float64))).astype(np.int64)
+    # log2 qua float có thể làm tròn lên ở sát lũy thừa 2
+    over = nz & ((w >> e.astype(np.uint64)) == 0)
+    e[over] -= 1
+    rho = np.where(nz, tail_bits - e, tail_bits + 1).astype(np.int8)
+
+    entries = (
+        pd.DataFrame({"cell": cells.astype(np.int64) * HLL_M + reg, "rho": rho})
+        .groupby("cell", sort=False)["rho"]
+        .max()
+    )
+    idx = entries.index.to_numpy()
+    return pd.DataFrame({
+        "cell": (idx // HLL_M).astype(np.int32),
+        "reg": (idx % HLL_M).astype(np.int16),
+        "rho": entries.to_numpy(dtype=np.int8),
+    })
+
+
+def estimate_groups(entries: pd.DataFrame, cell_group: np.ndarray, n_groups: int) -> np.ndarray:
+    """
+    Ước lượng distinct cho từng nhóm:
+    - cell_group[cell] = số thứ tự nhóm của cell, -1 nếu cell không được chọn
+    - hợp sketch = max rho theo (nhóm, reg), rồi công thức HLL + hiệu chỉnh vùng nhỏ
+    """
+    if n_groups == 0:
+        return np.zeros(0)
+
+    grp = cell_group[entries["cell"].to_numpy()]
+    sel = grp >= 0
+    key = grp[sel].astype(np.int64) * HLL_M + entries["reg"].to_numpy()[sel]
+    merged = pd.Series(entries["rho"].to_numpy()[sel]).groupby(key, sort=False).max()
+
+    g = (merged.index.to_numpy() // HLL_M).astype(np.int64)
+    k = np.bincount(g, minlength=n_groups)
+    z = np.bincount(g, weights=np.exp2(-merged.to_numpy(dtype=np.float64)), minlength=n_groups)
+
+    zeros = HLL_M - k
+    est = _ALPHA * HLL_M * HLL_M / (zeros + z)
+    small = (est <= 2.5 * HLL_M) & (zeros > 0)
+    est[small] = HLL_M * np.log(HLL_M / zeros[small])
+    return np.round(est)
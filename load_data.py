@@ -1,79 +1,1809 @@
 # load_data.py
 import os
+import sys
+import time
+import glob
+import atexit
+import datetime
+import hashlib
+import json
+import pickle
+import subprocess
+import threading
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import wraps
+try:
+    import fcntl  # khóa file giữa các process (POSIX)
+except ImportError:
+    fcntl = None
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+import hll
+from hll import HLL_ERROR  # re-export cho page (caption sai số)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-PARQUET_FILE = os.path.join(BASE_DIR, "data", "data.parquet")
+DATA_DIR = os.path.join(BASE_DIR, "data")
+PARQUET_FILE = os.path.join(DATA_DIR, "data.parquet")
+# Dữ liệu tuần mới nạp thêm (ingest_delta): mỗi lần nạp 1 file, tên theo thời điểm => sort = thứ tự nạp
+DELTA_DIR = os.path.join(DATA_DIR, "delta")
+# Snapshot Arrow IPC (đã _normalize) cạnh file nguồn => khởi động lại chỉ memory-map, không decode parquet
+# SHARED_DATA_DIR=/dev/shm/<app>: snapshot nằm trên tmpfs => mọi replica trên cùng host map chung 1 bản trong RAM
+SNAPSHOT_DIR = os.environ.get("SHARED_DATA_DIR", DATA_DIR)
+SNAPSHOT_FILE = os.path.join(SNAPSHOT_DIR, "data.snapshot.arrow")
+SNAPSHOT_SCHEMA_VERSION = 2  # tăng khi đổi _normalize / encode => snapshot cũ tự build lại
+
+# Dataset partition kiểu hive: data/year=YYYY/month=MM/brand=X/*.parquet
+# tên partition -> tên cột dimension tương ứng (file trong partition không có cột đó => lấy từ tên thư mục)
+PARTITION_DIMS = {"brand": "Brand"}
+
+# Các chiều ít giá trị (low-cardinality) => lưu dạng category (mã int + từ điển)
+DIM_COLS = [
+    "Brand",
+    "Region",
+    "Điểm_mua_hàng",
+    "LoaiCT",
+    "Nhóm_hàng",
+    "Trạng_thái_số_điện_thoại",
+    "Kiểm_tra_tên",
+]
+
+
+def encode_dimensions(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Dictionary-encode các cột DIM_COLS:
+    - build đầy đủ: categories được sort => mã (codes) ổn định cho cùng 1 dataset
+    - nạp thêm delta (append_normalized): giá trị mới nối CUỐI từ điển, không sort lại => mã cũ giữ nguyên,
+      nhưng thứ tự categories (và thứ tự nhóm của groupby trên cột category) không còn theo bảng chữ cái;
+      option hiển thị luôn sort riêng (_options)
+    - isin / groupby chạy trên mã int thay vì chuỗi Python
+    """
+    for c in DIM_COLS:
+        if c in df.columns and not isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype("category")
+    return df
+
+
+# Cột nhiều giá trị (SĐT, số CT) => khóa int64; chuỗi gốc giữ trong từ điển category
+KEY_COLS = {
+    "Số_điện_thoại": "KH_key",
+    "Số_CT": "CT_key",
+}
+
+
+def build_keys(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Surrogate key cho SĐT / số CT (1 lần / dataset):
+    - factorize(sort=True) => key tăng theo thứ tự chuỗi gốc (build đầy đủ; chuỗi mới từ delta nhận key nối cuối)
+    - cột gốc thành category (categories = bảng tra ngược key -> chuỗi)
+    - thiếu giá trị => Int64 <NA> để nunique / groupby bỏ qua như cũ
+    """
+    for src, key in KEY_COLS.items():
+        if src not in df.columns or key in df.columns:
+            continue
+
+        codes, uniques = pd.factorize(df[src], sort=True)
+        df[src] = pd.Categorical.from_codes(codes, categories=uniques)
+
+        keys = pd.Series(codes.astype("int64"), index=df.index)
+        if (codes < 0).any():
+            keys = keys.astype("Int64").mask(codes < 0)
+        df[key] = keys
+    return df
+
+
+def key_to_value(df: pd.DataFrame, col: str, keys) -> np.ndarray:
+    """Tra ngược key -> giá trị gốc (vd. KH_key -> Số_điện_thoại) cho bảng xuất CRM."""
+    cats = df[col].cat.categories
+    keys = pd.array(keys, dtype="Int64")
+    out = np.full(len(keys), None, dtype=object)
+    ok = ~keys.isna()
+    out[ok] = cats.take(keys[ok].to_numpy(dtype="int64")).to_numpy(dtype=object)
+    return out
+
+
+def isin_codes(s: pd.Series, values) -> np.ndarray:
+    """
+    Tương đương s.isin(values) nhưng với cột category thì so trên mã:
+    values -> codes qua từ điển categories, rồi tra bảng bool theo codes.
+    """
+    if not isinstance(s.dtype, pd.CategoricalDtype):
+        return s.isin(list(values)).to_numpy()
+
+    cats = s.cat.categories
+    idx = cats.get_indexer(pd.Index(list(values), dtype=object)) if len(values) else np.array([], dtype=int)
+    lut = np.zeros(len(cats) + 1, dtype=bool)  # phần tử cuối cho code -1 (NaN)
+    lut[idx[idx >= 0]] = True
+    return lut[s.cat.codes.to_numpy()]
+
+
+# =====================================================
+# BITMAP INDEX (giá trị chiều -> bitmap / danh sách vị trí dòng)
+# =====================================================
+INDEX_DIMS = ["LoaiCT", "Brand", "Region", "Điểm_mua_hàng", "Trạng_thái_số_điện_thoại", "Kiểm_tra_tên"]
+
+
+def build_bitmap_index(df: pd.DataFrame) -> dict:
+    """
+    Inverted index cho các cột INDEX_DIMS (dạng category), 1 entry / cột, build 1 lần / dataset:
+    - ít giá trị (<= 8 × byte / mã, vd. <= 8 với int8): ("bits", categories, bitmap uint8 [số giá trị × số byte],
+      bitmap dòng có giá trị | None) — bitmap dày np.packbits, 1 bit / dòng / giá trị, không lớn hơn mã category
+    - nhiều giá trị (vd. Điểm_mua_hàng): ("rows", categories, vị trí dòng int32, offsets) — mỗi giá trị k là
+      đoạn rows[offsets[k]:offsets[k + 1]] đã sort (dòng NaN là đoạn cuối); 4 byte / dòng bất kể số giá trị,
+      chọn vài cửa hàng chỉ chạm vào đoạn của các cửa hàng đó
+    """
+    index = {}
+    for c in INDEX_DIMS:
+        if c not in df.columns or not isinstance(df[c].dtype, pd.CategoricalDtype):
+            continue
+        codes = df[c].cat.codes.to_numpy()
+        cats = df[c].cat.categories
+        if len(cats) > 8 * codes.itemsize:
+            index[c] = ("rows", cats) + _row_lists(codes, len(cats))
+            continue
+        bits = np.stack([np.packbits(codes == k) for k in range(len(cats))]) if len(cats) else np.zeros((0, (len(codes) + 7) // 8), dtype=np.uint8)
+        valid = np.packbits(codes >= 0) if (codes < 0).any() else None
+        index[c] = ("bits", cats, bits, valid)
+    return index
+
+
+def _row_lists(codes: np.ndarray, n_cats: int) -> tuple[np.ndarray, np.ndarray]:
+    # sort ổn định theo mã (NaN = n_cats => cuối) => vị trí dòng trong từng đoạn tăng dần
+    keys = np.where(codes < 0, n_cats, codes)
+    rows = np.argsort(keys, kind="stable").astype(np.int32)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(keys, minlength=n_cats + 1))])
+    return rows, offsets
+
+
+def _selected(cats: pd.Index, values) -> np.ndarray:
+    idx = cats.get_indexer(pd.Index(list(values), dtype=object)) if len(values) else np.array([], dtype=int)
+    sel = np.zeros(len(cats), dtype=bool)
+    sel[idx[idx >= 0]] = True
+    return sel
 
 
-@st.cache_resource
-def _load_parquet_cached(path: str) -> pd.DataFrame:
-    # cache_resource: giữ 1 bản trong RAM của server cho toàn app
-    df = pd.read_parquet(path)
+def _bitmap_select(entry, values, b0: int, b1: int) -> np.ndarray | None:
+    # bitmap (đoạn byte b0:b1) của các dòng có giá trị thuộc values; None = mọi dòng
+    _, cats, bits, valid = entry
+    sel = _selected(cats, values)
 
-    # normalize
+    if sel.all():
+        return None if valid is None else valid[b0:b1]
+    if sel.sum() <= len(cats) // 2:
+        return np.bitwise_or.reduce(bits[sel, b0:b1], axis=0) if sel.any() else np.zeros(b1 - b0, dtype=np.uint8)
+
+    # chọn gần hết => phần bù của các giá trị KHÔNG chọn (ít bitmap phải OR hơn)
+    out = ~np.bitwise_or.reduce(bits[~sel, b0:b1], axis=0)
+    return out if valid is None else out & valid[b0:b1]
+
+
+def _rows_select(entry, values, rows: slice) -> np.ndarray | None:
+    # mask bool trên khoảng dòng rows của các dòng có giá trị thuộc values; None = mọi dòng
+    _, cats, positions, offsets = entry
+    sel = np.append(_selected(cats, values), False)  # đoạn cuối = dòng NaN, không bao giờ được chọn
+    if sel[:-1].all() and offsets[-1] == offsets[-2]:
+        return None
+
+    # chọn gần hết => bật tất cả rồi tắt các đoạn KHÔNG chọn (ít đoạn phải đụng hơn)
+    fill = sel.sum() > len(sel) // 2
+    mask = np.full(rows.stop - rows.start, fill)
+    for k in np.flatnonzero(sel != fill):
+        seg = positions[offsets[k]:offsets[k + 1]]
+        lo, hi = np.searchsorted(seg, [rows.start, rows.stop])
+        mask[seg[lo:hi] - rows.start] = not fill
+    return mask
+
+
+def index_mask(index: dict, filters: dict, rows: slice) -> tuple[np.ndarray | None, list]:
+    """
+    Giao index các bộ lọc có index trên khoảng dòng rows (vd. date_slice).
+    Trả (mask bool cho rows hoặc None nếu không lọc gì, các cột chưa có index).
+    """
+    b0, b1 = rows.start // 8, -(-rows.stop // 8)
+    acc, mask, rest = None, None, []
+    for col, values in filters.items():
+        if values is None:
+            continue
+        if col not in index:
+            rest.append(col)
+            continue
+        if index[col][0] == "rows":
+            m = _rows_select(index[col], values, rows)
+            if m is not None:
+                mask = m if mask is None else mask & m
+            continue
+        bm = _bitmap_select(index[col], values, b0, b1)
+        if bm is not None:
+            acc = bm if acc is None else acc & bm
+
+    if acc is not None:
+        off = rows.start - b0 * 8
+        dense = np.unpackbits(acc, count=off + rows.stop - rows.start)[off:].astype(bool)
+        mask = dense if mask is None else mask & dense
+    return mask, rest
+
+
+def date_slice(df: pd.DataFrame, start_date=None, end_date=None) -> slice:
+    """
+    Khoảng dòng [start_date, end_date] (đóng 2 đầu) của bảng đã sort theo Ngày.
+    Binary search trên cột Ngày => O(log n), df.iloc[slice] không copy dữ liệu.
+    """
+    lo = df["Ngày"].searchsorted(pd.to_datetime(start_date), side="left") if start_date is not None else 0
+    hi = df["Ngày"].searchsorted(pd.to_datetime(end_date), side="right") if end_date is not None else len(df)
+    return slice(int(lo), int(max(lo, hi)))
+
+
+def _coerce(df: pd.DataFrame) -> pd.DataFrame:
+    # ép kiểu Ngày / số tiền, bỏ dòng không có Ngày, sort theo Ngày (chưa encode category / khóa)
     if "Ngày" in df.columns:
         df["Ngày"] = pd.to_datetime(df["Ngày"], errors="coerce")
-        df = df.dropna(subset=["Ngày"])
+        # dropna / sort đều copy cả bảng => chỉ chạy khi thật sự có NaT / chưa sort
+        if df["Ngày"].isna().any():
+            df = df.dropna(subset=["Ngày"])
+        # mọi bảng ra khỏi load_data đều sort theo Ngày => lọc ngày = date_slice
+        if not df["Ngày"].is_monotonic_increasing:
+            df = df.sort_values("Ngày", kind="stable", ignore_index=True)
 
     for c in ["Tổng_Gross", "Tổng_Net"]:
         if c in df.columns:
             df[c] = pd.to_numeric(df[c], errors="coerce")
+    return df
+
+
+def _normalize(df: pd.DataFrame) -> pd.DataFrame:
+    df = encode_dimensions(_coerce(df))
+    return build_keys(df)
+
+
+# =====================================================
+# DATASET CONTRACT (kiểm 1 lần lúc load; page không normalize lại)
+# =====================================================
+REQUIRED_COLUMNS = ["Ngày", "Tổng_Gross", "Tổng_Net"]
 
+
+def validate_dataset(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Kiểm bảng sau _normalize, sai => ValueError (liệt kê mọi lỗi):
+    - đủ REQUIRED_COLUMNS; Ngày là datetime, không NaT, đã sort tăng dần
+    - Tổng_Gross / Tổng_Net là số; DIM_COLS là category; cột KEY_COLS có khóa int đi kèm
+    """
+    errors = [f"thiếu cột {c}" for c in REQUIRED_COLUMNS if c not in df.columns]
+    if "Ngày" in df.columns:
+        if not pd.api.types.is_datetime64_any_dtype(df["Ngày"]):
+            errors.append(f"Ngày phải là datetime (đang là {df['Ngày'].dtype})")
+        elif df["Ngày"].isna().any() or not df["Ngày"].is_monotonic_increasing:
+            errors.append("Ngày có NaT hoặc chưa sort")
+    errors += [
+        f"{c} phải là số (đang là {df[c].dtype})"
+        for c in ["Tổng_Gross", "Tổng_Net"]
+        if c in df.columns and not pd.api.types.is_numeric_dtype(df[c])
+    ]
+    errors += [f"{c} phải là category" for c in DIM_COLS if c in df.columns and not isinstance(df[c].dtype, pd.CategoricalDtype)]
+    errors += [f"thiếu khóa {k} cho {c}" for c, k in KEY_COLS.items() if c in df.columns and k not in df.columns]
+    if errors:
+        raise ValueError("; ".join(errors))
     return df
 
 
-def get_active_data() -> pd.DataFrame:
+def _read_only(df: pd.DataFrame) -> pd.DataFrame:
+    # bảng dùng chung giữa các phiên: trả bản nông (copy-on-write, pandas>=3) => page gán cột không đụng bản trong cache
+    return df.copy(deep=False)
+
+
+def _is_partitioned(path: str) -> bool:
+    return os.path.isdir(path) and any(n.startswith("year=") for n in os.listdir(path))
+
+
+def _partition_files(path: str) -> list:
+    return sorted(glob.glob(os.path.join(path, "year=*", "**", "*.parquet"), recursive=True))
+
+
+def _data_source() -> str | None:
+    """Thư mục partition (nếu có) được ưu tiên hơn file data.parquet đơn."""
+    if _is_partitioned(DATA_DIR):
+        return DATA_DIR
+    if os.path.exists(PARQUET_FILE):
+        return PARQUET_FILE
+    return None
+
+
+def _delta_files() -> list:
+    return sorted(glob.glob(os.path.join(DELTA_DIR, "*.parquet")))
+
+
+def _base_version(path: str) -> tuple:
+    files = _partition_files(path) if os.path.isdir(path) else [path]
+    return (len(files), max((os.path.getmtime(f) for f in files), default=0.0))
+
+
+def _stat_source_version(path: str) -> tuple:
+    # stat file => đổi khi ghi đè file, thêm partition mới hoặc nạp thêm file delta (glob cả cây partition)
+    files = _delta_files()
+    return _base_version(path) + (len(files), max((os.path.getmtime(f) for f in files), default=0.0))
+
+
+# 1 lần rerun hỏi version hàng chục lần (memo key, cache_resource, get_active_data...) => stat tối đa 1 lần / TTL
+SOURCE_VERSION_TTL_SECONDS = float(os.environ.get("SOURCE_VERSION_TTL_SECONDS", 2))
+
+_source_versions: dict = {}  # path -> (version, hạn)
+_source_versions_lock = threading.Lock()
+
+
+def _source_version(path: str) -> tuple:
+    """Version của nguồn (xem _stat_source_version), dùng lại trong SOURCE_VERSION_TTL_SECONDS; file mới thấy chậm tối đa 1 TTL."""
+    now = time.monotonic()
+    with _source_versions_lock:
+        hit = _source_versions.get(path)
+    if hit is not None and hit[1] > now:
+        return hit[0]
+    version = _stat_source_version(path)
+    with _source_versions_lock:
+        _source_versions[path] = (version, now + SOURCE_VERSION_TTL_SECONDS)
+    return version
+
+
+def _source_files(path: str) -> list:
+    # [[đường dẫn tương đối, mtime], ...] của nguồn gốc: mỗi partition là 1 phần của snapshot (xem _extend_snapshot)
+    if not os.path.isdir(path):
+        return [[os.path.basename(path), os.path.getmtime(path)]]
+    return [[os.path.relpath(f, path), os.path.getmtime(f)] for f in _partition_files(path)]
+
+
+def _read_partitions(path: str, files=None) -> pd.DataFrame:
+    # đọc thẳng từng file partition (mặc định: tất cả; chỉ lúc build snapshot, không giữ bản thô cạnh snapshot)
+    files = _partition_files(path) if files is None else files
+    if not files:
+        return pd.DataFrame()
+    dataset = ds.dataset(files, format="parquet", partitioning="hive", partition_base_dir=path)
+    tables = []
+    for fragment in dataset.get_fragments():
+        table = ds.dataset(fragment.path, format="parquet").to_table()
+        keys = ds.get_partition_keys(fragment.partition_expression)
+        for part, col in PARTITION_DIMS.items():
+            if part in keys and col not in table.column_names:
+                table = table.append_column(col, pa.array([str(keys[part])] * table.num_rows, type=pa.string()))
+        tables.append(table)
+    if not tables:
+        return pd.DataFrame()
+    return pa.concat_tables(tables, promote_options="permissive").to_pandas()
+
+
+def _read_source(path: str) -> pd.DataFrame:
+    # đọc thô toàn bộ nguồn: file / partition gốc + các file delta đã nạp (delta đã bỏ trùng lúc nạp)
+    df = _read_partitions(path) if os.path.isdir(path) else pd.read_parquet(path)
+    deltas = [pd.read_parquet(f) for f in _delta_files()]
+    return pd.concat([df] + deltas, ignore_index=True) if deltas else df
+
+
+# =====================================================
+# SNAPSHOT (Arrow IPC đã normalize, memory-map khi khởi động)
+# =====================================================
+def _snapshot_fingerprint(path: str, version) -> str:
+    return json.dumps({
+        "schema": SNAPSHOT_SCHEMA_VERSION,
+        "source": os.path.abspath(path),
+        "version": list(version),
+        "base": _source_files(path),
+        "deltas": [os.path.basename(f) for f in _delta_files()],
+    })
+
+
+def _read_snapshot(fingerprint: str, file: str | None = None) -> pa.Table | None:
+    # file IPC không nén => cột số / ngày trỏ thẳng vào page cache của OS (dùng chung giữa các process)
+    file = file or SNAPSHOT_FILE
+    try:
+        table = pa.ipc.open_file(pa.memory_map(file, "r")).read_all()
+    except (OSError, pa.ArrowInvalid):
+        return None
+    meta = table.schema.metadata or {}
+    return table if meta.get(b"snapshot") == fingerprint.encode() else None
+
+
+def _write_snapshot(table: pa.Table, file: str | None = None) -> bool:
+    # ghi file tạm rồi replace => process khác không bao giờ đọc phải file ghi dở
+    file = file or SNAPSHOT_FILE
+    tmp = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp, file)
+        return True
+    except OSError:
+        # thư mục chỉ đọc / hết chỗ: vẫn chạy bình thường, lần sau decode lại parquet
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+
+
+def append_normalized(stored: pd.DataFrame, delta: pd.DataFrame) -> tuple[pd.DataFrame, bool]:
+    """
+    Nối delta (thô) vào bảng đã normalize, không normalize lại phần cũ:
+    - delta qua _coerce; cột category: giá trị mới nối cuối từ điển => mã / khóa dòng cũ giữ nguyên
+    - KEY_COLS: khóa dòng mới = mã trong từ điển đã nối
+    - trả (bảng, pure_append): pure_append = mọi dòng delta sau watermark (Ngày lớn nhất cũ) => chỉ nối cuối;
+      ngược lại (dòng trễ) sort lại theo Ngày
+    """
+    delta = _coerce(delta.copy(deep=False))
+    missing = [c for c in stored.columns if c not in delta.columns and c not in KEY_COLS.values()]
+    if missing:
+        raise ValueError(f"delta thiếu cột {', '.join(missing)}")
+
+    old, new = stored.copy(deep=False), pd.DataFrame(index=delta.index)
+    for c in stored.columns:
+        if c in KEY_COLS.values():
+            continue
+        if isinstance(stored[c].dtype, pd.CategoricalDtype):
+            cats = stored[c].cat.categories
+            extra = pd.Index(delta[c].dropna().unique()).difference(cats)
+            if len(extra):
+                cats = cats.append(extra)
+                old[c] = old[c].cat.set_categories(cats)
+            new[c] = pd.Categorical(delta[c], categories=cats)
+        else:
+            new[c] = delta[c].astype(stored[c].dtype)
+
+    for src, key in KEY_COLS.items():
+        if key in stored.columns:
+            codes = new[src].cat.codes.to_numpy().astype("int64")
+            keys = pd.Series(codes, index=new.index)
+            if (codes < 0).any():
+                keys = keys.astype("Int64").mask(codes < 0)
+            new[key] = keys
+
+    pure_append = stored.empty or delta.empty or delta["Ngày"].min() > stored["Ngày"].max()
+    df = pd.concat([old, new], ignore_index=True)
+    if not df["Ngày"].is_monotonic_increasing:
+        df = df.sort_values("Ngày", kind="stable", ignore_index=True)
+    return df, pure_append
+
+
+def _extend_snapshot(fingerprint: str) -> pa.Table | None:
     """
-    - Nếu đã có st.session_state["active_df"] => trả luôn (KHÔNG load lại)
-    - Nếu chưa có => load từ cache_resource 1 lần rồi gán vào session_state
+    Snapshot hiện có cùng nguồn, chỉ thiếu partition / file delta thêm sau => đọc / normalize riêng phần mới rồi nối:
+    - partition cũ (cùng đường dẫn + mtime) lấy lại từ snapshot, không đọc lại parquet => tuần mới chỉ đọc partition mới
+    - partition bị sửa / xoá, file delta lệch thứ tự => None (build lại toàn bộ)
+    Nối cuối thuần => metadata ghi (fingerprint cũ, số dòng cũ) cho bảng dẫn xuất.
     """
-    if "active_df" in st.session_state and isinstance(st.session_state["active_df"], pd.DataFrame):
-        return st.session_state["active_df"]
+    try:
+        old = pa.ipc.open_file(pa.memory_map(SNAPSHOT_FILE, "r")).read_all()
+        old_fp = (old.schema.metadata or {}).get(b"snapshot", b"").decode()
+        prev, cur = json.loads(old_fp), json.loads(fingerprint)
+    except (OSError, pa.ArrowInvalid, ValueError):
+        return None
+
+    done, base = prev.get("deltas", []), prev.get("base", [])
+    added = [f for f in cur["base"] if f not in base]
+    same = all(prev.get(k) == cur[k] for k in ["schema", "source"]) and all(f in cur["base"] for f in base)
+    if not same or cur["deltas"][: len(done)] != done or (len(cur["deltas"]) == len(done) and not added):
+        return None
+
+    source = cur["source"]
+    parts = [_read_partitions(source, [os.path.join(source, f) for f, _ in added])] if added else []
+    deltas = [pd.read_parquet(os.path.join(DELTA_DIR, f)) for f in cur["deltas"][len(done):]]
+    delta = pd.concat(parts + deltas, ignore_index=True)
+    stored = old.to_pandas(split_blocks=True)
+    df, pure_append = append_normalized(stored, delta)
+
+    meta = {b"snapshot": fingerprint.encode()}
+    if pure_append:
+        meta[b"snapshot_append"] = json.dumps({"from": old_fp, "row": len(stored)}).encode()
+    table = pa.Table.from_pandas(validate_dataset(df), preserve_index=False)
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), **meta})
+
+
+def _build_lock():
+    # 1 process build snapshot, các replica khác chờ rồi attach bản vừa publish (không build lại)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    lock = open(f"{SNAPSHOT_FILE}.lock", "a")
+    if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+
+def publish_snapshot(path: str, version) -> pa.Table:
+    """
+    Trả snapshot khớp (path, version), build + publish nếu chưa có:
+    - snapshot khớp fingerprint (schema version + nguồn + version) => memory-map, không decode
+    - chỉ thiếu file delta mới nạp => nối riêng phần delta (_extend_snapshot)
+    - lệch / chưa có => giữ khóa build, đọc parquet, _normalize 1 lần rồi ghi snapshot mới
+    """
+    fingerprint = _snapshot_fingerprint(path, version)
+    table = _read_snapshot(fingerprint)
+    if table is not None:
+        return table
+
+    try:
+        lock = _build_lock()
+    except OSError:
+        lock = None
+    try:
+        table = _read_snapshot(fingerprint)  # replica khác có thể vừa publish trong lúc chờ khóa
+        if table is not None:
+            return table
 
-    if not os.path.exists(PARQUET_FILE):
+        table = _extend_snapshot(fingerprint)
+        if table is None:
+            table = pa.Table.from_pandas(validate_dataset(_normalize(_read_source(path))), preserve_index=False)
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"snapshot": fingerprint.encode()})
+        _write_snapshot(table)
+        published = _read_snapshot(fingerprint)
+        return published if published is not None else table
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+@st.cache_resource(max_entries=2)
+def _snapshot_cached(path: str, version) -> pa.Table:
+    # bảng đã normalize của dataset mặc định, memory-map read-only (buffer dùng chung giữa các process)
+    return publish_snapshot(path, version)
+
+
+def _snapshot_frame(path: str, version, columns=None) -> pd.DataFrame:
+    table = _snapshot_cached(path, version)
+    if columns is not None:
+        cols = [c for c in columns if c in table.column_names]
+        cols += [k for src, k in KEY_COLS.items() if src in cols and k not in cols]  # khóa đi kèm cột gốc
+        table = table.select(cols)
+    # split_blocks: mỗi cột 1 block => cột số không null dùng thẳng buffer của snapshot (không copy)
+    return table.to_pandas(split_blocks=True)
+
+
+@st.cache_resource(max_entries=2)
+def _snapshot_dates(path: str, version) -> pd.DataFrame:
+    # riêng cột Ngày (8 byte / dòng, không copy) => date_slice trên snapshot không decode cột nào khác
+    return _snapshot_frame(path, version, ["Ngày"])
+
+
+def _view_columns(columns, available) -> list:
+    cols = [c for c in columns if c in available] if columns is not None else list(available)
+    if columns is not None:
+        cols += [k for s, k in KEY_COLS.items() if s in cols and k in available and k not in cols]
+    return cols
+
+
+def _select_rows(df: pd.DataFrame, mask, rest, filters: dict, cols: list) -> pd.DataFrame:
+    # mask của index (None = mọi dòng) AND các bộ lọc chưa có index, rồi chọn cột
+    if mask is None:
+        mask = np.ones(len(df), dtype=bool)
+    for col in rest:
+        mask &= isin_codes(df[col], filters[col])
+    if mask.all():
+        # không dòng nào bị loại: chọn cột trên lát (copy-on-write, chưa copy dữ liệu)
+        return df[cols]
+    # bảng lọc duy nhất được materialize: chỉ các cột page cần
+    return df.loc[mask, cols]
+
+
+def _apply_view(df: pd.DataFrame, columns=None, start_date=None, end_date=None, filters=None, index=None) -> pd.DataFrame:
+    # df đã sort theo Ngày (xem _normalize): khoảng ngày = 1 lát liên tục, mask chỉ chạy trên lát đó
+    rows = date_slice(df, start_date, end_date) if "Ngày" in df.columns else slice(0, len(df))
+    df = df.iloc[rows]
+
+    filters = {c: v for c, v in (filters or {}).items() if c in df.columns}
+    mask, rest = index_mask(index or {}, filters, rows)
+    return _select_rows(df, mask, rest, filters, _view_columns(columns, df.columns))
+
+
+def _snapshot_view(path: str, version, columns=None, start_date=None, end_date=None, filters=None) -> pd.DataFrame:
+    # như _apply_view nhưng trên bảng Arrow memory-map: lát ngày + index chọn dòng trước,
+    # chỉ decode (to_pandas) các cột page cần + cột lọc chưa có index, trên đúng lát ngày đó
+    table = _snapshot_cached(path, version)
+    rows = date_slice(_snapshot_dates(path, version), start_date, end_date)
+
+    filters = {c: v for c, v in (filters or {}).items() if c in table.column_names}
+    mask, rest = index_mask(_active_index_cached(path, version), filters, rows)
+    cols = _view_columns(columns, table.column_names)
+    part = table.slice(rows.start, rows.stop - rows.start).select(list(dict.fromkeys(cols + rest)))
+    if mask is not None and not mask.all():
+        # Brand / cửa hàng... đã chọn dòng qua index => chỉ decode các dòng đó (như bỏ qua partition không cần)
+        part, mask = part.take(np.flatnonzero(mask)), None
+    return _select_rows(part.to_pandas(split_blocks=True), mask, rest, filters, cols)
+
+
+def _scan(path: str, version, columns=None) -> pd.DataFrame:
+    # mọi lần đọc dataset mặc định đi qua snapshot (đã normalize + sort, gồm cả file delta đã nạp);
+    # version của cache gọi tới => bảng dẫn xuất luôn dựng từ đúng snapshot của key
+    return _apply_view(_snapshot_frame(path, version, columns), columns)
+
+
+def load_view(columns=None, start_date=None, end_date=None, filters: dict | None = None) -> pd.DataFrame:
+    """
+    Data-access API cho từng page:
+    - columns: chỉ đọc các cột page cần (projection)
+    - start_date / end_date: lọc Ngày (đóng 2 đầu, như mask cũ của các page)
+    - filters: {cột: list giá trị} như isin; [] => không dòng nào
+    Dữ liệu mặc định: lát ngày + bitmap index trên snapshot memory-map (không decode parquet,
+    không giữ bảng đủ cột / bản lọc nào trong cache); chỉ decode các cột được chọn trên lát ngày.
+    Dữ liệu upload: lọc trên active_df trong RAM.
+    """
+    columns = tuple(columns) if columns is not None else None
+    filters = tuple((c, tuple(v) if v is not None else None) for c, v in (filters or {}).items())
+
+    if st.session_state.get("active_source", "default") != "default" and "active_df" in st.session_state:
+        return _apply_view(st.session_state["active_df"], columns, start_date, end_date, dict(filters), get_active_index())
+
+    path = _data_source()
+    if path is None:
         st.error(f"Không thấy file dữ liệu: {PARQUET_FILE}")
         st.stop()
 
-    df = _load_parquet_cached(PARQUET_FILE)
-    st.session_state["active_df"] = df
+    return _snapshot_view(path, _source_version(path), columns, start_date, end_date, dict(filters))
+
+
+# =====================================================
+# INCREMENTAL (bảng dẫn xuất của snapshot nối cuối: chỉ tính trên các dòng mới)
+# =====================================================
+_derived: dict = {}  # (tên, path) -> {fingerprint snapshot: bảng}, giữ 2 bản như cache_resource
+_derived_lock = threading.Lock()
+
+
+def _snapshot_append(path: str, version) -> tuple:
+    # (fingerprint, fingerprint bản trước, số dòng bản trước); bản trước None nếu snapshot không phải nối cuối thuần
+    meta = _snapshot_cached(path, version).schema.metadata or {}
+    if b"snapshot_append" not in meta:
+        return meta.get(b"snapshot"), None, 0
+    append = json.loads(meta[b"snapshot_append"])
+    return meta.get(b"snapshot"), append["from"].encode(), append["row"]
+
+
+def _derived_value(name: str, path: str, fingerprint):
+    return _derived.get((name, path), {}).get(fingerprint)
+
+
+def _incremental(name: str, path: str, version, build, extend):
+    """
+    Bảng dẫn xuất `name` của snapshot (path, version):
+    - snapshot nối cuối từ bản trước và process còn giữ bảng của bản trước
+      => extend(bảng cũ, fingerprint cũ, số dòng cũ), chỉ tính trên dòng mới
+    - ngược lại / extend trả None => build() toàn bộ
+    """
+    fingerprint, prev, n_old = _snapshot_append(path, version)
+    old = _derived_value(name, path, prev) if prev is not None else None
+    value = extend(old, prev, n_old) if old is not None else None
+    if value is None:
+        value = build()
+    with _derived_lock:
+        hist = _derived.setdefault((name, path), OrderedDict())
+        hist[fingerprint] = value
+        while len(hist) > 2:
+            hist.popitem(last=False)
+    return value
+
+
+def _appended(path: str, version, n_old: int, columns=None) -> pd.DataFrame:
+    # các dòng snapshot nối sau n_old dòng cũ (category đã mang từ điển nối thêm)
+    return _apply_view(_snapshot_frame(path, version, columns).iloc[n_old:], columns)
+
+
+def _append_rows(old: pd.DataFrame, new: pd.DataFrame, ignore_index: bool = True) -> pd.DataFrame:
+    # từ điển category của bảng mới = từ điển cũ + giá trị nối cuối => set cho bảng cũ (mã giữ nguyên), concat giữ category
+    old = old.copy(deep=False)
+    for c in new.columns:
+        if c in old.columns and isinstance(new[c].dtype, pd.CategoricalDtype) and old[c].dtype != new[c].dtype:
+            old[c] = old[c].cat.set_categories(new[c].cat.categories)
+    return pd.concat([old, new], ignore_index=ignore_index)
+
+
+def _concat_bits(old: np.ndarray, new: np.ndarray, n_old: int, n_new: int) -> np.ndarray:
+    # nối bitmap theo trục dòng (trục byte cuối); n_old lẻ 8 => ghép lại byte cuối dở dang
+    full, r = divmod(n_old, 8)
+    if r == 0:
+        return np.concatenate([old[..., :full], new], axis=-1)
+    tail = np.unpackbits(old[..., full:full + 1], axis=-1)[..., :r]
+    joined = np.packbits(np.concatenate([tail, np.unpackbits(new, axis=-1, count=n_new)], axis=-1), axis=-1)
+    return np.concatenate([old[..., :full], joined], axis=-1)
+
+
+def _concat_rows(old, new, n_old: int) -> tuple[np.ndarray, np.ndarray]:
+    # nối từng đoạn: đoạn cũ rồi đoạn mới (vị trí + n_old); giá trị mới => đoạn cũ rỗng, đoạn NaN luôn ở cuối
+    (_, old_cats, old_rows, old_off), (_, cats, rows, off) = old, new
+    k_old = len(old_cats)
+    parts, counts = [], []
+    for k in range(len(cats) + 1):
+        ko = k if k < len(cats) else k_old  # đoạn NaN của bảng cũ nằm ở vị trí k_old
+        a = old_rows[old_off[ko]:old_off[ko + 1]] if (k < k_old or k == len(cats)) else old_rows[:0]
+        b = rows[off[k]:off[k + 1]] + np.int32(n_old)
+        parts += [a, b]
+        counts.append(len(a) + len(b))
+    return np.concatenate(parts).astype(np.int32), np.concatenate([[0], np.cumsum(counts)])
+
+
+def extend_bitmap_index(index: dict, df_new: pd.DataFrame, n_old: int) -> dict | None:
+    """
+    Index sau khi nối df_new vào cuối bảng n_old dòng:
+    - chỉ build index cho dòng mới rồi ghép, không quét lại dòng cũ
+    - giá trị category mới (nối cuối từ điển) => thêm hàng bitmap 0 / đoạn rỗng cho phần cũ
+    - cột đổi kiểu entry (số giá trị vượt ngưỡng bitmap) => None, build lại toàn bộ
+    """
+    n_new = len(df_new)
+    out = {}
+    for c, entry in build_bitmap_index(df_new).items():
+        if c not in index:
+            continue
+        if index[c][0] != entry[0]:
+            return None
+        if entry[0] == "rows":
+            out[c] = ("rows", entry[1]) + _concat_rows(index[c], entry, n_old)
+            continue
+        _, cats, bits, valid = entry
+        _, _, old_bits, old_valid = index[c]
+        old_bits = np.concatenate([old_bits, np.zeros((len(cats) - len(old_bits), old_bits.shape[1]), dtype=np.uint8)])
+        if valid is not None or old_valid is not None:
+            old_valid = old_valid if old_valid is not None else np.packbits(np.ones(n_old, dtype=bool))
+            valid = valid if valid is not None else np.packbits(np.ones(n_new, dtype=bool))
+            valid = _concat_bits(old_valid, valid, n_old, n_new)
+        out[c] = ("bits", cats, _concat_bits(old_bits, bits, n_old, n_new), valid)
+    return out
+
+
+def _extend_index(name: str, path: str, prev, current: pd.DataFrame, old_index: dict) -> dict | None:
+    # index của bảng dẫn xuất `name`: số dòng cũ = độ dài bảng `name` của bản trước (None => build lại)
+    old = _derived_value(name, path, prev)
+    if old is None:
+        return None
+    return extend_bitmap_index(old_index, current.iloc[len(old):], len(old))
+
+
+# =====================================================
+# DAILY CUBE (Gross/Net cộng dồn theo ngày × các chiều sidebar)
+# =====================================================
+CUBE_DIMS = ["Điểm_mua_hàng", "LoaiCT", "Brand", "Region", "Trạng_thái_số_điện_thoại", "Kiểm_tra_tên"]
+CUBE_MEASURES = ["Tổng_Gross", "Tổng_Net"]
+
+
+def _cube_groupby(df: pd.DataFrame):
+    # sort=False: thứ tự cell = thứ tự xuất hiện => cube và sketch dùng chung id cell;
+    # dòng vào đã sort theo Ngày => cube cũng sort theo Ngày (cube_view dùng date_slice được)
+    dims = ["Ngày"] + [c for c in CUBE_DIMS if c in df.columns]
+    return df.groupby(dims, dropna=False, observed=True, sort=False)
+
+
+def build_daily_cube(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Cube = sum(Tổng_Gross, Tổng_Net) theo Ngày × mọi chiều lọc ở sidebar.
+    Giữ nguyên tên cột => các hàm group/mask của page chạy thẳng trên cube.
+    """
+    measures = [c for c in CUBE_MEASURES if c in df.columns]
+    return _cube_groupby(df)[measures].sum().reset_index()
+
+
+def build_cube_sketches(df: pd.DataFrame) -> dict:
+    """Sketch HLL cho KH_key / CT_key trên từng cell của cube (cell id = số dòng trong cube)."""
+    cells = _cube_groupby(df).ngroup().to_numpy()
+    return {c: hll.build_entries(cells, df[c]) for c in KEY_COLS.values() if c in df.columns}
+
+
+CUBE_COLUMNS = ["Ngày"] + CUBE_DIMS + CUBE_MEASURES
+SKETCH_COLUMNS = ["Ngày"] + CUBE_DIMS + list(KEY_COLS)
+
+
+def _extend_sketches(old: dict, prev, path: str, version, n_old: int) -> dict | None:
+    # cell của phần nối = số thứ tự trong cube mới => cộng thêm số cell của cube bản trước
+    old_cube = _derived_value("cube", path, prev)
+    if old_cube is None:
+        return None
+    new = build_cube_sketches(_appended(path, version, n_old, SKETCH_COLUMNS))
+    return {
+        c: pd.concat([old[c], e.assign(cell=e["cell"] + len(old_cube))], ignore_index=True) for c, e in new.items()
+    }
+
+
+@st.cache_resource(max_entries=2)
+def _cube_cached(path: str, version) -> pd.DataFrame:
+    # chỉ đọc cột cần cho cube, build 1 lần / phiên bản dataset; nạp thêm tuần mới => chỉ gộp các ngày mới
+    return _incremental(
+        "cube", path, version,
+        lambda: build_daily_cube(_scan(path, version, columns=CUBE_COLUMNS)),
+        lambda old, prev, n_old: _append_rows(old, build_daily_cube(_appended(path, version, n_old, CUBE_COLUMNS))),
+    )
+
+
+@st.cache_resource(max_entries=2)
+def _cube_sketches_cached(path: str, version) -> dict:
+    # chỉ build khi có page bật chế độ đếm xấp xỉ
+    return _incremental(
+        "cube_sketches", path, version,
+        lambda: build_cube_sketches(_scan(path, version, columns=SKETCH_COLUMNS)),
+        lambda old, prev, n_old: _extend_sketches(old, prev, path, version, n_old),
+    )
+
+
+@st.cache_resource(max_entries=2)
+def _cube_index_cached(path: str, version) -> dict:
+    return _incremental(
+        "cube_index", path, version,
+        lambda: build_bitmap_index(_cube_cached(path, version)),
+        lambda old, prev, n_old: _extend_index("cube", path, prev, _cube_cached(path, version), old),
+    )
+
+
+def _uploaded_part(name: str, build):
+    # dữ liệu upload: dựng 1 lần / phiên từ active_df, xoá khi set_active_data
+    if name not in st.session_state:
+        st.session_state[name] = build(st.session_state["active_df"])
+    return st.session_state[name]
+
+
+def _dataset_part(name: str, cached, build):
+    # bảng dẫn xuất (cube / header / index ...): upload -> session_state, mặc định -> cache theo (path, version)
+    if st.session_state.get("active_source", "default") != "default" and "active_df" in st.session_state:
+        return _uploaded_part(name, build)
+
+    path = _data_source()
+    if path is None:
+        st.error(f"Không thấy file dữ liệu: {PARQUET_FILE}")
+        st.stop()
+
+    return cached(path, _source_version(path))
+
+
+def get_cube() -> pd.DataFrame:
+    return _read_only(_dataset_part("active_cube", _cube_cached, build_daily_cube))
+
+
+def get_cube_sketches() -> dict:
+    return _dataset_part("active_cube_sketches", _cube_sketches_cached, build_cube_sketches)
+
+
+def get_cube_index() -> dict:
+    return _dataset_part("active_cube_index", _cube_index_cached, lambda _: build_bitmap_index(get_cube()))
+
+
+def cube_view(start_date=None, end_date=None, filters: dict | None = None) -> pd.DataFrame:
+    """Lát cube theo cùng khoảng ngày / bộ lọc như load_view."""
+    return _apply_view(get_cube(), None, start_date, end_date, filters, get_cube_index())
+
+
+# =====================================================
+# ORDER HEADER (1 dòng / chứng từ thay cho 1 dòng / mặt hàng)
+# =====================================================
+ORDER_DIMS = ["Ngày", "Điểm_mua_hàng", "Brand", "Region", "LoaiCT", "Trạng_thái_số_điện_thoại", "Kiểm_tra_tên"]
+ORDER_COLUMNS = ORDER_DIMS + ["Số_CT", "Số_điện_thoại", "tên_KH", "Tổng_Gross", "Tổng_Net"]
+
+
+def build_orders(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Bảng header chứng từ từ dữ liệu dòng hàng:
+    - khóa = CT_key + KH_key + Ngày + các chiều (dropna=False: dòng thiếu số CT không bị gộp lẫn)
+    - Tổng_Gross / Tổng_Net cộng theo chứng từ, tên_KH lấy giá trị đầu
+    - giữ Số_CT / Số_điện_thoại (category) để key_to_value dùng được như trên bảng dòng
+    Thứ tự nhóm = thứ tự xuất hiện => vẫn sort theo Ngày (date_slice dùng được).
+    """
+    keys = [c for c in ["CT_key", "Số_CT", "KH_key", "Số_điện_thoại"] + ORDER_DIMS if c in df.columns]
+    agg = {c: (c, "sum") for c in CUBE_MEASURES if c in df.columns}
+    if "tên_KH" in df.columns:
+        agg["tên_KH"] = ("tên_KH", "first")
+    return df.groupby(keys, dropna=False, observed=True, sort=False).agg(**agg).reset_index()
+
+
+@st.cache_resource(max_entries=2)
+def _orders_cached(path: str, version) -> pd.DataFrame:
+    # nạp thêm tuần mới => chỉ gộp chứng từ của các dòng mới rồi nối cuối
+    return _incremental(
+        "orders", path, version,
+        lambda: build_orders(_scan(path, version, columns=ORDER_COLUMNS)),
+        lambda old, prev, n_old: _append_rows(old, build_orders(_appended(path, version, n_old, ORDER_COLUMNS))),
+    )
+
+
+@st.cache_resource(max_entries=2)
+def _orders_index_cached(path: str, version) -> dict:
+    return _incremental(
+        "orders_index", path, version,
+        lambda: build_bitmap_index(_orders_cached(path, version)),
+        lambda old, prev, n_old: _extend_index("orders", path, prev, _orders_cached(path, version), old),
+    )
+
+
+def get_orders() -> pd.DataFrame:
+    return _read_only(_dataset_part("active_orders", _orders_cached, build_orders))
+
+
+def get_orders_index() -> dict:
+    return _dataset_part("active_orders_index", _orders_index_cached, lambda _: build_bitmap_index(get_orders()))
+
+
+def orders_view(start_date=None, end_date=None, filters: dict | None = None) -> pd.DataFrame:
+    """Lát bảng header chứng từ theo cùng khoảng ngày / bộ lọc như load_view."""
+    return _apply_view(get_orders(), None, start_date, end_date, filters, get_orders_index())
+
+
+# =====================================================
+# CUSTOMER DIMENSION (1 dòng / KH: lần mua đầu / cuối, tổng trọn đời, tên + cờ trạng thái)
+# =====================================================
+def build_customers(orders: pd.DataFrame) -> pd.DataFrame:
+    """
+    Bảng KH từ header chứng từ, index = KH_key:
+    - First_Date / Last_Date, Gross / Net / Orders trọn đời
+    - Name / Name_Check / Check_SDT = giá trị ở lần mua đầu (header đã sort theo Ngày)
+    """
+    if "KH_key" not in orders.columns or "Ngày" not in orders.columns:
+        return pd.DataFrame(columns=["First_Date", "Last_Date"], index=pd.Index([], name="KH_key"))
+
+    agg = {
+        "First_Date": ("Ngày", "min"),
+        "Last_Date": ("Ngày", "max"),
+    }
+    if "Tổng_Gross" in orders.columns:
+        agg["Gross"] = ("Tổng_Gross", "sum")
+    if "Tổng_Net" in orders.columns:
+        agg["Net"] = ("Tổng_Net", "sum")
+    if "CT_key" in orders.columns:
+        agg["Orders"] = ("CT_key", "nunique")
+    for name, col in [("Name", "tên_KH"), ("Name_Check", "Kiểm_tra_tên"), ("Check_SDT", "Trạng_thái_số_điện_thoại")]:
+        if col in orders.columns:
+            agg[name] = (col, "first")
+    return orders.groupby("KH_key", observed=True).agg(**agg)
+
+
+def merge_customers(old: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+    """
+    Bảng KH sau khi nối phần append (mọi ngày đều mới hơn bảng cũ), new = build_customers(header phần append):
+    - KH cũ mua thêm: Last_Date mới, Gross / Net / Orders cộng dồn; First_Date / Name... giữ lần mua đầu
+    - KH mới: nguyên dòng của phần append
+    """
+    both = new.index.intersection(old.index)
+    out = _append_rows(old, new.drop(index=both), ignore_index=False)
+    if len(both):
+        add = new.loc[both]
+        out.loc[both, "Last_Date"] = add["Last_Date"]
+        for c in ["Gross", "Net", "Orders"]:
+            if c in out.columns:
+                out.loc[both, c] = out.loc[both, c] + add[c]
+    return out.sort_index()
+
+
+def _extend_customers(old: pd.DataFrame, prev, path: str, version) -> pd.DataFrame | None:
+    old_orders = _derived_value("orders", path, prev)
+    if old_orders is None:
+        return None
+    return merge_customers(old, build_customers(_orders_cached(path, version).iloc[len(old_orders):]))
+
+
+@st.cache_resource(max_entries=2)
+def _customers_cached(path: str, version) -> pd.DataFrame:
+    return _incremental(
+        "customers", path, version,
+        lambda: build_customers(_orders_cached(path, version)),
+        lambda old, prev, n_old: _extend_customers(old, prev, path, version),
+    )
+
+
+def get_customers() -> pd.DataFrame:
+    return _read_only(_dataset_part("active_customers", _customers_cached, lambda _: build_customers(get_orders())))
+
+
+# =====================================================
+# CRM TABLES (thuần pandas trên header chứng từ => chạy được trong process pool, xem offload)
+# =====================================================
+# quy ước task: func(view header đã lọc, bảng KH, *tham số) -> bảng kết quả nhỏ
+def build_crm(df_f: pd.DataFrame, customers: pd.DataFrame, group_cols) -> pd.DataFrame:
+    # groupby chỉ cộng số đo trong kỳ; tên / cờ KH map từ bảng KH (không "first" trên chuỗi)
+    d = (
+        df_f.groupby(group_cols, observed=True)
+        .agg(
+            Gross=("Tổng_Gross", "sum"),
+            Net=("Tổng_Net", "sum"),
+            Orders=("CT_key", "nunique"),
+            First_Order=("Ngày", "min"),
+            Last_Order=("Ngày", "max"),
+        )
+        .reset_index()
+    )
+    attrs = customers.reindex(d["KH_key"])
+    d.insert(len(group_cols), "Name", attrs["Name"].to_numpy())
+    d.insert(len(group_cols) + 1, "Name_Check", attrs["Name_Check"].to_numpy())
+    d["Check_SDT"] = attrs["Check_SDT"].to_numpy()
+    # key -> SĐT gốc chỉ cho các dòng xuất CRM
+    d.insert(0, "Số_điện_thoại", key_to_value(df_f, "Số_điện_thoại", d.pop("KH_key")))
+    return d
+
+
+def pareto_base(df: pd.DataFrame, customers: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    Bảng KH × Cửa hàng đã xếp hạng (1 lần / bộ lọc, dùng lại khi đổi % / Top-Bottom / cửa hàng):
+    - Net giảm dần trong từng cửa hàng, Contribution_% / Cum_% theo cửa hàng
+    - Rank (0 = Net cao nhất) + Size (số KH của cửa hàng) để chọn Top/Bottom N%
+    """
+    g = (
+        df.groupby(["Điểm_mua_hàng", "KH_key"], observed=True)
+        .agg(Gross=("Tổng_Gross", "sum"), Net=("Tổng_Net", "sum"), Orders=("CT_key", "nunique"))
+        .reset_index()
+        .sort_values(["Điểm_mua_hàng", "Net"], ascending=[True, False], kind="stable", ignore_index=True)
+    )
+    if g.empty:
+        return g
+
+    by_store = g.groupby("Điểm_mua_hàng", observed=True, sort=False)
+    total_net = by_store["Net"].transform("sum")
+
+    g["CK_%"] = ((g["Gross"] - g["Net"]) / g["Gross"] * 100).round(2)
+    g["Contribution_%"] = (g["Net"] / total_net * 100).round(2).where(total_net != 0, 0)
+    g["Cum_%"] = g.groupby("Điểm_mua_hàng", observed=True, sort=False)["Contribution_%"].cumsum().round(2)
+    g["Rank"] = by_store.cumcount()
+    g["Size"] = by_store["Net"].transform("size")
+    g["Số_điện_thoại"] = key_to_value(df, "Số_điện_thoại", g["KH_key"])
+    return g
+
+
+def cohort_first_return(df_in: pd.DataFrame, customers: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    1 dòng / KH (tính 1 lần cho mọi MAX_MONTH):
+    - First: tháng mua đầu tiên trong kỳ lọc (số tháng tuyệt đối = năm*12 + tháng - 1)
+    - Return: số tháng từ First tới lần quay lại đầu tiên (<NA> nếu chưa quay lại)
+    """
+    d = pd.DataFrame({
+        "KH_key": df_in["KH_key"],
+        "M": df_in["Ngày"].dt.year * 12 + df_in["Ngày"].dt.month - 1,
+    }).dropna(subset=["KH_key"]).drop_duplicates()
+
+    d["Idx"] = d["M"] - d.groupby("KH_key")["M"].transform("min")
+    kh = d.groupby("KH_key").agg(First=("M", "min"))
+    kh["Return"] = d[d["Idx"] >= 1].groupby("KH_key")["Idx"].min().astype("Int64")
+    return kh
+
+
+# =====================================================
+# DIMENSION CATALOG (option sidebar, cây Brand → Region → Cửa hàng, min/max ngày)
+# =====================================================
+HIERARCHY = ["Brand", "Region", "Điểm_mua_hàng"]
+
+
+def _options(s: pd.Series) -> list:
+    # cùng chuẩn hoá với ms_all: bỏ NaN, str + strip, unique, sort
+    return sorted(pd.Series(s).dropna().astype(str).str.strip().unique().tolist())
+
+
+def build_catalog(df_cube: pd.DataFrame) -> dict:
+    """
+    Danh mục chiều của 1 dataset, dựng từ cube ngày (đủ mọi giá trị chiều, nhỏ hơn bảng fact):
+    - options: {cột: list giá trị đã chuẩn hoá} cho các cột INDEX_DIMS
+    - hierarchy: các bộ (Brand, Region, Điểm_mua_hàng) phân biệt => cascade sidebar
+    - date_min / date_max: mặc định của ô chọn ngày (None nếu không có dữ liệu)
+    """
+    options = {}
+    for c in INDEX_DIMS:
+        if c in df_cube.columns:
+            s = df_cube[c]
+            if isinstance(s.dtype, pd.CategoricalDtype):
+                codes = np.unique(s.cat.codes.to_numpy())
+                s = s.cat.categories.take(codes[codes >= 0]).to_series()
+            options[c] = _options(s)
+
+    hier = [c for c in HIERARCHY if c in df_cube.columns]
+    empty = df_cube.empty or "Ngày" not in df_cube.columns
+    return {
+        "options": options,
+        "hierarchy": df_cube[hier].drop_duplicates(ignore_index=True),
+        "date_min": None if empty else df_cube["Ngày"].min(),
+        "date_max": None if empty else df_cube["Ngày"].max(),
+    }
+
+
+@st.cache_resource(max_entries=2)
+def _catalog_cached(path: str, version) -> dict:
+    return build_catalog(_cube_cached(path, version))
+
+
+def get_catalog() -> dict:
+    return _dataset_part("active_catalog", _catalog_cached, lambda _: build_catalog(get_cube()))
+
+
+def cascade_options(catalog: dict, col: str, parents: dict) -> list:
+    """
+    Option của col trong cây HIERARCHY khi đã chọn các cột cha (vd. Region theo Brand).
+    Cột cha chọn rỗng => không có option (như cascade cũ trên bảng fact).
+    """
+    h = catalog["hierarchy"]
+    if col not in h.columns:
+        return []
+
+    mask = np.ones(len(h), dtype=bool)
+    for c, values in parents.items():
+        if not values or c not in h.columns:
+            return []
+        mask &= isin_codes(h[c], values)
+    return _options(h.loc[mask, col])
+
+
+# =====================================================
+# CALENDAR (bảng ngày dùng chung cho mọi grain / thứ bắt đầu tuần)
+# =====================================================
+def build_calendar(year_from: int, year_to: int) -> pd.DataFrame:
+    """
+    1 dòng / ngày của các năm [year_from, year_to], index = số ngày (int) kể từ 1970-01-01:
+    - Date, Year, Month, Quarter + nhãn Day_label / Month_label / Quarter_period (2025Q1) /
+      Quarter_label (Q1 2025) / Year_label
+    - tuần theo từng thứ bắt đầu ws = 0..6 (Thứ 2 = 0): Week_anchor_{ws} (ngày đầu tuần),
+      Week_year_{ws} / Week_{ws} (ISO năm / tuần của anchor), Week_label_{ws} (Tuần 05/2025)
+    """
+    days = pd.date_range(f"{year_from}-01-01", f"{year_to}-12-31", freq="D")
+    cal = pd.DataFrame({"Ngày": days}, index=days.to_numpy().astype("datetime64[D]").astype("int64"))
+
+    cal["Date"] = days.date
+    cal["Year"] = days.year
+    cal["Month"] = days.month
+    cal["Quarter"] = days.quarter
+    cal["Day_label"] = days.strftime("%Y-%m-%d")
+    cal["Month_label"] = days.to_period("M").astype(str)
+    cal["Quarter_period"] = days.to_period("Q").astype(str)
+    cal["Quarter_label"] = "Q" + cal["Quarter"].astype(str) + " " + cal["Year"].astype(str)
+    cal["Year_label"] = cal["Year"].astype(str)
+
+    for ws in range(7):
+        anchor = days - pd.to_timedelta((days.weekday - ws) % 7, unit="D")
+        iso = anchor.isocalendar()
+        cal[f"Week_anchor_{ws}"] = anchor
+        cal[f"Week_year_{ws}"] = iso["year"].astype(int).to_numpy()
+        cal[f"Week_{ws}"] = iso["week"].astype(int).to_numpy()
+        cal[f"Week_label_{ws}"] = ("Tuần " + iso["week"].astype(str).str.zfill(2) + "/" + iso["year"].astype(str)).to_numpy()
+    return cal
+
+
+@st.cache_resource(max_entries=4)
+def _calendar_cached(year_from: int, year_to: int) -> pd.DataFrame:
+    return build_calendar(year_from, year_to)
+
+
+def get_calendar() -> pd.DataFrame:
+    catalog = get_catalog()
+    if catalog["date_min"] is None:
+        return _calendar_cached(1970, 1970)
+    return _calendar_cached(catalog["date_min"].year, catalog["date_max"].year)
+
+
+def calendar_keys(dates: pd.Series, cols):
+    """
+    Cột lịch cho từng dòng: số ngày (int) -> take trên bảng calendar (không isocalendar /
+    to_period / strftime từng dòng). cols: tên cột => Series, list => DataFrame (như cal[cols]).
+    """
+    day = dates.to_numpy().astype("datetime64[D]").astype("int64")
+    cal = get_calendar()
+    pos = day - cal.index[0]
+    if len(pos) and (pos.min() < 0 or pos.max() >= len(cal)):
+        # ngày ngoài khoảng năm của dataset (hiếm) => lịch riêng cho đúng khoảng
+        cal = _calendar_cached(dates.min().year, dates.max().year)
+        pos = day - cal.index[0]
+
+    out = cal[cols].take(pos)
+    out.index = dates.index
+    return out
+
+
+def period_cols(grain: str, week_start: int = 0) -> tuple:
+    """(cột Year, cột Key, cột nhãn) của calendar cho grain Tuần / Tháng / Quý."""
+    if grain == "Tuần":
+        return f"Week_year_{week_start}", f"Week_{week_start}", f"Week_label_{week_start}"
+    return {"Tháng": ("Year", "Month", "Month_label"), "Quý": ("Year", "Quarter", "Quarter_label")}[grain]
+
+
+def period_labels(grain: str, week_start: int = 0) -> pd.Series:
+    """Nhãn kỳ theo (Year, Key), lấy từ calendar => join thay cho apply(lambda) từng dòng."""
+    ycol, kcol, lcol = period_cols(grain, week_start)
+    lab = get_calendar()[[ycol, kcol, lcol]].drop_duplicates([ycol, kcol])
+    return pd.Series(lab[lcol].to_numpy(), index=pd.MultiIndex.from_arrays([lab[ycol], lab[kcol]], names=["Year", "Key"]))
+
+
+def _approx_distinct(group_ids: pd.Series, n_groups: int, col: str) -> np.ndarray:
+    # group_ids: số thứ tự nhóm, index = id cell trong cube đầy đủ
+    # (ngroup() với pd.Grouper trả index theo thứ tự đã sort => luôn map theo index, không theo vị trí)
+    cell_group = np.full(len(get_cube()), -1, dtype=np.int64)
+    cell_group[group_ids.index.to_numpy()] = group_ids.to_numpy()
+    return hll.estimate_groups(get_cube_sketches()[col], cell_group, n_groups)
+
+
+def cube_distinct(df_cube: pd.DataFrame, col: str) -> int:
+    """Distinct xấp xỉ (HLL) của KH_key / CT_key trên toàn bộ lát cube."""
+    return int(_approx_distinct(pd.Series(0, index=df_cube.index), 1, col)[0])
+
+
+def cube_agg(
+    df_rows: pd.DataFrame,
+    df_cube: pd.DataFrame,
+    by,
+    sums: dict,
+    distinct: dict | None = None,
+    dropna: bool = True,
+    approx: bool = False,
+) -> pd.DataFrame:
+    """
+    Gộp theo `by` (tên cột / pd.Grouper có mặt ở cả 2 bảng):
+    - sums: {cột kết quả: cột nguồn} => cộng trên cube (nhỏ hơn bảng fact nhiều lần)
+    - distinct: {cột kết quả: cột nguồn} => nunique trên dòng gốc (không cộng dồn được)
+    - approx=True: distinct lấy từ hợp sketch HLL của các cell, không quét dòng gốc
+    """
+    g = df_cube.groupby(by, dropna=dropna, observed=True)
+    out = g.agg(**{k: (v, "sum") for k, v in sums.items()})
+
+    if distinct and approx:
+        group_ids = g.ngroup()
+        for k, v in distinct.items():
+            out[k] = _approx_distinct(group_ids, len(out), v).astype("int64")
+    elif distinct:
+        cnt = df_rows.groupby(by, dropna=dropna, observed=True).agg(**{k: (v, "nunique") for k, v in distinct.items()})
+        out = out.join(cnt, how="outer")
+        out[list(distinct)] = out[list(distinct)].fillna(0).astype("int64")
+
+    out[list(sums)] = out[list(sums)].fillna(0)
+    return out.reset_index()
+
+
+def _default_key() -> tuple:
+    path = _data_source()
+    if path is None:
+        st.error(f"Không thấy file dữ liệu: {PARQUET_FILE}")
+        st.stop()
+    return path, _source_version(path)
+
+
+def get_active_data() -> pd.DataFrame:
+    """
+    - Dữ liệu upload (st.session_state["active_df"]) => trả luôn (KHÔNG load lại)
+    - Dữ liệu mặc định => đọc đủ cột từ snapshot memory-map mỗi lần gọi, không cache / không gán vào
+      session_state (page đọc qua load_view chỉ với các cột cần)
+    - Bảng đã qua validate_dataset (typed, sort theo Ngày): page dùng thẳng, không ensure_datetime / fix_numeric;
+      trả bản nông read-only, không sửa được bản dùng chung
+    """
+    if st.session_state.get("active_source", "default") != "default" and "active_df" in st.session_state:
+        return _read_only(st.session_state["active_df"])
+
+    st.session_state.pop("active_df", None)
     st.session_state["active_source"] = "default"
-    return df
+    return _read_only(_snapshot_frame(*_default_key()))
+
+
+@st.cache_resource(max_entries=2)
+def _active_index_cached(path: str, version) -> dict:
+    # index chỉ cần các cột INDEX_DIMS của snapshot (category trên buffer memory-map)
+    return _incremental(
+        "active_index", path, version,
+        lambda: build_bitmap_index(_snapshot_frame(path, version, INDEX_DIMS)),
+        lambda old, prev, n_old: extend_bitmap_index(old, _snapshot_frame(path, version, INDEX_DIMS).iloc[n_old:], n_old),
+    )
+
+
+def get_active_index() -> dict:
+    """Bitmap index khớp vị trí dòng với get_active_data() (dùng chung giữa các phiên nếu là dữ liệu mặc định)."""
+    if st.session_state.get("active_source", "default") != "default" and "active_df" in st.session_state:
+        return _uploaded_part("active_index", build_bitmap_index)
+    return _active_index_cached(*_default_key())
 
 
 def set_active_data(df: pd.DataFrame, source: str = "upload"):
     """
     Khi upload parquet mới:
+    - Normalize + validate_dataset 1 lần; không hợp lệ (kể cả rỗng sau khi bỏ Ngày lỗi) => ValueError, giữ dữ liệu cũ
     - Gán vào session_state để toàn bộ pages dùng chung ngay
     - Không cache (vì file upload khác nhau)
     """
     if df is None or df.empty:
         return
 
-    df = df.copy()
-    if "Ngày" in df.columns:
-        df["Ngày"] = pd.to_datetime(df["Ngày"], errors="coerce")
-        df = df.dropna(subset=["Ngày"])
-
-    for c in ["Tổng_Gross", "Tổng_Net"]:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce")
+    df = validate_dataset(_normalize(df.copy(deep=False)))
+    if df.empty:
+        raise ValueError("không còn dòng nào có Ngày hợp lệ")
 
     st.session_state["active_df"] = df
+    st.session_state.pop("active_cube", None)
+    st.session_state.pop("active_cube_sketches", None)
+    st.session_state.pop("active_cube_index", None)
+    st.session_state.pop("active_catalog", None)
+    st.session_state.pop("active_orders", None)
+    st.session_state.pop("active_orders_index", None)
+    st.session_state.pop("active_customers", None)
+    st.session_state["active_version"] = ("upload", _content_hash(df))
+    st.session_state.pop("active_index", None)
     st.session_state["active_source"] = source
 
 
-def first_purchase(df: pd.DataFrame | None = None) -> pd.DataFrame:
-    if df is None:
-        df = get_active_data()
+# =====================================================
+# DATASET VERSION + MEMO (kết quả tính theo (version, hàm, tham số lọc))
+# =====================================================
+# cache kết quả dùng chung toàn process (mọi phiên): LRU theo số entry + ngân sách RAM, hết hạn theo TTL
+MEMO_MAX_ENTRIES = int(os.environ.get("MEMO_MAX_ENTRIES", 256))
+MEMO_MAX_BYTES = int(float(os.environ.get("MEMO_MAX_MB", 512)) * 1024 * 1024)
+MEMO_TTL_SECONDS = float(os.environ.get("MEMO_TTL_SECONDS", 3600))
 
-    if "Số_điện_thoại" not in df.columns or "Ngày" not in df.columns:
-        return pd.DataFrame(columns=["Số_điện_thoại", "First_Date"])
+_memo: OrderedDict = OrderedDict()  # key -> (kết quả, số byte, hạn)
+_memo_lock = threading.Lock()
+_memo_bytes = 0
+_memo_stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "coalesced": 0}
 
-    fp = (
-        df.groupby("Số_điện_thoại", as_index=False)["Ngày"]
-        .min()
-        .rename(columns={"Ngày": "First_Date"})
-    )
-    return fp
+# single-flight: key đang tính -> _Flight; các phiên gọi trùng key chờ kết quả thay vì tính lại
+_inflight: dict = {}
+_inflight_lock = threading.Lock()
+
+
+def _content_hash(df: pd.DataFrame) -> str:
+    # hash nội dung 1 lần / upload (O(số dòng), không lặp lại mỗi rerun)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr(list(df.columns)).encode())
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def dataset_version() -> tuple:
+    """
+    Id rẻ cho dataset đang active:
+    - mặc định: (path, số file + mtime) như các cache_resource
+    - upload: hash nội dung, tính 1 lần khi set_active_data
+    """
+    if st.session_state.get("active_source", "default") != "default" and "active_df" in st.session_state:
+        if "active_version" not in st.session_state:
+            st.session_state["active_version"] = ("upload", _content_hash(st.session_state["active_df"]))
+        return st.session_state["active_version"]
+    return ("default", *_default_key())
+
+
+def _freeze(v, as_set: bool = False):
+    """
+    Chuẩn hoá tham số thành key hashable:
+    - ngày (date / datetime / Timestamp) -> Timestamp
+    - dict (bộ lọc) -> cặp (cột, giá trị) sort theo cột; list giá trị trong dict coi như tập hợp
+    - list / tuple -> tuple (giữ thứ tự, vd. cột group)
+    """
+    if isinstance(v, dict):
+        return tuple(sorted((str(k), _freeze(x, as_set=True)) for k, x in v.items()))
+    if isinstance(v, (list, tuple, set, frozenset, np.ndarray, pd.Index, pd.Series)):
+        items = [_freeze(x) for x in v]
+        if as_set or isinstance(v, (set, frozenset)):
+            return tuple(sorted(set(items), key=repr))
+        return tuple(items)
+    if isinstance(v, (datetime.date, np.datetime64)):
+        return pd.Timestamp(v)
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+def _nbytes(v) -> int:
+    # ước lượng RAM của kết quả (bảng tổng hợp nhỏ => deep=True vẫn rẻ)
+    if isinstance(v, pd.DataFrame):
+        return int(v.memory_usage(index=True, deep=True).sum())
+    if isinstance(v, (pd.Series, pd.Index)):
+        return int(v.memory_usage(deep=True))
+    if isinstance(v, np.ndarray):
+        return int(v.nbytes)
+    if isinstance(v, dict):
+        return sys.getsizeof(v) + sum(_nbytes(x) for x in v.values())
+    if isinstance(v, (list, tuple)):
+        return sys.getsizeof(v) + sum(_nbytes(x) for x in v)
+    return sys.getsizeof(v)
+
+
+def _memo_drop(key, stat: str):
+    global _memo_bytes
+    _, nbytes, _ = _memo.pop(key)
+    _memo_bytes -= nbytes
+    _memo_stats[stat] += 1
+
+
+def _memo_get(key):
+    with _memo_lock:
+        entry = _memo.get(key)
+        if entry is not None and entry[2] < time.monotonic():
+            _memo_drop(key, "expired")
+            entry = None
+        if entry is None:
+            _memo_stats["misses"] += 1
+            return None
+        _memo.move_to_end(key)
+        _memo_stats["hits"] += 1
+        return entry
+
+
+def _memo_put(key, result):
+    global _memo_bytes
+    nbytes = _nbytes(result)
+    if nbytes > MEMO_MAX_BYTES:
+        return  # lớn hơn cả ngân sách => không giữ, lần sau tính lại
+
+    with _memo_lock:
+        old = _memo.pop(key, None)  # 2 phiên tính trùng cùng lúc => giữ bản sau
+        if old is not None:
+            _memo_bytes -= old[1]
+        _memo[key] = (result, nbytes, time.monotonic() + MEMO_TTL_SECONDS)
+        _memo_bytes += nbytes
+        while len(_memo) > MEMO_MAX_ENTRIES or _memo_bytes > MEMO_MAX_BYTES:
+            _memo_drop(next(iter(_memo)), "evictions")
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def single_flight(key, compute):
+    """
+    Gộp các lời gọi đồng thời cùng key thành 1 lần tính:
+    - phiên đến trước tính compute(), phiên đến sau chờ rồi dùng chung kết quả (hoặc lỗi)
+    - xong là bỏ khỏi _inflight => lần gọi sau (không đồng thời) tính lại / đọc memo như thường
+    """
+    with _inflight_lock:
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _inflight[key] = _Flight()
+
+    if not leader:
+        with _memo_lock:
+            _memo_stats["coalesced"] += 1
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = compute()
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        flight.done.set()
+    return flight.result
+
+
+def _memo_compute(key, func, args, kwargs):
+    result = func(*args, **kwargs)
+    _memo_put(key, result)
+    return result
+
+
+def memo_stats() -> dict:
+    """Số entry / RAM đang giữ + hit / miss / evict / hết hạn / gộp single-flight của memo dùng chung."""
+    with _memo_lock:
+        stats = dict(_memo_stats)
+        stats.update(entries=len(_memo), bytes=_memo_bytes, max_bytes=MEMO_MAX_BYTES)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / total if total else 0.0
+    return stats
+
+
+def memoize(func):
+    """
+    Memo kết quả theo (dataset_version(), hàm, tham số đã chuẩn hoá):
+    - tham số chỉ là bộ lọc / grain / cờ (không truyền DataFrame), hàm tự lấy view bên trong
+    - dùng chung giữa các phiên (version theo nội dung => không lẫn dataset): N người xem cùng view = 1 lần tính, 1 bản trong RAM
+    - miss đồng thời cùng key (vd. nhiều người mở dashboard khi file mới về) => single_flight, chỉ 1 phiên tính
+    - kết quả trả ra dùng chung => caller không sửa tại chỗ (copy trước khi thêm cột)
+    """
+    name = (func.__code__.co_filename, func.__qualname__)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (dataset_version(), name, _freeze(args), tuple(sorted((k, _freeze(v)) for k, v in kwargs.items())))
+        entry = _memo_get(key)
+        if entry is not None:
+            return entry[0]
+
+        return single_flight(key, lambda: _memo_compute(key, func, args, kwargs))
+
+    return wrapper
+
+
+# =====================================================
+# PROCESS POOL (offload tính nặng ra process riêng => dùng đủ core, không giữ GIL của server)
+# =====================================================
+# worker = subprocess "python offload_worker.py": không fork server đang chạy nhiều thread, không chạy lại script page;
+# task / kết quả pickle qua pipe stdin / stdout của worker (xem offload_worker.py)
+OFFLOAD_WORKERS = int(os.environ.get("OFFLOAD_WORKERS", min(4, os.cpu_count() or 1)))
+OFFLOAD_TIMEOUT_SECONDS = float(os.environ.get("OFFLOAD_TIMEOUT_SECONDS", 120))
+OFFLOAD_WORKER = os.path.join(BASE_DIR, "offload_worker.py")
+
+
+class OffloadTimeout(Exception):
+    """Task offload quá OFFLOAD_TIMEOUT_SECONDS (worker đã bị kill); page báo lỗi cho người dùng."""
+
+
+_idle_workers: list = []  # worker rảnh (subprocess.Popen), dùng lại cho task sau
+_idle_lock = threading.Lock()
+_worker_slots = threading.BoundedSemaphore(max(OFFLOAD_WORKERS, 1))
+
+
+def _spawn_worker() -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, OFFLOAD_WORKER], stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=BASE_DIR)
+
+
+def _expire(proc: subprocess.Popen, expired: threading.Event):
+    expired.set()
+    proc.kill()
+
+
+def _run_in_worker(func, args: tuple, timeout: float):
+    """
+    Chạy func(*args) trong 1 worker rảnh (mở mới nếu chưa có), chờ tối đa timeout giây:
+    - tối đa OFFLOAD_WORKERS task cùng lúc; thời gian chờ chỗ tính cả vào timeout
+    - quá hạn => kill worker (không giữ core), OffloadTimeout
+    - worker chết giữa chừng => OSError / EOFError; lỗi của func được raise lại nguyên kiểu
+    """
+    deadline = time.monotonic() + timeout
+    if not _worker_slots.acquire(timeout=timeout):
+        raise OffloadTimeout(f"Tính toán quá {timeout:.0f}s")
+    try:
+        with _idle_lock:
+            proc = _idle_workers.pop() if _idle_workers else None
+        if proc is None or proc.poll() is not None:
+            proc = _spawn_worker()
+
+        expired = threading.Event()
+        timer = threading.Timer(max(deadline - time.monotonic(), 0), _expire, (proc, expired))
+        timer.start()
+        try:
+            pickle.dump((func, args), proc.stdin, protocol=pickle.HIGHEST_PROTOCOL)
+            proc.stdin.flush()
+            status, result = pickle.load(proc.stdout)
+        except BaseException:
+            # worker chết / quá hạn / phiên bị dừng giữa chừng: bỏ worker này (pipe có thể còn kết quả dở)
+            proc.kill()
+            proc.wait()
+            if expired.is_set():
+                raise OffloadTimeout(f"Tính toán quá {timeout:.0f}s") from None
+            raise
+        finally:
+            timer.cancel()
+
+        with _idle_lock:
+            _idle_workers.append(proc)
+    finally:
+        _worker_slots.release()
+
+    if status == "error":
+        raise result
+    return result
+
+
+@atexit.register
+def _close_workers():
+    # server tắt: đóng stdin => worker tự thoát khỏi vòng đọc task
+    with _idle_lock:
+        procs, _idle_workers[:] = list(_idle_workers), []
+    for proc in procs:
+        proc.stdin.close()
+
+
+_published: dict = {}  # file -> fingerprint snapshot đã ghi
+_published_lock = threading.Lock()
+
+
+def _publish_table(name: str, fingerprint: str, build) -> str | None:
+    # bảng dẫn xuất ghi 1 lần / snapshot thành file Arrow IPC cạnh snapshot => worker memory-map, không dựng lại
+    file = f"{SNAPSHOT_FILE}.{name}"
+    with _published_lock:
+        if _published.get(file) == fingerprint:
+            return file
+        if _read_snapshot(fingerprint, file) is None:
+            table = pa.Table.from_pandas(build())
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"snapshot": fingerprint.encode()})
+            if not _write_snapshot(table, file):
+                return None
+        _published[file] = fingerprint
+        return file
+
+
+def _publish_tables(path: str, version) -> dict | None:
+    # {tên: file} của header chứng từ + bảng KH cho worker; None nếu không ghi được (thư mục chỉ đọc...)
+    fingerprint = (_snapshot_cached(path, version).schema.metadata or {}).get(b"snapshot", b"").decode()
+    files = {
+        "orders": _publish_table("orders", fingerprint, lambda: _orders_cached(path, version)),
+        "customers": _publish_table("customers", fingerprint, lambda: _customers_cached(path, version)),
+    }
+    return None if None in files.values() else {"fingerprint": fingerprint, **files}
+
+
+_mapped: dict = {}  # phía worker: file -> (fingerprint, DataFrame) bản map mới nhất
+
+
+def _mapped_table(file: str, fingerprint: str) -> pd.DataFrame:
+    hit = _mapped.get(file)
+    if hit is None or hit[0] != fingerprint:
+        table = _read_snapshot(fingerprint, file)
+        if table is None:
+            # server khác vừa ghi bản mới hơn => server gửi task tự chạy lại trong thread
+            raise FileNotFoundError(f"{file} không khớp snapshot")
+        hit = _mapped[file] = (fingerprint, table.to_pandas(split_blocks=True))
+    return hit[1]
+
+
+def _offload_run(func, files: dict, start_date, end_date, filters, args):
+    # phía worker: header / bảng KH map từ file server đã publish; lát ngày + isin (không cần index của server)
+    orders = _mapped_table(files["orders"], files["fingerprint"])
+    customers = _mapped_table(files["customers"], files["fingerprint"])
+    return func(_apply_view(orders, None, start_date, end_date, filters), customers, *args)
+
+
+def offload(func, start_date=None, end_date=None, filters: dict | None = None, *args):
+    """
+    Chạy task thuần func(view header, bảng KH, *args) (xem CRM TABLES) trong process worker:
+    - chỉ gửi (file đã publish, bộ lọc, tham số) => worker tự lát header của nó, trả về bảng nhỏ
+    - quá OFFLOAD_TIMEOUT_SECONDS => OffloadTimeout (worker bị kill, không giữ core); page bắt để báo lỗi
+    - dữ liệu upload (chỉ có trong phiên) / OFFLOAD_WORKERS = 0 / không publish được / worker chết => chạy ngay trong thread
+    """
+    uploaded = st.session_state.get("active_source", "default") != "default" and "active_df" in st.session_state
+    files = None if uploaded or OFFLOAD_WORKERS <= 0 else _publish_tables(*_default_key())
+    if files is not None:
+        try:
+            return _run_in_worker(_offload_run, (func, files, start_date, end_date, filters, args), OFFLOAD_TIMEOUT_SECONDS)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+    return func(orders_view(start_date, end_date, filters), get_customers(), *args)
+
+
+# =====================================================
+# SECTION RUNNER (các bảng độc lập của 1 page tính song song trong 1 lần rerun)
+# =====================================================
+SECTION_WORKERS = int(os.environ.get("SECTION_WORKERS", 4))
+
+_section_pool = ThreadPoolExecutor(max_workers=SECTION_WORKERS, thread_name_prefix="section")
+
+
+def _run_section(ctx, func, args):
+    # thread của pool không có context Streamlit => gắn context của phiên gọi (session_state, cache)
+    if ctx is not None:
+        add_script_run_ctx(threading.current_thread(), ctx)
+    return func(*args)
+
+
+def run_sections(tasks: dict):
+    """
+    Tính các section độc lập song song:
+    - tasks: {tên: (func, *args)}; func chỉ tính (thường là hàm @memoize), không vẽ UI
+    - yield (tên, kết quả) theo thứ tự xong trước => page vẽ vào container đã đặt sẵn
+    - pandas / pyarrow nhả GIL trong phần lớn kernel => thời gian cả page ~ section chậm nhất
+    - lỗi của 1 section được raise lại ở thread của page (như khi tính tuần tự)
+    """
+    ctx = get_script_run_ctx()
+    futures = {_section_pool.submit(_run_section, ctx, t[0], t[1:]): name for name, t in tasks.items()}
+    for future in as_completed(futures):
+        yield futures[future], future.result()
+
+
+def render_sections(tasks: dict, views: dict):
+    """
+    Tính tasks bằng run_sections rồi vẽ từng section ngay khi đủ kết quả nó cần (DAG 1 tầng):
+    - views: {tên section: (container, hàm vẽ, [tên task cần])}; hàm vẽ nhận kết quả theo thứ tự list
+    - section sẵn sàng cùng lúc => vẽ theo thứ tự khai báo trong views
+    """
+    results, pending = {}, dict(views)
+    for name, result in run_sections(tasks):
+        results[name] = result
+        for section, (box, show, needs) in list(pending.items()):
+            if all(n in results for n in needs):
+                del pending[section]
+                with box:
+                    show(*[results[n] for n in needs])
+
+
+# =====================================================
+# MEMORY PROFILE (đỉnh bộ nhớ cấp phát trong 1 lần rerun; bật bằng MEMORY_PROFILE=1)
+# =====================================================
+MEMORY_PROFILE = os.environ.get("MEMORY_PROFILE", "") == "1"
+
+
+def rerun_memory_start():
+    """Đầu page: mốc đo; tracemalloc thấy mọi cấp phát numpy / pandas (cả thread section)."""
+    if not MEMORY_PROFILE:
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    st.session_state["_rerun_memory_base"] = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+
+
+def rerun_memory_peak() -> dict | None:
+    """
+    Cuối page: {"peak": byte cấp phát thêm ở đỉnh của lần rerun, "dataset": byte của dataset đang dùng}
+    - None nếu MEMORY_PROFILE tắt
+    - đỉnh đo chung cả process => nhiều phiên chạy cùng lúc sẽ cộng dồn
+    """
+    if not MEMORY_PROFILE or not tracemalloc.is_tracing():
+        return None
+    peak = tracemalloc.get_traced_memory()[1] - st.session_state.get("_rerun_memory_base", 0)
+    if st.session_state.get("active_source", "default") != "default" and "active_df" in st.session_state:
+        dataset = int(st.session_state["active_df"].memory_usage(deep=True).sum())
+    else:
+        dataset = int(_snapshot_cached(*_default_key()).nbytes)  # memory-map, dùng chung mọi phiên
+    return {"peak": max(peak, 0), "dataset": dataset}
+
+
+# =====================================================
+# INGEST (nạp lô dữ liệu mới: bỏ trùng theo watermark, ghi file delta, nối snapshot)
+# =====================================================
+def _row_hash(df: pd.DataFrame, columns) -> np.ndarray:
+    # định danh dòng = mọi cột nguồn (Số_CT + phần còn lại của dòng; dữ liệu không có cột số dòng)
+    # cột category hash theo giá trị (không theo mã) => so được giữa lô mới và snapshot khác từ điển
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+
+# nạp từ sidebar ghi thẳng vào dữ liệu dùng chung (mọi phiên / replica, không undo) => tắt mặc định,
+# chỉ bật UI_INGEST=1 trên instance quản trị; đường chuẩn: python load_data.py ingest ...
+UI_INGEST = os.environ.get("UI_INGEST", "") == "1"
+
+
+def ingest_delta(df: pd.DataFrame) -> dict:
+    """
+    Nạp 1 lô dữ liệu mới (vd. file parquet tuần) vào dataset mặc định:
+    - watermark = Ngày lớn nhất đã có; dòng sau watermark chắc chắn mới, dòng trễ chỉ so trùng với phần cũ
+      từ ngày nhỏ nhất của lô (date_slice), không quét cả bảng; bỏ cả dòng trùng trong chính lô
+    - lô sai cột / kiểu => ValueError, chưa ghi gì
+    - phần còn lại ghi thành 1 file trong DELTA_DIR rồi publish_snapshot => snapshot / bảng dẫn xuất
+      chỉ xử lý phần mới (xem _extend_snapshot, INCREMENTAL)
+    - trả thống kê {"rows", "invalid", "late", "duplicates", "added", "watermark", "file"}
+    """
+    path = _data_source()
+    if path is None:
+        raise ValueError(f"không thấy file dữ liệu: {PARQUET_FILE}")
+    version = _stat_source_version(path)
+    stored = publish_snapshot(path, version)
+    columns = [c for c in stored.column_names if c not in KEY_COLS.values()]
+
+    delta = _coerce(df.copy(deep=False))
+    new, _ = append_normalized(stored.slice(0, 0).to_pandas(), delta)  # kiểm cột / kiểu + cùng dtype với bảng cũ
+    dates = pd.DataFrame({"Ngày": stored.column("Ngày").to_pandas()})
+    watermark = dates["Ngày"].iloc[-1] if len(dates) else None
+
+    hashes = _row_hash(new, columns)
+    keep = ~pd.Series(hashes).duplicated().to_numpy()
+    late = np.zeros(len(new), dtype=bool) if watermark is None else (new["Ngày"] <= watermark).to_numpy()
+    if late.any():
+        rows = date_slice(dates, new["Ngày"].min(), watermark)
+        old = stored.slice(rows.start, rows.stop - rows.start).select(columns).to_pandas()
+        keep[late] &= ~np.isin(hashes[late], _row_hash(old, columns))
+
+    stats = {
+        "rows": len(df),
+        "invalid": len(df) - len(delta),
+        "late": int(late.sum()),
+        "duplicates": int(len(delta) - keep.sum()),
+        "added": int(keep.sum()),
+        "watermark": watermark,
+        "file": None,
+    }
+    if not keep.any():
+        return stats
+
+    os.makedirs(DELTA_DIR, exist_ok=True)
+    name = os.path.join(DELTA_DIR, datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f") + ".parquet")
+    lock = _build_lock()
+    try:
+        # lô khác nạp chen giữa lúc so trùng => watermark / phần so trùng đã cũ
+        if _stat_source_version(path) != version:
+            raise ValueError("dữ liệu vừa được cập nhật bởi lần nạp khác, hãy nạp lại")
+        delta.loc[keep, columns].to_parquet(f"{name}.tmp", index=False)
+        os.replace(f"{name}.tmp", name)
+    finally:
+        lock.close()
+
+    with _source_versions_lock:
+        _source_versions.pop(path, None)  # process nạp thấy dữ liệu mới ngay, không chờ TTL
+    publish_snapshot(path, _source_version(path))
+    stats["file"] = name
+    return stats
+
+
+# =====================================================
+# PUBLISH (process loader: python load_data.py => build snapshot trước khi bật các replica)
+# python load_data.py ingest tuan_moi.parquet ... => nạp thêm từng file rồi publish
+# =====================================================
+if __name__ == "__main__":
+    source = _data_source()
+    if source is None:
+        sys.exit(f"Không thấy file dữ liệu: {PARQUET_FILE}")
+    if sys.argv[1:2] == ["ingest"]:
+        for f in sys.argv[2:]:
+            stats = ingest_delta(pd.read_parquet(f))
+            print(f"{f}: +{stats['added']:,} dòng (trùng {stats['duplicates']:,}, trễ {stats['late']:,}, lỗi Ngày {stats['invalid']:,})")
+    published = publish_snapshot(source, _source_version(source))
+    print(f"{SNAPSHOT_FILE}: {published.num_rows:,} dòng, {published.nbytes / 2**20:,.1f} MB")
@@ -0,0 +1,35 @@
+# offload_worker.py
+# Process worker của PROCESS POOL (xem load_data._run_in_worker), chạy bằng "python offload_worker.py".
+# Đọc task (func, args) pickle từ stdin, ghi ("ok", kết quả) / ("error", exception) ra stdout; hết stdin => thoát.
+import os
+import pickle
+import sys
+
+
+def main():
+    # stdout chỉ dành cho kết quả: print / log (kể cả từ thư viện C) chuyển sang stderr
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    import load_data  # noqa: F401  import nặng 1 lần / worker, các task sau dùng luôn
+
+    while True:
+        try:
+            func, args = pickle.load(sys.stdin.buffer)
+        except EOFError:
+            return
+        try:
+            reply = ("ok", func(*args))
+        except Exception as e:
+            reply = ("error", e)
+        try:
+            data = pickle.dumps(reply, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            data = pickle.dumps(("error", RuntimeError(f"không gửi được kết quả: {e!r}")))
+        out.write(data)
+        out.flush()
+
+
+if __name__ == "__main__":
+    main()
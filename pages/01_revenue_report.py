@@ -4,7 +4,10 @@ import numpy as np
 import streamlit as st
 import plotly.express as px
 
-from load_data import get_active_data
+from load_data import (
+    load_view, cube_view, orders_view, cube_agg, get_catalog, cascade_options, calendar_keys, period_cols,
+    period_labels, memoize, render_sections, rerun_memory_start, rerun_memory_peak, KEY_COLS, HLL_ERROR,
+)
 
 # =====================================================
 # FORMAT HELPERS
@@ -29,35 +32,20 @@ def fmt_pct(x, decimals=2, with_sign=False):
     except Exception:
         return ""
 
-def ensure_datetime(df: pd.DataFrame) -> pd.DataFrame:
-    if "Ngày" in df.columns:
-        df["Ngày"] = pd.to_datetime(df["Ngày"], errors="coerce")
-        df = df.dropna(subset=["Ngày"])
-    return df
-
-def fix_numeric(df: pd.DataFrame) -> pd.DataFrame:
-    for c in ["Tổng_Gross", "Tổng_Net"]:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce")
-    return df
-
 def show_df(df_show: pd.DataFrame, title=None):
     if title:
         st.subheader(title)
     st.dataframe(df_show, use_container_width=True, hide_index=True)
 
 # =====================================================
-# WEEK HELPERS (TUẦN BẮT ĐẦU THEO THỨ - RIÊNG REVENUE)
+# WEEK START (TUẦN BẮT ĐẦU THEO THỨ - RIÊNG REVENUE)
 # =====================================================
+# năm / tuần ISO theo thứ bắt đầu lấy từ calendar chung (Week_year_{ws} / Week_{ws})
 WEEKDAY_MAP = {
     "Thứ 2": 0, "Thứ 3": 1, "Thứ 4": 2, "Thứ 5": 3,
     "Thứ 6": 4, "Thứ 7": 5, "Chủ nhật": 6
 }
 
-def week_anchor(dt: pd.Series, week_start: int) -> pd.Series:
-    d = pd.to_datetime(dt)
-    return (d - pd.to_timedelta((d.dt.weekday - week_start) % 7, unit="D")).dt.normalize()
-
 # =====================================================
 # FILTER HELPERS
 # =====================================================
@@ -93,17 +81,18 @@ def ms_all(key: str, label: str, options, all_label="All", default_all=True):
 # =====================================================
 st.set_page_config(page_title="📈 Báo cáo Doanh thu", layout="wide")
 st.title("📈 Báo cáo Doanh thu")
+rerun_memory_start()
 
 # =====================================================
-# LOAD
+# LOAD (sidebar đọc catalog chiều; bảng fact đọc sau theo bộ lọc)
 # =====================================================
-df = get_active_data()
-st.sidebar.caption("🔎 Đang dùng nguồn: **{}**".format(st.session_state.get("active_source", "default")))
+SIDEBAR_COLUMNS = ["Ngày", "LoaiCT", "Brand", "Region", "Điểm_mua_hàng", "Trạng_thái_số_điện_thoại", "Kiểm_tra_tên"]
+REV_COLUMNS = SIDEBAR_COLUMNS + ["Tổng_Gross", "Tổng_Net", "Số_điện_thoại", "Số_CT"]
 
-df = ensure_datetime(df)
-df = fix_numeric(df)
+catalog = get_catalog()
+st.sidebar.caption("🔎 Đang dùng nguồn: **{}**".format(st.session_state.get("active_source", "default")))
 
-if df.empty:
+if catalog["date_min"] is None:
     st.warning("⚠ Không có dữ liệu để phân tích.")
     st.stop()
 
@@ -135,124 +124,129 @@ with st.sidebar:
 
     start_date = st.date_input(
         "Từ ngày",
-        df["Ngày"].min().date(),
+        catalog["date_min"].date(),
         key=REV_PREFIX + "start_date",
     )
     end_date = st.date_input(
         "Đến ngày",
-        df["Ngày"].max().date(),
+        catalog["date_max"].date(),
         key=REV_PREFIX + "end_date",
     )
 
     loaict_filter = ms_all(
         key=REV_PREFIX + "loaict",
         label="LoaiCT",
-        options=df["LoaiCT"] if "LoaiCT" in df.columns else [],
+        options=catalog["options"].get("LoaiCT", []),
     )
 
     brand_filter = ms_all(
         key=REV_PREFIX + "brand",
         label="Brand",
-        options=df["Brand"] if "Brand" in df.columns else [],
+        options=catalog["options"].get("Brand", []),
     )
 
-    df_b = df[df["Brand"].isin(brand_filter)] if (brand_filter and "Brand" in df.columns) else df.iloc[0:0]
     region_filter = ms_all(
         key=REV_PREFIX + "region",
         label="Region",
-        options=df_b["Region"] if "Region" in df_b.columns else [],
+        options=cascade_options(catalog, "Region", {"Brand": brand_filter}),
     )
 
-    df_br = df_b[df_b["Region"].isin(region_filter)] if (region_filter and "Region" in df_b.columns) else df_b.iloc[0:0]
     store_filter = ms_all(
         key=REV_PREFIX + "store",
         label="Điểm mua hàng",
-        options=df_br["Điểm_mua_hàng"] if "Điểm_mua_hàng" in df_br.columns else [],
+        options=cascade_options(catalog, "Điểm_mua_hàng", {"Brand": brand_filter, "Region": region_filter}),
     )
 
     checksdt_filter = ms_all(
         key=REV_PREFIX + "checksdt",
         label="Trạng_thái_số_điện_thoại",
-        options=df["Trạng_thái_số_điện_thoại"] if "Trạng_thái_số_điện_thoại" in df.columns else [],
+        options=catalog["options"].get("Trạng_thái_số_điện_thoại", []),
     )
 
     checkten_filter = ms_all(
         key=REV_PREFIX + "checkten",
         label="Kiểm_tra_tên",
-        options=df["Kiểm_tra_tên"] if "Kiểm_tra_tên" in df.columns else [],
+        options=catalog["options"].get("Kiểm_tra_tên", []),
+    )
+
+    approx = st.checkbox(
+        "⚡ Đếm KH/đơn xấp xỉ (nhanh hơn)",
+        value=False,
+        key=REV_PREFIX + "approx",
+        help=f"Đếm distinct bằng HyperLogLog trên cube ngày, sai số chuẩn ~{HLL_ERROR:.1%}, 99.7% trường hợp trong ±{3 * HLL_ERROR:.1%}",
     )
 
 # =====================================================
 # APPLY FILTER
 # =====================================================
-mask = (df["Ngày"] >= pd.to_datetime(start_date)) & (df["Ngày"] <= pd.to_datetime(end_date))
-
-if "LoaiCT" in df.columns:
-    mask &= df["LoaiCT"].isin(loaict_filter if loaict_filter else [])
-if "Brand" in df.columns:
-    mask &= df["Brand"].isin(brand_filter if brand_filter else [])
-if "Region" in df.columns:
-    mask &= df["Region"].isin(region_filter if region_filter else [])
-if "Điểm_mua_hàng" in df.columns:
-    mask &= df["Điểm_mua_hàng"].isin(store_filter if store_filter else [])
-if "Trạng_thái_số_điện_thoại" in df.columns:
-    mask &= df["Trạng_thái_số_điện_thoại"].isin(checksdt_filter if checksdt_filter else [])
-if "Kiểm_tra_tên" in df.columns:
-    mask &= df["Kiểm_tra_tên"].isin(checkten_filter if checkten_filter else [])
-
-df_filtered = df.loc[mask].copy()
-
-if df_filtered.empty:
+rev_filters = {
+    "LoaiCT": loaict_filter if loaict_filter else [],
+    "Brand": brand_filter if brand_filter else [],
+    "Region": region_filter if region_filter else [],
+    "Điểm_mua_hàng": store_filter if store_filter else [],
+    "Trạng_thái_số_điện_thoại": checksdt_filter if checksdt_filter else [],
+    "Kiểm_tra_tên": checkten_filter if checkten_filter else [],
+}
+
+# kiểm tra rỗng trên cube ngày (cùng bộ lọc, memo) => không decode bảng dòng hàng mỗi lần rerun
+if cube_view(start_date=start_date, end_date=end_date, filters=rev_filters).empty:
     st.warning("⚠ Không có dữ liệu sau khi áp bộ lọc.")
     st.stop()
 
+# Tổng_Gross/Tổng_Net lấy từ cube ngày (cùng bộ lọc); đếm KH / đơn trên header chứng từ
+# các bảng dưới memo theo (version dataset, bộ lọc, grain) => quay lại bộ lọc cũ trả kết quả ngay
+def rev_views(start_date, end_date, filters):
+    df_cube = cube_view(start_date=start_date, end_date=end_date, filters=filters)
+    df_orders = orders_view(start_date=start_date, end_date=end_date, filters=filters)
+    return df_cube, df_orders
+
+SUM_AGG = {"Tổng_Gross": "Tổng_Gross", "Tổng_Net": "Tổng_Net"}
+DISTINCT_AGG = {"Số_KH": "KH_key", "Số_đơn_hàng": "CT_key"}
+
+if approx:
+    st.caption(f"⚡ Số_KH / Số_đơn_hàng là số ước lượng (HyperLogLog, sai số chuẩn ~{HLL_ERROR:.1%}, 99.7% trường hợp trong ±{3 * HLL_ERROR:.1%}).")
+
 # =====================================================
 # HELPER: TIME KEY (TUẦN THEO THỨ TUỲ CHỌN RIÊNG REVENUE)
 # =====================================================
-def add_time_key(df_in: pd.DataFrame, grain: str):
-    df_out = df_in.copy()
+def add_time_key(df_in: pd.DataFrame, grain: str, week_start: int):
+    df_out = df_in.copy(deep=False)  # copy-on-write: chỉ thêm cột Key / Year, không copy dữ liệu
 
     if grain == "Ngày":
-        df_out["Key"] = df_out["Ngày"].dt.date
-        df_out["Year"] = df_out["Ngày"].dt.year
+        keys = calendar_keys(df_out["Ngày"], ["Date", "Year"])
+        df_out["Key"] = keys["Date"]
+        df_out["Year"] = keys["Year"]
         group_cols = ["Key"]
 
     else:
-        if grain == "Tuần":
-            df_out["_WeekAnchor"] = week_anchor(df_out["Ngày"], REV_WEEK_START)
-            iso = df_out["_WeekAnchor"].dt.isocalendar()
-            df_out["Year"] = iso["year"].astype(int)
-            df_out["Key"] = iso["week"].astype(int)
-        elif grain == "Tháng":
-            df_out["Year"] = df_out["Ngày"].dt.year
-            df_out["Key"] = df_out["Ngày"].dt.month.astype(int)
-        elif grain == "Quý":
-            df_out["Year"] = df_out["Ngày"].dt.year
-            df_out["Key"] = df_out["Ngày"].dt.quarter.astype(int)
-
+        ycol, kcol, _ = period_cols(grain, week_start)
+        keys = calendar_keys(df_out["Ngày"], [ycol, kcol])
+        df_out["Year"] = keys[ycol]
+        df_out["Key"] = keys[kcol]
         group_cols = ["Year", "Key"]
 
     return df_out, group_cols
 
+def period_label(df_in: pd.DataFrame, grain: str) -> pd.Series:
+    # nhãn kỳ cho bảng đã gộp: Ngày => strftime trên Key; còn lại join (Year, Key) với calendar
+    if grain == "Ngày":
+        return pd.to_datetime(df_in["Key"], errors="coerce").dt.strftime("%Y-%m-%d")
+    idx = pd.MultiIndex.from_arrays([df_in["Year"].astype(int), df_in["Key"].astype(int)])
+    return pd.Series(period_labels(grain, REV_WEEK_START).reindex(idx).to_numpy(), index=df_in.index)
+
 # =====================================================
 # SUMMARY TABLE
 # =====================================================
-def summarize_revenue(df_in: pd.DataFrame, grain: str) -> pd.DataFrame:
+@memoize
+def summarize_revenue(start_date, end_date, filters, grain: str, week_start: int, approx: bool) -> pd.DataFrame:
+    df_sum, df_in = rev_views(start_date, end_date, filters)
     if df_in.empty:
         return pd.DataFrame()
 
-    df_tmp, group_cols = add_time_key(df_in, grain)
+    df_tmp, group_cols = add_time_key(df_in, grain, week_start)
+    df_tmp_sum, _ = add_time_key(df_sum, grain, week_start)
 
-    summary = (
-        df_tmp.groupby(group_cols)
-        .agg(
-            Tổng_Gross=("Tổng_Gross", "sum"),
-            Tổng_Net=("Tổng_Net", "sum"),
-            Số_KH=("Số_điện_thoại", "nunique"),
-            Số_đơn_hàng=("Số_CT", "nunique"),
-        )
-        .reset_index()
-    )
+    summary = cube_agg(df_tmp, df_tmp_sum, group_cols, SUM_AGG, DISTINCT_AGG, approx=approx)
 
     summary["Tỷ_lệ_CK (%)"] = (100 * (1 - summary["Tổng_Net"] / summary["Tổng_Gross"])).where(
         summary["Tổng_Gross"] != 0, 0
@@ -273,24 +267,32 @@ def summarize_revenue(df_in: pd.DataFrame, grain: str) -> pd.DataFrame:
 # =====================================================
 # TOP/BOTTOM STORE
 # =====================================================
-def top_bottom_store(df_in: pd.DataFrame, grain: str, top: bool = True, year=None, key=None) -> pd.DataFrame:
+@memoize
+def store_periods(start_date, end_date, filters, grain: str, week_start: int) -> pd.DataFrame:
+    # Net / CK / % đổi so kỳ trước của mọi (Cửa hàng, kỳ) => đổi kỳ / Top-Bottom chỉ chọn lại dòng
+    df_in, _ = rev_views(start_date, end_date, filters)
     if df_in.empty:
         return pd.DataFrame()
 
-    df_store, group_cols = add_time_key(df_in, grain)
+    df_store, group_cols = add_time_key(df_in, grain, week_start)
     group_cols_store = ["Điểm_mua_hàng"] + group_cols
 
-    grouped = df_store.groupby(group_cols_store, as_index=False)[["Tổng_Gross", "Tổng_Net"]].sum()
+    grouped = df_store.groupby(group_cols_store, as_index=False, observed=True)[["Tổng_Gross", "Tổng_Net"]].sum()
 
     grouped["Tỷ_lệ_CK (%)"] = (100 * (1 - grouped["Tổng_Net"] / grouped["Tổng_Gross"])).where(
         grouped["Tổng_Gross"] != 0, 0
     )
 
     grouped = grouped.sort_values(["Điểm_mua_hàng"] + group_cols)
-    grouped["Prev"] = grouped.groupby("Điểm_mua_hàng")["Tổng_Net"].shift(1)
+    grouped["Prev"] = grouped.groupby("Điểm_mua_hàng", observed=True)["Tổng_Net"].shift(1)
     grouped["Change%"] = ((grouped["Tổng_Net"] - grouped["Prev"]) / grouped["Prev"] * 100).where(
         grouped["Prev"].notna() & (grouped["Prev"] != 0)
     )
+    return grouped
+
+def top_bottom_store(grouped: pd.DataFrame, grain: str, top: bool = True, year=None, key=None) -> pd.DataFrame:
+    if grouped.empty:
+        return pd.DataFrame()
 
     if grain == "Ngày":
         sel_key = key if key is not None else grouped["Key"].max()
@@ -304,196 +306,145 @@ def top_bottom_store(df_in: pd.DataFrame, grain: str, top: bool = True, year=Non
             sel_key = key
         mask2 = (grouped["Year"] == sel_year) & (grouped["Key"] == sel_key)
 
-    out = grouped.loc[mask2].copy()
-    out = out.sort_values("Tổng_Net", ascending=not top).head(10)
+    out = grouped.loc[mask2].sort_values("Tổng_Net", ascending=not top).head(10)
     return out
 
 # =====================================================
 # VIEW RAW
 # =====================================================
 with st.expander("📑 Xem dữ liệu đã lọc (mở/đóng)", expanded=False):
-    st.dataframe(df_filtered, use_container_width=True)
+    # thân expander chạy cả khi đang đóng => chỉ đọc bảng dòng hàng khi người dùng bật
+    if st.toggle("Tải dữ liệu chi tiết", key=REV_PREFIX + "show_raw"):
+        df_filtered = load_view(columns=REV_COLUMNS, start_date=start_date, end_date=end_date, filters=rev_filters)
+        st.dataframe(df_filtered.drop(columns=list(KEY_COLS.values()), errors="ignore"), use_container_width=True)
 
 # =====================================================
 # SUMMARY DISPLAY + CHART
 # =====================================================
-st.subheader("📊 Tổng hợp doanh thu")
-df_summary = summarize_revenue(df_filtered, time_grain)
-
-if df_summary.empty:
-    st.info("Không có dữ liệu sau khi lọc.")
-    st.stop()
-
-df_summary_show = df_summary.copy()
-
-if time_grain == "Ngày":
-    df_summary_show["Kỳ"] = pd.to_datetime(df_summary_show["Key"], errors="coerce").dt.strftime("%Y-%m-%d")
-else:
-    if time_grain == "Tuần":
-        df_summary_show["Kỳ"] = df_summary_show.apply(lambda r: f"Tuần {int(r['Key']):02d}/{int(r['Year'])}", axis=1)
-    elif time_grain == "Tháng":
-        df_summary_show["Kỳ"] = df_summary_show.apply(lambda r: f"{int(r['Year'])}-{int(r['Key']):02d}", axis=1)
-    else:
-        df_summary_show["Kỳ"] = df_summary_show.apply(lambda r: f"Q{int(r['Key'])} {int(r['Year'])}", axis=1)
-
-for c in [
-    "Tổng_Gross", "Tổng_Net", "Số_KH", "Số_đơn_hàng",
-    "Prev_Tổng_Gross", "Prev_Tổng_Net", "Prev_Số_KH", "Prev_Số_đơn_hàng"
-]:
-    if c in df_summary_show.columns:
-        df_summary_show[c] = df_summary_show[c].apply(fmt_int)
-
-for c in [
-    "Tỷ_lệ_CK (%)",
-    "%_So_sánh_Tổng_Gross", "%_So_sánh_Tổng_Net", "%_So_sánh_Số_KH", "%_So_sánh_Số_đơn_hàng"
-]:
-    if c in df_summary_show.columns:
-        df_summary_show[c] = df_summary_show[c].apply(lambda v: fmt_pct(v, 2, with_sign=c.startswith("%_So_sánh")))
-
-show_cols = ["Kỳ"]
-for c in ["Tổng_Gross", "Tổng_Net", "Số_KH", "Số_đơn_hàng", "Tỷ_lệ_CK (%)", "Prev_Tổng_Net", "%_So_sánh_Tổng_Net"]:
-    if c in df_summary_show.columns:
-        show_cols.append(c)
-
-show_df(df_summary_show[show_cols], title=None)
-
-fig = px.line(
-    df_summary,
-    x="Key",
-    y=["Tổng_Gross", "Tổng_Net"],
-    markers=True,
-    title=f"Doanh thu theo {time_grain}",
-)
-st.plotly_chart(fig, use_container_width=True)
+summary_box = st.container()
+
+def show_summary(df_summary: pd.DataFrame):
+    st.subheader("📊 Tổng hợp doanh thu")
+
+    if df_summary.empty:
+        st.info("Không có dữ liệu sau khi lọc.")
+        st.stop()
+
+    df_summary_show = df_summary.copy(deep=False)
+
+    df_summary_show["Kỳ"] = period_label(df_summary_show, time_grain)
+
+    for c in [
+        "Tổng_Gross", "Tổng_Net", "Số_KH", "Số_đơn_hàng",
+        "Prev_Tổng_Gross", "Prev_Tổng_Net", "Prev_Số_KH", "Prev_Số_đơn_hàng"
+    ]:
+        if c in df_summary_show.columns:
+            df_summary_show[c] = df_summary_show[c].apply(fmt_int)
+
+    for c in [
+        "Tỷ_lệ_CK (%)",
+        "%_So_sánh_Tổng_Gross", "%_So_sánh_Tổng_Net", "%_So_sánh_Số_KH", "%_So_sánh_Số_đơn_hàng"
+    ]:
+        if c in df_summary_show.columns:
+            df_summary_show[c] = df_summary_show[c].apply(lambda v: fmt_pct(v, 2, with_sign=c.startswith("%_So_sánh")))
+
+    show_cols = ["Kỳ"]
+    for c in ["Tổng_Gross", "Tổng_Net", "Số_KH", "Số_đơn_hàng", "Tỷ_lệ_CK (%)", "Prev_Tổng_Net", "%_So_sánh_Tổng_Net"]:
+        if c in df_summary_show.columns:
+            show_cols.append(c)
+
+    show_df(df_summary_show[show_cols], title=None)
+
+    fig = px.line(
+        df_summary,
+        x="Key",
+        y=["Tổng_Gross", "Tổng_Net"],
+        markers=True,
+        title=f"Doanh thu theo {time_grain}",
+    )
+    st.plotly_chart(fig, use_container_width=True)
 
 # =====================================================
-# REGION REPORT + CHỌN KỲ
+# REGION REPORT + CHỌN KỲ (FRAGMENT: đổi kỳ chỉ chạy lại bảng Region trên kết quả đã tính)
 # =====================================================
-st.subheader("🌍 Doanh thu theo Region")
-
-df_region, group_cols = add_time_key(df_filtered, time_grain)
-group_cols_region = ["Region"] + group_cols
-
-grouped_region = (
-    df_region.groupby(group_cols_region, as_index=False)
-    .agg(
-        Tổng_Gross=("Tổng_Gross", "sum"),
-        Tổng_Net=("Tổng_Net", "sum"),
-        Số_KH=("Số_điện_thoại", "nunique"),
-        Số_đơn_hàng=("Số_CT", "nunique"),
-    )
-)
+region_box = st.container()
 
-grouped_region["Tỷ_lệ_CK (%)"] = (100 * (1 - grouped_region["Tổng_Net"] / grouped_region["Tổng_Gross"])).where(
-    grouped_region["Tổng_Gross"] != 0, 0
-)
-
-grouped_region = grouped_region.sort_values(["Region"] + group_cols)
-for col in ["Tổng_Gross", "Tổng_Net", "Số_KH", "Số_đơn_hàng"]:
-    prev_col = f"Prev_{col}"
-    pct_col = f"%_So_sánh_{col}"
-    grouped_region[prev_col] = grouped_region.groupby("Region")[col].shift(1)
-    grouped_region[pct_col] = ((grouped_region[col] - grouped_region[prev_col]) / grouped_region[prev_col] * 100).where(
-        grouped_region[prev_col].notna() & (grouped_region[prev_col] != 0)
-    )
+@memoize
+def summarize_region(start_date, end_date, filters, grain: str, week_start: int, approx: bool) -> pd.DataFrame:
+    df_cube, df_orders = rev_views(start_date, end_date, filters)
+    df_region, group_cols = add_time_key(df_orders, grain, week_start)
+    df_region_sum, _ = add_time_key(df_cube, grain, week_start)
+    group_cols_region = ["Region"] + group_cols
 
-st.markdown("### 🔍 Chọn kỳ để xem bảng Region")
+    grouped = cube_agg(df_region, df_region_sum, group_cols_region, SUM_AGG, DISTINCT_AGG, approx=approx)
 
-if time_grain == "Ngày":
-    periods = df_summary[["Key"]].drop_duplicates().sort_values("Key").copy()
-    periods["label"] = pd.to_datetime(periods["Key"], errors="coerce").dt.strftime("%Y-%m-%d")
-    sel_label = st.selectbox("Kỳ (Ngày)", periods["label"].tolist(), index=len(periods) - 1, key=REV_PREFIX + "region_period")
-    sel_key = periods.loc[periods["label"] == sel_label, "Key"].iloc[0]
-    region_mask = grouped_region["Key"] == sel_key
-else:
-    periods = df_summary[["Year", "Key"]].drop_duplicates().sort_values(["Year", "Key"]).copy()
-    if time_grain == "Tuần":
-        periods["label"] = periods.apply(lambda r: f"Tuần {int(r['Key']):02d}/{int(r['Year'])}", axis=1)
-    elif time_grain == "Tháng":
-        periods["label"] = periods.apply(lambda r: f"{int(r['Year'])}-{int(r['Key']):02d}", axis=1)
-    else:
-        periods["label"] = periods.apply(lambda r: f"Q{int(r['Key'])} {int(r['Year'])}", axis=1)
+    grouped["Tỷ_lệ_CK (%)"] = (100 * (1 - grouped["Tổng_Net"] / grouped["Tổng_Gross"])).where(
+        grouped["Tổng_Gross"] != 0, 0
+    )
 
-    sel_label = st.selectbox("Kỳ", periods["label"].tolist(), index=len(periods) - 1, key=REV_PREFIX + "region_period")
-    row = periods.loc[periods["label"] == sel_label].iloc[0]
-    sel_year = int(row["Year"])
-    sel_key = int(row["Key"])
-    region_mask = (grouped_region["Year"] == sel_year) & (grouped_region["Key"] == sel_key)
+    grouped = grouped.sort_values(group_cols_region)
+    for col in ["Tổng_Gross", "Tổng_Net", "Số_KH", "Số_đơn_hàng"]:
+        prev_col = f"Prev_{col}"
+        pct_col = f"%_So_sánh_{col}"
+        grouped[prev_col] = grouped.groupby("Region", observed=True)[col].shift(1)
+        grouped[pct_col] = ((grouped[col] - grouped[prev_col]) / grouped[prev_col] * 100).where(
+            grouped[prev_col].notna() & (grouped[prev_col] != 0)
+        )
+    return grouped
 
-df_region_view = grouped_region.loc[region_mask].copy().sort_values("Tổng_Net", ascending=False)
+@st.fragment
+def show_region(df_summary: pd.DataFrame, grouped_region: pd.DataFrame):
+    st.subheader("🌍 Doanh thu theo Region")
+    st.markdown("### 🔍 Chọn kỳ để xem bảng Region")
 
-df_region_show = df_region_view.copy()
-if time_grain == "Ngày":
-    df_region_show["Kỳ"] = pd.to_datetime(df_region_show["Key"], errors="coerce").dt.strftime("%Y-%m-%d")
-else:
-    if time_grain == "Tuần":
-        df_region_show["Kỳ"] = df_region_show.apply(lambda r: f"Tuần {int(r['Key']):02d}/{int(r['Year'])}", axis=1)
-    elif time_grain == "Tháng":
-        df_region_show["Kỳ"] = df_region_show.apply(lambda r: f"{int(r['Year'])}-{int(r['Key']):02d}", axis=1)
+    if time_grain == "Ngày":
+        periods = df_summary[["Key"]].drop_duplicates().sort_values("Key")
+        periods["label"] = pd.to_datetime(periods["Key"], errors="coerce").dt.strftime("%Y-%m-%d")
+        sel_label = st.selectbox("Kỳ (Ngày)", periods["label"].tolist(), index=len(periods) - 1, key=REV_PREFIX + "region_period")
+        sel_key = periods.loc[periods["label"] == sel_label, "Key"].iloc[0]
+        region_mask = grouped_region["Key"] == sel_key
     else:
-        df_region_show["Kỳ"] = df_region_show.apply(lambda r: f"Q{int(r['Key'])} {int(r['Year'])}", axis=1)
-
-for c in [
-    "Tổng_Gross", "Tổng_Net", "Số_KH", "Số_đơn_hàng",
-    "Prev_Tổng_Gross", "Prev_Tổng_Net", "Prev_Số_KH", "Prev_Số_đơn_hàng"
-]:
-    if c in df_region_show.columns:
-        df_region_show[c] = df_region_show[c].apply(fmt_int)
-
-for c in ["Tỷ_lệ_CK (%)", "%_So_sánh_Tổng_Gross", "%_So_sánh_Tổng_Net", "%_So_sánh_Số_KH", "%_So_sánh_Số_đơn_hàng"]:
-    if c in df_region_show.columns:
-        df_region_show[c] = df_region_show[c].apply(lambda v: fmt_pct(v, 2, with_sign=c.startswith("%_So_sánh")))
-
-region_cols = [
-    "Kỳ", "Region", "Tổng_Gross", "Tổng_Net", "Số_KH", "Số_đơn_hàng",
-    "Tỷ_lệ_CK (%)", "Prev_Tổng_Net", "%_So_sánh_Tổng_Net"
-]
-region_cols = [c for c in region_cols if c in df_region_show.columns]
-show_df(df_region_show[region_cols], title=None)
+        periods = df_summary[["Year", "Key"]].drop_duplicates().sort_values(["Year", "Key"])
+        periods["label"] = period_label(periods, time_grain)
+
+        sel_label = st.selectbox("Kỳ", periods["label"].tolist(), index=len(periods) - 1, key=REV_PREFIX + "region_period")
+        row = periods.loc[periods["label"] == sel_label].iloc[0]
+        sel_year = int(row["Year"])
+        sel_key = int(row["Key"])
+        region_mask = (grouped_region["Year"] == sel_year) & (grouped_region["Key"] == sel_key)
+
+    df_region_show = grouped_region.loc[region_mask].sort_values("Tổng_Net", ascending=False)
+    df_region_show["Kỳ"] = period_label(df_region_show, time_grain)
+
+    for c in [
+        "Tổng_Gross", "Tổng_Net", "Số_KH", "Số_đơn_hàng",
+        "Prev_Tổng_Gross", "Prev_Tổng_Net", "Prev_Số_KH", "Prev_Số_đơn_hàng"
+    ]:
+        if c in df_region_show.columns:
+            df_region_show[c] = df_region_show[c].apply(fmt_int)
+
+    for c in ["Tỷ_lệ_CK (%)", "%_So_sánh_Tổng_Gross", "%_So_sánh_Tổng_Net", "%_So_sánh_Số_KH", "%_So_sánh_Số_đơn_hàng"]:
+        if c in df_region_show.columns:
+            df_region_show[c] = df_region_show[c].apply(lambda v: fmt_pct(v, 2, with_sign=c.startswith("%_So_sánh")))
+
+    region_cols = [
+        "Kỳ", "Region", "Tổng_Gross", "Tổng_Net", "Số_KH", "Số_đơn_hàng",
+        "Tỷ_lệ_CK (%)", "Prev_Tổng_Net", "%_So_sánh_Tổng_Net"
+    ]
+    region_cols = [c for c in region_cols if c in df_region_show.columns]
+    show_df(df_region_show[region_cols], title=None)
 
 # =====================================================
-# TOP/BOTTOM STORE + CHỌN KỲ
+# TOP/BOTTOM STORE + CHỌN KỲ (FRAGMENT: đổi kỳ chỉ chọn lại Top/Bottom)
 # =====================================================
-st.subheader("🏪 Top/Bottom 10 Điểm mua hàng")
-st.markdown("### 🔍 Chọn kỳ để xem Top/Bottom")
-
-if time_grain == "Ngày":
-    period_df = df_summary[["Key"]].drop_duplicates().sort_values("Key").copy()
-    period_df["label"] = pd.to_datetime(period_df["Key"], errors="coerce").dt.strftime("%Y-%m-%d")
-    sel_label2 = st.selectbox("Kỳ (Ngày)", period_df["label"].tolist(), index=len(period_df) - 1, key=REV_PREFIX + "store_period")
-    sel_key2 = period_df.loc[period_df["label"] == sel_label2, "Key"].iloc[0]
-    top10 = top_bottom_store(df_filtered, time_grain, top=True, key=sel_key2)
-    bottom10 = top_bottom_store(df_filtered, time_grain, top=False, key=sel_key2)
-else:
-    period_df = df_summary[["Year", "Key"]].drop_duplicates().sort_values(["Year", "Key"]).copy()
-    if time_grain == "Tuần":
-        period_df["label"] = period_df.apply(lambda r: f"Tuần {int(r['Key']):02d}/{int(r['Year'])}", axis=1)
-    elif time_grain == "Tháng":
-        period_df["label"] = period_df.apply(lambda r: f"{int(r['Year'])}-{int(r['Key']):02d}", axis=1)
-    else:
-        period_df["label"] = period_df.apply(lambda r: f"Q{int(r['Key'])} {int(r['Year'])}", axis=1)
-
-    sel_label2 = st.selectbox("Kỳ", period_df["label"].tolist(), index=len(period_df) - 1, key=REV_PREFIX + "store_period")
-    row2 = period_df.loc[period_df["label"] == sel_label2].iloc[0]
-    sel_year2 = int(row2["Year"])
-    sel_key2 = int(row2["Key"])
-    top10 = top_bottom_store(df_filtered, time_grain, top=True, year=sel_year2, key=sel_key2)
-    bottom10 = top_bottom_store(df_filtered, time_grain, top=False, year=sel_year2, key=sel_key2)
+store_box = st.container()
 
 def format_store_table(dfin: pd.DataFrame) -> pd.DataFrame:
     if dfin.empty:
         return dfin
-    out = dfin.copy()
+    out = dfin.copy(deep=False)
 
-    if time_grain == "Ngày":
-        out["Kỳ"] = pd.to_datetime(out["Key"], errors="coerce").dt.strftime("%Y-%m-%d")
-    else:
-        if time_grain == "Tuần":
-            out["Kỳ"] = out.apply(lambda r: f"Tuần {int(r['Key']):02d}/{int(r['Year'])}", axis=1)
-        elif time_grain == "Tháng":
-            out["Kỳ"] = out.apply(lambda r: f"{int(r['Year'])}-{int(r['Key']):02d}", axis=1)
-        else:
-            out["Kỳ"] = out.apply(lambda r: f"Q{int(r['Key'])} {int(r['Year'])}", axis=1)
+    out["Kỳ"] = period_label(out, time_grain)
 
     for c in ["Tổng_Gross", "Tổng_Net", "Prev"]:
         if c in out.columns:
@@ -508,14 +459,57 @@ def format_store_table(dfin: pd.DataFrame) -> pd.DataFrame:
     cols = [c for c in cols if c in out.columns]
     return out[cols]
 
-top10_show = format_store_table(top10)
-bottom10_show = format_store_table(bottom10)
+@st.fragment
+def show_store(df_summary: pd.DataFrame, grouped_store: pd.DataFrame):
+    st.subheader("🏪 Top/Bottom 10 Điểm mua hàng")
+    st.markdown("### 🔍 Chọn kỳ để xem Top/Bottom")
+
+    if time_grain == "Ngày":
+        period_df = df_summary[["Key"]].drop_duplicates().sort_values("Key")
+        period_df["label"] = pd.to_datetime(period_df["Key"], errors="coerce").dt.strftime("%Y-%m-%d")
+        sel_label2 = st.selectbox("Kỳ (Ngày)", period_df["label"].tolist(), index=len(period_df) - 1, key=REV_PREFIX + "store_period")
+        sel_key2 = period_df.loc[period_df["label"] == sel_label2, "Key"].iloc[0]
+        top10 = top_bottom_store(grouped_store, time_grain, top=True, key=sel_key2)
+        bottom10 = top_bottom_store(grouped_store, time_grain, top=False, key=sel_key2)
+    else:
+        period_df = df_summary[["Year", "Key"]].drop_duplicates().sort_values(["Year", "Key"])
+        period_df["label"] = period_label(period_df, time_grain)
 
-colA, colB = st.columns(2)
-with colA:
-    st.markdown("### 🏆 Top 10 Điểm mua hàng")
-    st.dataframe(top10_show, use_container_width=True, hide_index=True)
+        sel_label2 = st.selectbox("Kỳ", period_df["label"].tolist(), index=len(period_df) - 1, key=REV_PREFIX + "store_period")
+        row2 = period_df.loc[period_df["label"] == sel_label2].iloc[0]
+        sel_year2 = int(row2["Year"])
+        sel_key2 = int(row2["Key"])
+        top10 = top_bottom_store(grouped_store, time_grain, top=True, year=sel_year2, key=sel_key2)
+        bottom10 = top_bottom_store(grouped_store, time_grain, top=False, year=sel_year2, key=sel_key2)
+
+    top10_show = format_store_table(top10)
+    bottom10_show = format_store_table(bottom10)
+
+    colA, colB = st.columns(2)
+    with colA:
+        st.markdown("### 🏆 Top 10 Điểm mua hàng")
+        st.dataframe(top10_show, use_container_width=True, hide_index=True)
+
+    with colB:
+        st.markdown("### 📉 Bottom 10 Điểm mua hàng")
+        st.dataframe(bottom10_show, use_container_width=True, hide_index=True)
+
+# =====================================================
+# RUN SECTIONS (summary / region / store độc lập => tính song song; region, store cần danh sách kỳ của summary)
+# =====================================================
+render_sections(
+    {
+        "summary": (summarize_revenue, start_date, end_date, rev_filters, time_grain, REV_WEEK_START, approx),
+        "region": (summarize_region, start_date, end_date, rev_filters, time_grain, REV_WEEK_START, approx),
+        "store": (store_periods, start_date, end_date, rev_filters, time_grain, REV_WEEK_START),
+    },
+    {
+        "summary": (summary_box, show_summary, ["summary"]),
+        "region": (region_box, show_region, ["summary", "region"]),
+        "store": (store_box, show_store, ["summary", "store"]),
+    },
+)
 
-with colB:
-    st.markdown("### 📉 Bottom 10 Điểm mua hàng")
-    st.dataframe(bottom10_show, use_container_width=True, hide_index=True)
+mem = rerun_memory_peak()
+if mem:
+    st.sidebar.caption(f"📈 Đỉnh bộ nhớ lần chạy này: {mem['peak'] / 2**20:,.1f} MB (dataset {mem['dataset'] / 2**20:,.1f} MB)")
@@ -5,7 +5,10 @@ import numpy as np
 import streamlit as st
 from io import BytesIO
 
-from load_data import get_active_data, first_purchase
+from load_data import (
+    get_orders, orders_view, get_customers, get_catalog, cascade_options, isin_codes, memoize, offload,
+    OffloadTimeout, build_crm, pareto_base, cohort_first_return, rerun_memory_start, rerun_memory_peak,
+)
 
 # =====================================================
 # SAFE MULTISELECT WITH "ALL"
@@ -91,20 +94,6 @@ def to_excel(df: pd.DataFrame) -> bytes:
     return output.getvalue()
 
 
-def ensure_datetime(df: pd.DataFrame) -> pd.DataFrame:
-    if "Ngày" in df.columns:
-        df["Ngày"] = pd.to_datetime(df["Ngày"], errors="coerce")
-        df = df.dropna(subset=["Ngày"])
-    return df
-
-
-def fix_numeric(df: pd.DataFrame) -> pd.DataFrame:
-    for c in ["Tổng_Gross", "Tổng_Net"]:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce")
-    return df
-
-
 def show_df(df_show: pd.DataFrame, title: str | None = None):
     if title:
         st.subheader(title)
@@ -115,31 +104,34 @@ def show_df(df_show: pd.DataFrame, title: str | None = None):
 # PAGE
 # =====================================================
 st.title("📤 CRM & Cohort Retention")
+rerun_memory_start()
 
 # =====================================================
-# LOAD
+# LOAD (header chứng từ: mọi bảng của page chỉ cần mức Số_CT)
 # =====================================================
-df = get_active_data()
-df = ensure_datetime(df)
-df = fix_numeric(df)
+# header đã typed + sort theo Ngày từ load_data (validate 1 lần lúc load) => không ép kiểu lại mỗi rerun
+df = get_orders()
 
 if df.empty:
     st.warning("⚠ Không có dữ liệu để phân tích. Kiểm tra lại nguồn dữ liệu.")
     st.stop()
 
+# option / cascade / min-max ngày cho sidebar: đọc catalog, không quét bảng fact
+catalog = get_catalog()
+
 # =====================================================
 # SIDEBAR FILTER (Brand → Region → Cửa hàng) + All
 # =====================================================
 with st.sidebar:
     st.header("🎛️ Bộ lọc dữ liệu (CRM & Cohort)")
 
-    start_date = st.date_input("Từ ngày", df["Ngày"].min().date())
-    end_date = st.date_input("Đến ngày", df["Ngày"].max().date())
+    start_date = st.date_input("Từ ngày", catalog["date_min"].date())
+    end_date = st.date_input("Đến ngày", catalog["date_max"].date())
 
     loaiCT_filter = safe_multiselect_all(
         key="loaiCT_filter",
         label="Loại CT",
-        options=df["LoaiCT"] if "LoaiCT" in df.columns else [],
+        options=catalog["options"].get("LoaiCT", []),
         all_label="All",
         default_all=True,
     )
@@ -147,52 +139,47 @@ with st.sidebar:
     brand_filter = safe_multiselect_all(
         key="brand_filter",
         label="Brand",
-        options=df["Brand"] if "Brand" in df.columns else [],
+        options=catalog["options"].get("Brand", []),
         all_label="All",
         default_all=True,
     )
 
 # Cascade: Region by Brand
-df_b = df[df["Brand"].isin(brand_filter)] if (brand_filter and "Brand" in df.columns) else df.iloc[0:0]
-
 with st.sidebar:
     region_filter = safe_multiselect_all(
         key="region_filter",
         label="Region",
-        options=df_b["Region"] if "Region" in df_b.columns else [],
+        options=cascade_options(catalog, "Region", {"Brand": brand_filter}),
         all_label="All",
         default_all=True,
     )
 
 # Cascade: Store by Brand+Region
-df_br = df_b[df_b["Region"].isin(region_filter)] if (region_filter and "Region" in df_b.columns) else df_b.iloc[0:0]
-
 with st.sidebar:
     store_filter = safe_multiselect_all(
         key="store_filter",
         label="Cửa hàng",
-        options=df_br["Điểm_mua_hàng"] if "Điểm_mua_hàng" in df_br.columns else [],
+        options=cascade_options(catalog, "Điểm_mua_hàng", {"Brand": brand_filter, "Region": region_filter}),
         all_label="All",
         default_all=True,
     )
 
 
-def apply_filters(df: pd.DataFrame, start_date, end_date, loaiCT, brand, region, store) -> pd.DataFrame:
-    mask = (df["Ngày"] >= pd.to_datetime(start_date)) & (df["Ngày"] <= pd.to_datetime(end_date))
+crm_filters = {
+    "LoaiCT": loaiCT_filter if loaiCT_filter else [],
+    "Brand": brand_filter if brand_filter else [],
+    "Region": region_filter if region_filter else [],
+    "Điểm_mua_hàng": store_filter if store_filter else [],
+}
 
-    if "LoaiCT" in df.columns:
-        mask &= df["LoaiCT"].isin(loaiCT if loaiCT else [])
-    if "Brand" in df.columns:
-        mask &= df["Brand"].isin(brand if brand else [])
-    if "Region" in df.columns:
-        mask &= df["Region"].isin(region if region else [])
-    if "Điểm_mua_hàng" in df.columns:
-        mask &= df["Điểm_mua_hàng"].isin(store if store else [])
 
-    return df.loc[mask].copy()
+def apply_filters(start_date, end_date, filters) -> pd.DataFrame:
+    # lát ngày (searchsorted) + giao bitmap index của header chứng từ, không quét isin từng cột
+    # bảng trả ra chỉ đọc; các bảng tính bên dưới memo theo (version dataset, bộ lọc)
+    return orders_view(start_date, end_date, filters)
 
 
-df_f = apply_filters(df, start_date, end_date, loaiCT_filter, brand_filter, region_filter, store_filter)
+df_f = apply_filters(start_date, end_date, crm_filters)
 
 if df_f.empty:
     st.warning("⚠ Không có dữ liệu sau khi áp bộ lọc.")
@@ -214,30 +201,27 @@ VIP_NET_THRESHOLD = st.sidebar.number_input(
 GROUP_BY_CUSTOMER = st.sidebar.checkbox("Gộp tất cả giao dịch của 1 KH", value=False)
 min_net = st.sidebar.number_input("Net tối thiểu (lọc)", 0, value=0)
 
-group_cols = ["Số_điện_thoại"]
+group_cols = ["KH_key"]
 if not GROUP_BY_CUSTOMER:
     group_cols.append("Điểm_mua_hàng")
 
 
-def build_crm(df_f: pd.DataFrame, group_cols):
-    d = (
-        df_f.groupby(group_cols)
-        .agg(
-            Name=("tên_KH", "first"),
-            Name_Check=("Kiểm_tra_tên", "first"),
-            Gross=("Tổng_Gross", "sum"),
-            Net=("Tổng_Net", "sum"),
-            Orders=("Số_CT", "nunique"),
-            First_Order=("Ngày", "min"),
-            Last_Order=("Ngày", "max"),
-            Check_SDT=("Trạng_thái_số_điện_thoại", "first"),
-        )
-        .reset_index()
-    )
-    return d
+def offloaded(compute, *args) -> pd.DataFrame:
+    # compute gọi offload (process worker); quá hạn => báo lỗi + dừng page (phiên chờ cùng key nhận cùng lỗi)
+    try:
+        return compute(*args)
+    except OffloadTimeout as e:
+        st.error(f"⏱ {e}, hãy thu hẹp khoảng ngày / bộ lọc.")
+        st.stop()
+
 
+@memoize
+def crm_export(start_date, end_date, filters, group_cols) -> pd.DataFrame:
+    return offload(build_crm, start_date, end_date, filters, group_cols)
 
-df_export = build_crm(df_f, group_cols)
+
+# bản nông (copy-on-write) của kết quả memo: thêm cột tag không copy / không sửa bảng dùng chung
+df_export = offloaded(crm_export, start_date, end_date, crm_filters, group_cols).copy(deep=False)
 
 df_export["CK_%"] = np.where(
     df_export["Gross"] > 0,
@@ -262,7 +246,7 @@ df_export["Bao_lâu_không_mua"] = np.where(
     np.nan,
 ).astype("float")
 
-df_export = df_export[df_export["Net"] >= min_net].copy()
+df_export = df_export[df_export["Net"] >= min_net]
 
 display_cols = [
     "Số_điện_thoại",
@@ -281,110 +265,117 @@ if not GROUP_BY_CUSTOMER:
 # =========================
 # FILTER BẢNG CRM
 # =========================
-st.subheader("📄 Danh sách KH xuất CRM")
-st.markdown("### 🔎 Lọc nhanh trên bảng")
-
-col1, col2, col3, col4, col5 = st.columns(5)
-
-with col1:
-    show_inactive = st.checkbox("Chỉ KH Inactive", value=False)
-with col2:
-    show_vip = st.checkbox("Chỉ KH VIP", value=False)
-with col3:
-    show_customer = st.checkbox("Khách hàng thường", value=True)
-
-with col4:
-    kiem_tra_ten_filter = safe_multiselect_all(
-        key="kiem_tra_ten_filter",
-        label="Kiểm tra tên KH",
-        options=df_f["Kiểm_tra_tên"] if "Kiểm_tra_tên" in df_f.columns else [],
-        all_label="All",
-        default_all=True,
-    )
+# (FRAGMENT: lọc nhanh / sắp xếp chỉ chạy lại bảng này trên df_export đã tính, không đụng Pareto / Cohort)
+@st.fragment
+def crm_table(df_export: pd.DataFrame, display_cols: list):
+    st.subheader("📄 Danh sách KH xuất CRM")
+    st.markdown("### 🔎 Lọc nhanh trên bảng")
+
+    col1, col2, col3, col4, col5 = st.columns(5)
+
+    with col1:
+        show_inactive = st.checkbox("Chỉ KH Inactive", value=False)
+    with col2:
+        show_vip = st.checkbox("Chỉ KH VIP", value=False)
+    with col3:
+        show_customer = st.checkbox("Khách hàng thường", value=True)
+
+    with col4:
+        kiem_tra_ten_filter = safe_multiselect_all(
+            key="kiem_tra_ten_filter",
+            label="Kiểm tra tên KH",
+            # cùng nguồn với cột Name_Check (bảng KH, giá trị ở lần mua đầu) => option khớp giá trị được lọc
+            options=df_export["Name_Check"] if "Name_Check" in df_export.columns else [],
+            all_label="All",
+            default_all=True,
+        )
 
-with col5:
-    check_sdt_filter = safe_multiselect_all(
-        key="check_sdt_filter",
-        label="Check SĐT",
-        options=df_export["Check_SDT"] if "Check_SDT" in df_export.columns else [],
-        all_label="All",
-        default_all=True,
-    )
+    with col5:
+        check_sdt_filter = safe_multiselect_all(
+            key="check_sdt_filter",
+            label="Check SĐT",
+            options=df_export["Check_SDT"] if "Check_SDT" in df_export.columns else [],
+            all_label="All",
+            default_all=True,
+        )
 
-selected_tags = []
-if show_inactive:
-    selected_tags.append("KH Inactive")
-if show_vip:
-    selected_tags.append("KH VIP")
-if show_customer:
-    selected_tags.append("Khách hàng")
+    selected_tags = []
+    if show_inactive:
+        selected_tags.append("KH Inactive")
+    if show_vip:
+        selected_tags.append("KH VIP")
+    if show_customer:
+        selected_tags.append("Khách hàng")
 
-if selected_tags:
-    df_export = df_export[df_export["KH_tag"].isin(selected_tags)]
+    if selected_tags:
+        df_export = df_export[df_export["KH_tag"].isin(selected_tags)]
 
-if check_sdt_filter:
-    df_export = df_export[df_export["Check_SDT"].isin(check_sdt_filter)]
+    if check_sdt_filter:
+        df_export = df_export[df_export["Check_SDT"].isin(check_sdt_filter)]
 
-if kiem_tra_ten_filter:
-    df_export = df_export[df_export["Name_Check"].isin(kiem_tra_ten_filter)]
+    if kiem_tra_ten_filter:
+        df_export = df_export[df_export["Name_Check"].isin(kiem_tra_ten_filter)]
 
-sort_col = st.selectbox(
-    "Sắp xếp theo",
-    options=df_export.columns,
-    index=list(df_export.columns).index("Net") if "Net" in df_export.columns else 0,
-)
-sort_order = st.radio("Thứ tự", ["Giảm dần", "Tăng dần"], horizontal=True)
-df_export = df_export.sort_values(sort_col, ascending=(sort_order == "Tăng dần"))
-
-total_kh_filtered = df_export["Số_điện_thoại"].nunique()
-st.info(f"👥 Tổng số KH theo bộ lọc hiện tại: **{total_kh_filtered:,}** khách hàng")
-
-# Row tổng
-total_row = {}
-for col in df_export.columns:
-    if col in ["Gross", "Net", "Orders"]:
-        total_row[col] = df_export[col].sum()
-    elif col == "CK_%":
-        total_row[col] = df_export[col].mean()
-    elif col == "Last_Order":
-        total_row[col] = pd.NaT
-    elif col == "Số_điện_thoại":
-        total_row[col] = "TỔNG"
-    elif col == "Bao_lâu_không_mua":
-        total_row[col] = np.nan
-    else:
-        total_row[col] = ""
-
-df_export_with_total = pd.concat([df_export, pd.DataFrame([total_row])], ignore_index=True)
-
-# ===== format hiển thị CRM =====
-df_export_display = df_export_with_total[display_cols].copy()
-
-for c in ["Gross", "Net", "Orders"]:
-    if c in df_export_display.columns:
-        df_export_display[c] = df_export_display[c].apply(fmt_int)
-
-if "CK_%" in df_export_display.columns:
-    df_export_display["CK_%"] = df_export_display["CK_%"].apply(lambda v: fmt_pct(v, 2))
-
-if "Bao_lâu_không_mua" in df_export_display.columns:
-    df_export_display["Bao_lâu_không_mua"] = df_export_display["Bao_lâu_không_mua"].apply(
-        lambda v: "" if pd.isna(v) else fmt_int(v)
+    sort_col = st.selectbox(
+        "Sắp xếp theo",
+        options=df_export.columns,
+        index=list(df_export.columns).index("Net") if "Net" in df_export.columns else 0,
     )
+    sort_order = st.radio("Thứ tự", ["Giảm dần", "Tăng dần"], horizontal=True)
+    df_export = df_export.sort_values(sort_col, ascending=(sort_order == "Tăng dần"))
+
+    total_kh_filtered = df_export["Số_điện_thoại"].nunique()
+    st.info(f"👥 Tổng số KH theo bộ lọc hiện tại: **{total_kh_filtered:,}** khách hàng")
+
+    # Row tổng
+    total_row = {}
+    for col in df_export.columns:
+        if col in ["Gross", "Net", "Orders"]:
+            total_row[col] = df_export[col].sum()
+        elif col == "CK_%":
+            total_row[col] = df_export[col].mean()
+        elif col == "Last_Order":
+            total_row[col] = pd.NaT
+        elif col == "Số_điện_thoại":
+            total_row[col] = "TỔNG"
+        elif col == "Bao_lâu_không_mua":
+            total_row[col] = np.nan
+        else:
+            total_row[col] = ""
+
+    df_export_with_total = pd.concat([df_export, pd.DataFrame([total_row])], ignore_index=True)
+
+    # ===== format hiển thị CRM =====
+    df_export_display = df_export_with_total[display_cols]
+
+    for c in ["Gross", "Net", "Orders"]:
+        if c in df_export_display.columns:
+            df_export_display[c] = df_export_display[c].apply(fmt_int)
 
-if "Last_Order" in df_export_display.columns:
-    df_export_display["Last_Order"] = pd.to_datetime(
-        df_export_display["Last_Order"], errors="coerce"
-    ).dt.strftime("%Y-%m-%d")
+    if "CK_%" in df_export_display.columns:
+        df_export_display["CK_%"] = df_export_display["CK_%"].apply(lambda v: fmt_pct(v, 2))
 
-show_df(df_export_display, title=None)
+    if "Bao_lâu_không_mua" in df_export_display.columns:
+        df_export_display["Bao_lâu_không_mua"] = df_export_display["Bao_lâu_không_mua"].apply(
+            lambda v: "" if pd.isna(v) else fmt_int(v)
+        )
 
-st.download_button(
-    "📥 Tải danh sách KH (Excel)",
-    data=to_excel(df_export_display),
-    file_name="customer_marketing.xlsx",
-    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-)
+    if "Last_Order" in df_export_display.columns:
+        df_export_display["Last_Order"] = pd.to_datetime(
+            df_export_display["Last_Order"], errors="coerce"
+        ).dt.strftime("%Y-%m-%d")
+
+    show_df(df_export_display, title=None)
+
+    st.download_button(
+        "📥 Tải danh sách KH (Excel)",
+        data=to_excel(df_export_display),
+        file_name="customer_marketing.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
+
+
+crm_table(df_export, display_cols)
 
 # =========================
 # PARETO KH THEO CỬA HÀNG
@@ -400,46 +391,34 @@ store_filter_pareto = st.sidebar.multiselect(
 )
 
 
-def pareto_customer_by_store(df: pd.DataFrame, percent=20, top=True) -> pd.DataFrame:
-    rows = []
-    for store, d in df.groupby("Điểm_mua_hàng"):
-        g = (
-            d.groupby("Số_điện_thoại")
-            .agg(Gross=("Tổng_Gross", "sum"), Net=("Tổng_Net", "sum"), Orders=("Số_CT", "nunique"))
-            .reset_index()
-            .sort_values("Net", ascending=False)
-        )
-        if g.empty:
-            continue
-
-        g["CK_%"] = ((g["Gross"] - g["Net"]) / g["Gross"] * 100).round(2)
-        total_net = g["Net"].sum()
-        g["Contribution_%"] = (g["Net"] / total_net * 100).round(2) if total_net != 0 else 0
-        g["Cum_%"] = g["Contribution_%"].cumsum().round(2)
-
-        n = max(1, int(len(g) * percent / 100))
-        g_sel = g.head(n) if top else g.tail(n)
+@memoize
+def pareto_ranked(start_date, end_date, filters) -> pd.DataFrame:
+    # bảng KH × Cửa hàng đã xếp hạng (1 lần / bộ lọc, dùng lại khi đổi % / Top-Bottom / cửa hàng)
+    return offload(pareto_base, start_date, end_date, filters)
 
-        g_sel = g_sel.copy()
-        g_sel.loc[:, "Điểm_mua_hàng"] = store
-        rows.append(g_sel)
 
-    if rows:
-        return pd.concat(rows, ignore_index=True)
-    return pd.DataFrame()
+def pareto_customer_by_store(base: pd.DataFrame, stores, percent=20, top=True) -> pd.DataFrame:
+    if base.empty:
+        return pd.DataFrame()
 
+    n = np.maximum(1, (base["Size"] * percent / 100).astype(int))
+    sel = base["Rank"] < n if top else base["Rank"] >= base["Size"] - n
+    if stores:
+        sel &= isin_codes(base["Điểm_mua_hàng"], stores)
+    return base[sel].reset_index(drop=True)
 
-df_pareto_base = df_f.copy()
-if store_filter_pareto:
-    df_pareto_base = df_pareto_base[df_pareto_base["Điểm_mua_hàng"].isin(store_filter_pareto)]
 
-df_pareto = pareto_customer_by_store(df_pareto_base, percent=pareto_percent, top=(pareto_type == "Top"))
+# base chỉ phụ thuộc bộ lọc sidebar => memo, slider / radio chỉ chọn lại dòng
+df_pareto = pareto_customer_by_store(
+    offloaded(pareto_ranked, start_date, end_date, crm_filters),
+    store_filter_pareto, percent=pareto_percent, top=(pareto_type == "Top"),
+)
 
 st.subheader(f"🏆 {pareto_type} {pareto_percent}% KH theo từng Cửa hàng (Pareto)")
 if not df_pareto.empty:
     df_pareto_show = df_pareto[
         ["Điểm_mua_hàng", "Số_điện_thoại", "Gross", "Net", "CK_%", "Orders", "Contribution_%", "Cum_%"]
-    ].copy()
+    ]
 
     for c in ["Gross", "Net", "Orders"]:
         df_pareto_show[c] = df_pareto_show[c].apply(fmt_int)
@@ -454,13 +433,15 @@ else:
 # =========================
 # KH MỚI VS KH QUAY LẠI
 # =========================
-df_fp = first_purchase(df)  # dùng toàn bộ active_df để đúng First_Date
-df_kh = df_f.merge(df_fp, on="Số_điện_thoại", how="left")
-df_kh["KH_type"] = np.where(df_kh["First_Date"] >= pd.to_datetime(start_date), "KH mới", "KH quay lại")
+# First_Date trọn đời từ bảng KH (không lọc) => map trên KH distinct của kỳ, không merge từng dòng
+customers = get_customers()
+kh_keys = pd.Series(df_f["KH_key"].dropna().unique())
+kh_first = customers["First_Date"].reindex(kh_keys).to_numpy()
+kh_type = pd.Series(np.where(kh_first >= pd.to_datetime(start_date), "KH mới", "KH quay lại"), name="KH_type")
 
 st.subheader("👥 KH mới vs KH quay lại")
 st.dataframe(
-    df_kh.groupby("KH_type")["Số_điện_thoại"].nunique().reset_index(name="Số KH"),
+    kh_type.groupby(kh_type).size().reset_index(name="Số KH"),
     use_container_width=True,
     hide_index=True,
 )
@@ -468,53 +449,51 @@ st.dataframe(
 # =========================
 # COHORT RETENTION – CỘNG DỒN (%)
 # =========================
-st.sidebar.subheader("⚙️ Cohort Retention")
-MAX_MONTH = st.sidebar.slider("Giới hạn số tháng retention", 3, 12, 7)
-
-df_cohort = df_f.copy()
-df_cohort = ensure_datetime(df_cohort)
-
-df_cohort["Order_Month"] = df_cohort["Ngày"].dt.to_period("M")
-df_cohort["First_Month"] = df_cohort.groupby("Số_điện_thoại")["Order_Month"].transform("min")
-
-df_cohort["Cohort_Index"] = (
-    (df_cohort["Order_Month"].dt.year - df_cohort["First_Month"].dt.year) * 12
-    + (df_cohort["Order_Month"].dt.month - df_cohort["First_Month"].dt.month)
-)
-df_cohort = df_cohort[df_cohort["Cohort_Index"] >= 0]
-
-cohort_size = df_cohort[df_cohort["Cohort_Index"] == 0].groupby("First_Month")["Số_điện_thoại"].nunique()
-
-rows = []
-for cohort, size in cohort_size.items():
-    d = df_cohort[df_cohort["First_Month"] == cohort]
-    row = {"First_Month": str(cohort), "Tổng KH": int(size)}
+@memoize
+def cohort_returns(start_date, end_date, filters) -> pd.DataFrame:
+    # 1 dòng / KH: tháng mua đầu (First) + số tháng tới lần quay lại đầu tiên (Return)
+    return offload(cohort_first_return, start_date, end_date, filters)
+
+
+def build_retention(kh: pd.DataFrame, max_month: int) -> pd.DataFrame:
+    """Ma trận retention cộng dồn (%) + Grand Total từ 1 crosstab + cumsum."""
+    if kh.empty:
+        return pd.DataFrame()
+
+    size = kh.groupby("First").size()
+    months = list(range(1, max_month + 1))
+    back = kh.dropna(subset=["Return"])
+    cum = (
+        pd.crosstab(back["First"], back["Return"].astype(int))
+        .reindex(index=size.index, columns=months, fill_value=0)
+        .cumsum(axis=1)
+    )
+    cum.loc["Grand Total"] = cum.sum()
+    size.loc["Grand Total"] = size.sum()
 
-    for m in range(1, MAX_MONTH + 1):
-        kh_quay_lai = d[(d["Cohort_Index"] >= 1) & (d["Cohort_Index"] <= m)]["Số_điện_thoại"].nunique()
-        row[f"Sau {m} tháng"] = round(kh_quay_lai / size * 100, 2) if size else 0
+    retention = (cum.div(size, axis=0) * 100).round(2)
+    retention.columns = [f"Sau {m} tháng" for m in months]
+    retention.insert(0, "Tổng KH", size.astype(int))
 
-    rows.append(row)
+    labels = pd.PeriodIndex.from_ordinals(size.index[:-1].astype("int64") - 1970 * 12, freq="M").astype(str)
+    retention.insert(0, "First_Month", list(labels) + ["Grand Total"])
+    return retention.reset_index(drop=True)
 
-retention = pd.DataFrame(rows)
 
-# GRAND TOTAL
-if not retention.empty:
-    total_kh = retention["Tổng KH"].sum()
-    grand = {"First_Month": "Grand Total", "Tổng KH": int(total_kh)}
+kh_cohort = offloaded(cohort_returns, start_date, end_date, crm_filters)
+max_span = int(kh_cohort["Return"].max()) if kh_cohort["Return"].notna().any() else 0
 
-    for c in retention.columns:
-        if c.startswith("Sau"):
-            grand[c] = round((retention[c] * retention["Tổng KH"]).sum() / total_kh, 2) if total_kh else 0
+st.sidebar.subheader("⚙️ Cohort Retention")
+MAX_MONTH = st.sidebar.slider("Giới hạn số tháng retention", 3, max(12, max_span), 7)
 
-    retention = pd.concat([retention, pd.DataFrame([grand])], ignore_index=True)
+retention = build_retention(kh_cohort, MAX_MONTH)
 
 st.subheader("🏅 Cohort Retention – Cộng dồn (%)")
 
 if retention.empty:
     st.info("Không có dữ liệu cohort.")
 else:
-    retention_show = retention.copy()
+    retention_show = retention.copy(deep=False)
     retention_show["Tổng KH"] = retention_show["Tổng KH"].apply(fmt_int)
     for c in retention_show.columns:
         if c.startswith("Sau"):
@@ -532,3 +511,7 @@ with st.sidebar:
         ]:
             st.session_state.pop(k, None)
         st.rerun()
+
+mem = rerun_memory_peak()
+if mem:
+    st.sidebar.caption(f"📈 Đỉnh bộ nhớ lần chạy này: {mem['peak'] / 2**20:,.1f} MB (dataset {mem['dataset'] / 2**20:,.1f} MB)")
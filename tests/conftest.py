@@ -0,0 +1,50 @@
+# tests/conftest.py
+# Các module của app nằm ở thư mục gốc (không phải package) => thêm vào sys.path cho pytest chạy từ mọi thư mục
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def sales_rows(n_orders: int, start: str = "2025-01-01", days: int = 90, seed: int = 0,
+               brands=("A", "B", "C"), n_stores: int = 30, n_customers: int = 400) -> pd.DataFrame:
+    """
+    Dữ liệu dòng hàng thô giả lập (như data/data.parquet trước _normalize), 1-4 dòng / chứng từ:
+    - cửa hàng nhiều giá trị (index dạng "rows"), Brand / LoaiCT / cờ ít giá trị (dạng "bits")
+    - ~5% Region / Điểm_mua_hàng thiếu (đoạn NaN của index), chứng từ trùng SĐT giữa các ngày
+    """
+    rng = np.random.default_rng(seed)
+    store = rng.integers(0, n_stores, n_orders)
+    customer = rng.integers(0, n_customers, n_orders)
+    orders = pd.DataFrame({
+        "Ngày": pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, days, n_orders), unit="D"),
+        "Số_CT": [f"CT{seed:02d}{i:06d}" for i in range(n_orders)],
+        "Điểm_mua_hàng": [f"CH{s:03d}" for s in store],
+        "Brand": np.asarray(brands, dtype=object)[store % len(brands)],
+        "Region": np.array(["Bắc", "Trung", "Nam"], dtype=object)[store % 3],
+        "LoaiCT": rng.choice(np.array(["Bán", "Trả"], dtype=object), n_orders, p=[0.9, 0.1]),
+        "Số_điện_thoại": [f"09{c:08d}" for c in customer],
+        "tên_KH": [f"KH {c}" for c in customer],
+        "Trạng_thái_số_điện_thoại": np.array(["Hợp lệ", "Sai"], dtype=object)[(customer % 7 == 0).astype(int)],
+        "Kiểm_tra_tên": np.array(["OK", "Thiếu"], dtype=object)[(customer % 5 == 0).astype(int)],
+    })
+    orders.loc[rng.random(n_orders) < 0.05, "Region"] = None
+    orders.loc[rng.random(n_orders) < 0.05, "Điểm_mua_hàng"] = None
+
+    lines = orders.loc[orders.index.repeat(rng.integers(1, 5, n_orders))].reset_index(drop=True)
+    gross = rng.integers(1, 50, len(lines)) * 10_000.0
+    lines["Nhóm_hàng"] = rng.choice(np.array(["Áo", "Quần", "Giày", "Phụ kiện"], dtype=object), len(lines))
+    lines["Mã_NB"] = [f"SP{k:04d}" for k in rng.integers(0, 200, len(lines))]
+    lines["Số_lượng"] = rng.integers(1, 4, len(lines))
+    lines["Tổng_Gross"] = gross
+    lines["Tổng_Net"] = gross * rng.choice([1.0, 0.9, 0.8], len(lines))
+    return lines
+
+
+@pytest.fixture
+def make_sales():
+    return sales_rows
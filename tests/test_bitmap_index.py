@@ -0,0 +1,106 @@
+# tests/test_bitmap_index.py
+import numpy as np
+import pandas as pd
+import pytest
+
+from load_data import INDEX_DIMS, _normalize, append_normalized, build_bitmap_index, extend_bitmap_index, index_mask
+
+
+def _expected(df: pd.DataFrame, filters: dict, rows: slice) -> np.ndarray:
+    mask = np.ones(rows.stop - rows.start, dtype=bool)
+    for col, values in filters.items():
+        mask &= df[col].iloc[rows].isin(list(values)).to_numpy()
+    return mask
+
+
+def _assert_mask(df: pd.DataFrame, index: dict, filters: dict, rows: slice):
+    mask, rest = index_mask(index, filters, rows)
+    assert rest == [c for c in filters if c not in index]
+    got = np.ones(rows.stop - rows.start, dtype=bool) if mask is None else mask
+    np.testing.assert_array_equal(got, _expected(df, filters, rows))
+
+
+def _random_filters(df: pd.DataFrame, rng) -> dict:
+    # mỗi cột: bỏ qua / rỗng / 1 giá trị / gần hết / đủ / có giá trị không tồn tại
+    filters = {}
+    for c in INDEX_DIMS:
+        cats = list(df[c].cat.categories)
+        kind = rng.integers(0, 6)
+        if kind == 0:
+            continue
+        if kind == 1:
+            filters[c] = []
+        elif kind == 2:
+            filters[c] = [cats[rng.integers(0, len(cats))]]
+        elif kind == 3:
+            filters[c] = list(rng.choice(cats, size=max(len(cats) - 1, 1), replace=False))
+        elif kind == 4:
+            filters[c] = cats
+        else:
+            filters[c] = list(rng.choice(cats, size=min(2, len(cats)), replace=False)) + ["không có"]
+    return filters
+
+
+@pytest.fixture
+def sales(make_sales):
+    return _normalize(make_sales(1_500, seed=1))
+
+
+def test_entry_kinds(sales):
+    index = build_bitmap_index(sales)
+    assert set(index) == set(INDEX_DIMS)
+    assert index["Điểm_mua_hàng"][0] == "rows"  # 30 cửa hàng > 8 giá trị / mã int8
+    assert index["Brand"][0] == "bits"
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_index_mask_matches_isin(sales, seed):
+    rng = np.random.default_rng(seed)
+    index = build_bitmap_index(sales)
+    n = len(sales)
+    for rows in [slice(0, n), slice(3, n - 5), slice(n // 3, n // 3), slice(17, 18)]:
+        _assert_mask(sales, index, _random_filters(sales, rng), rows)
+
+
+def test_unindexed_filter_returned_as_rest(sales):
+    index = build_bitmap_index(sales)
+    mask, rest = index_mask(index, {"Brand": ["A"], "Nhóm_hàng": ["Áo"]}, slice(0, len(sales)))
+    assert rest == ["Nhóm_hàng"]
+    np.testing.assert_array_equal(mask, sales["Brand"].eq("A").to_numpy())
+
+
+def _assert_same_index(ext: dict, full: dict):
+    assert ext.keys() == full.keys()
+    for c in full:
+        assert ext[c][0] == full[c][0], c
+        assert ext[c][1].equals(full[c][1]), c
+        for a, b in zip(ext[c][2:], full[c][2:]):
+            if a is None or b is None:
+                assert a is None and b is None, c
+            else:
+                np.testing.assert_array_equal(a, b, err_msg=c)
+
+
+@pytest.mark.parametrize("n_old", [1_001, 1_200])  # không chia hết / chia hết cho 8 => ghép byte bitmap dở dang
+def test_extend_matches_full_build(make_sales, n_old):
+    old = _normalize(make_sales(n_old, start="2025-01-01", seed=2)).iloc[:n_old].reset_index(drop=True)
+    # phần nối: ngày sau watermark, thêm cửa hàng / Brand mới, vẫn có Region / cửa hàng thiếu
+    delta = make_sales(300, start="2025-06-01", days=20, seed=3, brands=("A", "D"), n_stores=45)
+    combined, pure_append = append_normalized(old, delta)
+    assert pure_append
+
+    ext = extend_bitmap_index(build_bitmap_index(old), combined.iloc[n_old:], n_old)
+    _assert_same_index(ext, build_bitmap_index(combined))
+
+    rng = np.random.default_rng(n_old)
+    for rows in [slice(0, len(combined)), slice(n_old - 3, len(combined)), slice(5, n_old + 9)]:
+        _assert_mask(combined, ext, _random_filters(combined, rng), rows)
+
+
+def test_extend_kind_change_rebuilds(make_sales):
+    # Brand vượt 8 giá trị sau khi nối => entry "bits" thành "rows" => None (build lại toàn bộ)
+    old = _normalize(make_sales(200, seed=4, brands=tuple("ABCDEFGH")))
+    delta = make_sales(50, start="2025-06-01", seed=5, brands=("X", "Y"))
+    combined, _ = append_normalized(old, delta)
+    assert build_bitmap_index(old)["Brand"][0] == "bits"
+    assert extend_bitmap_index(build_bitmap_index(old), combined.iloc[len(old):], len(old)) is None
@@ -0,0 +1,60 @@
+# tests/test_hll.py
+import numpy as np
+import pandas as pd
+import pytest
+
+from hll import HLL_ERROR, build_entries, estimate_groups
+
+
+def _keys(n: int, seed: int) -> np.ndarray:
+    # n key int64 khác nhau, rải trên khoảng lớn (như KH_key / CT_key sau factorize của dataset lớn)
+    rng = np.random.default_rng(seed)
+    return rng.choice(10**12, size=n, replace=False).astype(np.int64)
+
+
+def _estimate(keys, cells=None, cell_group=None, n_groups=1) -> np.ndarray:
+    cells = np.zeros(len(keys), dtype=np.int64) if cells is None else cells
+    cell_group = np.zeros(int(cells.max(initial=0)) + 1, dtype=np.int64) if cell_group is None else cell_group
+    return estimate_groups(build_entries(cells, pd.Series(keys)), cell_group, n_groups)
+
+
+@pytest.mark.parametrize("n", [1, 10, 500, 5_000, 50_000, 300_000])
+def test_estimate_within_error_bound(n):
+    # 4 sai số chuẩn: xác suất vượt ~6e-5 => test ổn định; n nhỏ (linear counting) gần như đúng tuyệt đối
+    est = _estimate(_keys(n, seed=n))[0]
+    assert abs(est - n) <= max(4 * HLL_ERROR * n, 1)
+
+
+def test_relative_error_matches_standard_error():
+    # sai số tương đối RMS trên nhiều tập độc lập ~ HLL_ERROR (con số hiển thị trong caption của page)
+    n = 20_000
+    errors = [(_estimate(_keys(n, seed=s))[0] - n) / n for s in range(60)]
+    rms = float(np.sqrt(np.mean(np.square(errors))))
+    assert 0.5 * HLL_ERROR <= rms <= 1.5 * HLL_ERROR
+
+
+def test_duplicates_and_missing_keys_ignored():
+    keys = _keys(20_000, seed=1)
+    noisy = pd.Series(np.concatenate([keys, keys[:5_000], keys[::7]]), dtype="Int64")
+    noisy[::11] = pd.NA
+    present = noisy.dropna().unique()
+    assert _estimate(noisy)[0] == _estimate(present)[0]
+
+
+def test_union_over_cells_per_group():
+    # 40 cell, key trùng giữa các cell; 3 nhóm cell + cell bị loại (-1) => hợp sketch theo nhóm
+    rng = np.random.default_rng(7)
+    pool = _keys(60_000, seed=7)
+    cells = rng.integers(0, 40, size=150_000)
+    keys = pool[rng.integers(0, len(pool), size=len(cells))]
+    cell_group = np.arange(40) % 4 - 1  # -1, 0, 1, 2, -1, 0, ...
+
+    est = _estimate(keys, cells, cell_group, n_groups=3)
+    group = cell_group[cells]
+    for g in range(3):
+        true = len(np.unique(keys[group == g]))
+        assert abs(est[g] - true) <= 4 * HLL_ERROR * true
+
+
+def test_no_groups():
+    assert len(_estimate(_keys(10, seed=0), n_groups=0)) == 0
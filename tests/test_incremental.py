@@ -0,0 +1,186 @@
+# tests/test_incremental.py
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import streamlit as st
+
+import load_data
+from load_data import (
+    KEY_COLS, _append_rows, _normalize, append_normalized, build_cube_sketches, build_customers, build_daily_cube,
+    build_orders, ingest_delta, merge_customers,
+)
+
+
+def assert_same(a, b, name="value"):
+    # so sánh đệ quy DataFrame / dict / tuple / mảng (bảng dẫn xuất, index, sketch)
+    if isinstance(a, pd.DataFrame):
+        pd.testing.assert_frame_equal(a, b, obj=name)
+    elif isinstance(a, dict):
+        assert a.keys() == b.keys(), name
+        for k in a:
+            assert_same(a[k], b[k], f"{name}.{k}")
+    elif isinstance(a, tuple):
+        assert len(a) == len(b), name
+        for i, (x, y) in enumerate(zip(a, b)):
+            assert_same(x, y, f"{name}[{i}]")
+    elif isinstance(a, pd.Index):
+        assert a.equals(b), name
+    elif a is None:
+        assert b is None, name
+    else:
+        np.testing.assert_array_equal(a, b, err_msg=name)
+
+
+def decoded(df: pd.DataFrame) -> pd.DataFrame:
+    # nội dung theo giá trị (bỏ khóa / mã category): snapshot nối vs build lại khác thứ tự từ điển
+    df = df.drop(columns=[k for k in KEY_COLS.values() if k in df.columns]).astype(str)
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+# =====================================================
+# HÀM THUẦN: nối phần mới vs build lại
+# =====================================================
+@pytest.fixture
+def appended(make_sales):
+    old = _normalize(make_sales(800, start="2025-01-01", seed=1))
+    delta = make_sales(200, start="2025-05-01", days=30, seed=2, brands=("A", "D"), n_stores=40)
+    combined, pure_append = append_normalized(old, delta)
+    assert pure_append
+    return old, combined
+
+
+def test_append_normalized_keeps_old_codes(appended):
+    old, combined = appended
+    n_old = len(old)
+    for c in ["Brand", "Điểm_mua_hàng", "Số_điện_thoại"]:
+        cats = combined[c].cat.categories
+        assert cats[: len(old[c].cat.categories)].equals(old[c].cat.categories)  # giá trị mới nối cuối
+        np.testing.assert_array_equal(combined[c].cat.codes[:n_old], old[c].cat.codes)
+    pd.testing.assert_series_equal(combined["KH_key"].iloc[:n_old], old["KH_key"])
+    new = combined.iloc[n_old:]
+    np.testing.assert_array_equal(
+        combined["Số_điện_thoại"].cat.categories.take(new["KH_key"].to_numpy()), new["Số_điện_thoại"].astype(str)
+    )
+
+
+def test_late_rows_are_sorted_in(make_sales):
+    old = _normalize(make_sales(300, seed=1))
+    late = make_sales(20, start="2025-01-10", days=5, seed=3)
+    combined, pure_append = append_normalized(old, late)
+    assert not pure_append
+    assert combined["Ngày"].is_monotonic_increasing
+    assert len(combined) == len(old) + len(late)
+
+
+def test_derived_tables_extend_like_full_build(appended):
+    old, combined = appended
+    new = combined.iloc[len(old):]
+
+    cube = _append_rows(build_daily_cube(old), build_daily_cube(new))
+    assert_same(cube, build_daily_cube(combined), "cube")
+
+    orders = _append_rows(build_orders(old), build_orders(new))
+    assert_same(orders, build_orders(combined), "orders")
+
+    old_orders = build_orders(old)
+    customers = merge_customers(build_customers(old_orders), build_customers(orders.iloc[len(old_orders):]))
+    assert_same(customers, build_customers(orders), "customers")
+
+    n_cells = len(build_daily_cube(old))
+    sketches = {
+        c: pd.concat([e, build_cube_sketches(new)[c].assign(cell=lambda x: x["cell"] + n_cells)], ignore_index=True)
+        for c, e in build_cube_sketches(old).items()
+    }
+    for c, full in build_cube_sketches(combined).items():
+        key = ["cell", "reg"]
+        assert_same(
+            sketches[c].sort_values(key).reset_index(drop=True), full.sort_values(key).reset_index(drop=True), c
+        )
+
+
+# =====================================================
+# ingest_delta trên dataset tạm (file delta + snapshot nối + bảng dẫn xuất tăng dần)
+# =====================================================
+def _clear_caches():
+    st.cache_resource.clear()
+    load_data._derived.clear()
+    load_data._source_versions.clear()
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch, make_sales):
+    data = tmp_path / "data"
+    data.mkdir()
+    paths = {
+        "DATA_DIR": data,
+        "PARQUET_FILE": data / "data.parquet",
+        "DELTA_DIR": data / "delta",
+        "SNAPSHOT_DIR": data,
+        "SNAPSHOT_FILE": data / "data.snapshot.arrow",
+    }
+    for name, value in paths.items():
+        monkeypatch.setattr(load_data, name, str(value))
+    base = make_sales(600, start="2025-01-01", days=120, seed=1)
+    base.to_parquet(paths["PARQUET_FILE"], index=False)
+    _clear_caches()
+    yield base
+    _clear_caches()
+
+
+def derived() -> dict:
+    path = load_data._data_source()
+    version = load_data._source_version(path)
+    return {
+        "snapshot": load_data._snapshot_frame(path, version),
+        "cube": load_data._cube_cached(path, version),
+        "cube_index": load_data._cube_index_cached(path, version),
+        "sketches": load_data._cube_sketches_cached(path, version),
+        "orders": load_data._orders_cached(path, version),
+        "orders_index": load_data._orders_index_cached(path, version),
+        "customers": load_data._customers_cached(path, version),
+        "active_index": load_data._active_index_cached(path, version),
+    }
+
+
+def _snapshot_meta() -> dict:
+    path = load_data._data_source()
+    return load_data._snapshot_cached(path, load_data._source_version(path)).schema.metadata
+
+
+def test_ingest_extends_derived_tables(dataset, make_sales):
+    derived()  # bảng dẫn xuất của bản trước nằm trong process => lần nạp sau chỉ tính phần mới
+    delta = pd.concat([make_sales(150, start="2025-06-01", days=10, seed=5, n_stores=35), dataset.tail(20)])
+
+    stats = ingest_delta(delta)
+    assert stats["added"] == len(delta) - 20
+    assert stats["duplicates"] == 20 and stats["file"] is not None
+    assert b"snapshot_append" in _snapshot_meta()
+    incremental = derived()
+
+    # cùng snapshot, build lại từ đầu mọi bảng dẫn xuất
+    _clear_caches()
+    assert_same(incremental, derived())
+
+    # snapshot build lại từ parquet + file delta: cùng nội dung theo giá trị
+    _clear_caches()
+    os.remove(load_data.SNAPSHOT_FILE)
+    fresh = derived()
+    pd.testing.assert_frame_equal(decoded(incremental["snapshot"]), decoded(fresh["snapshot"]))
+    assert np.isclose(incremental["customers"]["Net"].sum(), fresh["customers"]["Net"].sum())
+
+
+def test_ingest_late_rows_rebuilds(dataset, make_sales):
+    derived()
+    late = make_sales(40, start="2025-02-01", days=10, seed=6)
+    stats = ingest_delta(late)
+    assert stats["late"] == len(late) and stats["added"] == len(late)
+    assert b"snapshot_append" not in _snapshot_meta()  # dòng trễ => sort lại, bảng dẫn xuất build lại
+    assert len(derived()["snapshot"]) == len(dataset) + len(late)
+
+
+def test_ingest_only_duplicates_writes_nothing(dataset):
+    stats = ingest_delta(dataset.sample(50, random_state=0))
+    assert stats["added"] == 0 and stats["duplicates"] == 50 and stats["file"] is None
+    assert not os.path.exists(load_data.DELTA_DIR)